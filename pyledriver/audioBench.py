@@ -0,0 +1,122 @@
+'''
+Benchmark of keypad feedback latency, ie the time from a key event to the click
+being audible, while the alarm and other sounds keep every ordinary channel
+busy. Run from the package directory (so the sound files can be found), eg:
+
+	python audioBench.py [ITERATIONS]
+
+No sound card is needed; SDL's dummy audio driver is used unless
+SDL_AUDIODRIVER is already set. The dummy driver consumes buffers at the same
+rate as a real device, so only the hardware latency itself is missing.
+
+Latency has two parts, both of which are reported for each configuration:
+- dispatch: from the key event to the sound being on a channel (measured)
+- output: the time until the mixer mixes the channel into a buffer and that
+  buffer is played, between one and two buffer periods (computed)
+Clicks that get no channel at all are counted as dropped.
+
+Also reported is the time to load every sound in soundfx, both by decoding the
+files and from the decoded sample cache (see soundBank.py), which is the
+startup time saved once the cache is filled.
+'''
+
+import os, sys, time, statistics, tempfile, shutil
+
+os.environ.setdefault('SDL_AUDIODRIVER', 'dummy')
+
+from pygame import mixer
+
+_FREQUENCY = 44100
+
+# configurations to compare: (description, buffer size, reserved UI channels)
+_CONFIGS = [
+	('default', 1024, 0),
+	('low latency', 256, 2),
+	('low latency, 128 samples', 128, 2)
+]
+
+def _bench(buffer, uiChannels, iterations, channels=8):
+	from soundLib import SoundScheduler, SoundEffect
+
+	mixer.pre_init(frequency=_FREQUENCY, size=-16, channels=2, buffer=buffer)
+	mixer.init()
+	try:
+		mixer.set_num_channels(channels)
+		mixer.set_reserved(uiChannels)
+		scheduler = SoundScheduler({'keypad': range(uiChannels)}, range(uiChannels, channels))
+
+		click = SoundEffect('soundfx/smb_bump.wav', priority='keypad', scheduler=scheduler)
+		alarm = SoundEffect('soundfx/alarms/burgler_alarm.ogg', loops=-1, priority='alarm', scheduler=scheduler)
+		door = SoundEffect('soundfx/smb_pipe.wav', loops=-1, priority='door', scheduler=scheduler)
+
+		# occupy every ordinary channel, as during an alarm with speech
+		alarm.play()
+		for i in range(channels - uiChannels - 1):
+			door.play()
+
+		dispatch = []
+		dropped = 0
+		for i in range(iterations):
+			start = time.perf_counter()
+			channel = click.play()
+			if channel is None:
+				dropped += 1
+			else:
+				while not channel.get_busy():
+					pass
+				dispatch.append(time.perf_counter() - start)
+			# keys are not pressed faster than this
+			time.sleep(0.05)
+	finally:
+		mixer.quit()
+
+	period = buffer / _FREQUENCY
+	result = {'dropped': dropped, 'outputMin': period, 'outputMax': 2 * period}
+	if dispatch:
+		result['dispatchMedian'] = statistics.median(dispatch)
+		result['dispatchMax'] = max(dispatch)
+	return result
+
+def _benchLoad(buffer=1024):
+	from soundBank import SoundBank
+
+	paths = [os.path.join(d, f) for d, _, files in os.walk('soundfx') for f in sorted(files)]
+	cachePath = tempfile.mkdtemp(prefix='pyledriver-pcm-')
+	mixer.pre_init(frequency=_FREQUENCY, size=-16, channels=2, buffer=buffer)
+	mixer.init()
+	try:
+		result = {'files': len(paths)}
+		# a fresh bank each time so nothing is kept in memory between runs
+		for kind in ('decoded', 'mapped'):
+			bank = SoundBank(cachePath)
+			start = time.perf_counter()
+			for path in paths:
+				bank.get(path)
+			result[kind] = time.perf_counter() - start
+	finally:
+		mixer.quit()
+		shutil.rmtree(cachePath, ignore_errors=True)
+	return result
+
+def main(argv):
+	iterations = int(argv[1]) if len(argv) > 1 else 100
+	print('driver: {}, {} clicks per configuration'.format(os.environ['SDL_AUDIODRIVER'], iterations))
+	for description, buffer, uiChannels in _CONFIGS:
+		r = _bench(buffer, uiChannels, iterations)
+		print('{:<26} buffer {:>4}, ui channels {}'.format(description, buffer, uiChannels))
+		if 'dispatchMedian' in r:
+			print('    dispatch  median {:7.3f} ms   max {:7.3f} ms'.format(
+				r['dispatchMedian'] * 1000, r['dispatchMax'] * 1000))
+			print('    audible   {:7.1f} - {:.1f} ms after the key event'.format(
+				(r['dispatchMedian'] + r['outputMin']) * 1000, (r['dispatchMedian'] + r['outputMax']) * 1000))
+		print('    dropped   {}/{}'.format(r['dropped'], iterations))
+
+	r = _benchLoad()
+	print('loading {} sound files'.format(r['files']))
+	print('    decoded   {:7.1f} ms'.format(r['decoded'] * 1000))
+	print('    cached    {:7.1f} ms   ({:.1f} ms saved)'.format(
+		r['mapped'] * 1000, (r['decoded'] - r['mapped']) * 1000))
+	return 0
+
+if __name__ == '__main__':
+	sys.exit(main(sys.argv))
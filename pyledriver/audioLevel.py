@@ -0,0 +1,254 @@
+'''
+Audio sensor: detects loud transients (glass breaking, banging) in the sound
+from the camera microphone. The camera pipeline measures the rms and peak level
+of the audio in short windows with the gstreamer level element (see Camera in
+stream.py), which costs next to nothing next to the opus encoder, and feeds
+them to a LoudnessDetector. Detections go through the same action path as the
+GPIO sensors. The same levels drive the SilenceGate, which makes the opus
+encoder cheaper while there is nothing to hear.
+
+The detector can be tried on recordings or test sources without the rest of the
+program, eg:
+
+	python audioLevel.py recording.wav
+	python audioLevel.py --gst "audiotestsrc wave=white-noise volume=0.5 num-buffers=200"
+
+The first decodes the wav file with numpy; the second runs the given gstreamer
+source through the level element, as the camera does.
+'''
+
+import sys, math, logging, clock
+from threading import Lock
+
+logger = logging.getLogger(__name__)
+
+# the audio sensor has no pin, so its events are recorded in the sensor history
+# under this (real pins are far below it)
+HISTORY_ID = 0xFFFF
+
+# levels are in dBFS; silence is reported as (minus) infinity
+_FLOOR = -100.0
+
+class LoudnessDetector:
+	'''
+	Flags windows whose peak reaches peak dBFS or whose rms rises more than
+	rise dB above the background, an average of the rms of recent windows that
+	adapts by the fraction adapt each window (loudAdapt while the window is
+	loud, so a lasting change in level becomes the new background rather than
+	one endless sound). Only the onset of a loud sound is flagged, not every
+	window it lasts. The background is only learnt (nothing is flagged) for the
+	first warmup seconds. After a detection nothing is flagged for holdoff
+	seconds. Nor is anything flagged while playing() is True (ie our own
+	speaker is making noise, which the microphone hears too) or for echoTail
+	seconds after. action() is called on each detection, from whatever thread
+	calls feed (ie the camera's bus thread)
+	'''
+	def __init__(self, peak=-3, rise=25, adapt=0.02, loudAdapt=0.002, warmup=5, holdoff=2,
+		echoTail=1, action=None, playing=None):
+		self.peak = peak
+		self.rise = rise
+		self.adapt = adapt
+		self.loudAdapt = loudAdapt
+		self.warmup = warmup
+		self.holdoff = holdoff
+		self.echoTail = echoTail
+		self.action = action
+		self.playing = playing
+		self._echoEnd = None
+		self.background = None
+		self._start = None
+		self._last = None
+		self._loud = False
+		self._lock = Lock()
+		self.windows = 0
+		self.detections = 0
+		self.suppressed = 0
+		self.level = None
+
+	@classmethod
+	def fromConfig(cls, conf, **kwargs):
+		keys = ('peak', 'rise', 'adapt', 'loudAdapt', 'warmup', 'holdoff', 'echoTail')
+		return cls(**dict({k: conf[k] for k in keys if k in conf}, **kwargs))
+
+	def feed(self, rms, peak):
+		'''
+		Take the levels of one window, returning True if it was flagged
+		'''
+		rms = max(rms, _FLOOR)
+		peak = max(peak, _FLOOR)
+		now = clock.monotonic()
+		playing = self.playing
+		if playing and playing():
+			self._echoEnd = now + self.echoTail
+		with self._lock:
+			self.windows += 1
+			self.level = (rms, peak)
+			if self._start is None:
+				self._start = now
+			if self.background is None:
+				self.background = rms
+
+			loud = peak >= self.peak or rms - self.background >= self.rise
+			self.background += (rms - self.background) * (self.loudAdapt if loud else self.adapt)
+			onset = loud and not self._loud
+			self._loud = loud
+
+			if not onset or now - self._start < self.warmup or \
+				(self._last is not None and now - self._last < self.holdoff):
+				return False
+			if self._echoEnd is not None and now < self._echoEnd:
+				self.suppressed += 1
+				return False
+			self._last = now
+			self.detections += 1
+			action = self.action
+
+		logger.debug('Loud sound: rms %.1f dB, peak %.1f dB (background %.1f dB)', rms, peak, self.background)
+		if action:
+			action()
+		return True
+
+	def stats(self):
+		with self._lock:
+			return {
+				'windows': self.windows,
+				'detections': self.detections,
+				'suppressed': self.suppressed,
+				'level': self.level,
+				'background': self.background
+			}
+
+class SilenceGate:
+	'''
+	Switches an opus encoder to low complexity and bitrate while the audio is
+	silent, ie the rms level of every window of the last hangover seconds was
+	under threshold dBFS, and back as soon as a window is not. Every frame is
+	still encoded, so the RTP stream stays continuous for its receivers
+	(Janus and FileDump); silence just costs less CPU to encode and less to
+	send. Windows are counted rather than timed, so the gate behaves the same
+	when audio is processed faster than real time (eg in a benchmark)
+	'''
+	def __init__(self, encoder, interval, threshold=-50, hangover=1, complexity=0, bitrate=8000):
+		self._encoder = encoder
+		self._interval = interval
+		self.threshold = threshold
+		self._hangover = max(1, round(hangover / interval))
+		self._settings = {
+			False: {p: encoder.get_property(p) for p in ('complexity', 'bitrate')},
+			True: {'complexity': complexity, 'bitrate': bitrate}
+		}
+		self._quiet = 0
+		self.silent = False
+		self.windows = 0
+		self.silentWindows = 0
+		self.switches = 0
+
+	@classmethod
+	def fromConfig(cls, encoder, interval, conf):
+		keys = ('threshold', 'hangover', 'complexity', 'bitrate')
+		return cls(encoder, interval, **{k: conf[k] for k in keys if k in conf})
+
+	def feed(self, rms, peak):
+		self.windows += 1
+		self._quiet = self._quiet + 1 if rms < self.threshold else 0
+		silent = self._quiet >= self._hangover
+		if silent != self.silent:
+			for prop, value in self._settings[silent].items():
+				self._encoder.set_property(prop, value)
+			self.silent = silent
+			self.switches += 1
+			logger.debug('Audio is %s, encoding at complexity %s', 'silent' if silent else 'active',
+				self._settings[silent]['complexity'])
+		if silent:
+			self.silentWindows += 1
+
+	def stats(self):
+		return {
+			'silent': self.silent,
+			'silentSeconds': self.silentWindows * self._interval,
+			'activeSeconds': (self.windows - self.silentWindows) * self._interval,
+			'switches': self.switches
+		}
+
+def _dB(x):
+	return 20 * math.log10(x) if x > 0 else -math.inf
+
+def wavLevels(path, interval=0.05):
+	'''
+	Levels (rms, peak) of each window of a wav file, computed the way the level
+	element does (the loudest channel of each window)
+	'''
+	import wave, numpy
+
+	with wave.open(path) as w:
+		width, channels, rate = w.getsampwidth(), w.getnchannels(), w.getframerate()
+		data = w.readframes(w.getnframes())
+
+	if width == 1:
+		samples = (numpy.frombuffer(data, numpy.uint8).astype(numpy.float32) - 128) / 128
+	elif width in (2, 4):
+		dtype = numpy.int16 if width == 2 else numpy.int32
+		samples = numpy.frombuffer(data, dtype).astype(numpy.float32) / -numpy.iinfo(dtype).min
+	else:
+		raise ValueError('Unsupported sample width: {}'.format(width))
+
+	window = max(1, int(rate * interval))
+	n = len(samples) // channels // window
+	samples = samples[:n * window * channels].reshape(n, window, channels)
+	rms = numpy.sqrt(numpy.mean(samples ** 2, axis=1)).max(axis=1)
+	peak = numpy.abs(samples).max(axis=(1, 2))
+	return [(_dB(r), _dB(p)) for r, p in zip(rms, peak)]
+
+def gstLevels(source, interval=0.05):
+	'''
+	Levels (rms, peak) of each window of a gstreamer source (a gst-launch style
+	description), measured with the level element
+	'''
+	import gi
+	gi.require_version('Gst', '1.0')
+	from gi.repository import Gst
+
+	Gst.init(None)
+	pipeline = Gst.parse_launch('{} ! audioconvert ! level name=level interval={} ! fakesink sync=false'
+		.format(source, int(interval * Gst.SECOND)))
+	bus = pipeline.get_bus()
+	pipeline.set_state(Gst.State.PLAYING)
+	try:
+		while 1:
+			msg = bus.timed_pop_filtered(Gst.CLOCK_TIME_NONE,
+				Gst.MessageType.ELEMENT | Gst.MessageType.EOS | Gst.MessageType.ERROR)
+			if msg.type == Gst.MessageType.ERROR:
+				raise RuntimeError(msg.parse_error()[0].message)
+			if msg.type == Gst.MessageType.EOS:
+				break
+			structure = msg.get_structure()
+			if structure.get_name() == 'level':
+				yield max(structure.get_value('rms')), max(structure.get_value('peak'))
+	finally:
+		pipeline.set_state(Gst.State.NULL)
+
+def main(argv):
+	if len(argv) == 3 and argv[1] == '--gst':
+		levels = gstLevels(argv[2])
+	elif len(argv) == 2:
+		levels = wavLevels(argv[1])
+	else:
+		print('usage: {} FILE.wav | --gst SOURCE'.format(argv[0]))
+		return 1
+
+	# replay the windows on a virtual clock so the time based settings behave
+	# as they would live
+	interval = 0.05
+	virtual = clock.VirtualClock()
+	clock.setClock(virtual)
+	detector = LoudnessDetector()
+	for i, (rms, peak) in enumerate(levels):
+		if detector.feed(rms, peak):
+			print('{:8.2f} s  rms {:6.1f} dB  peak {:6.1f} dB  background {:6.1f} dB'.format(
+				i * interval, rms, peak, detector.background))
+		virtual.advance(interval)
+	print('{} windows, {} detections'.format(detector.windows, detector.detections))
+	return 0
+
+if __name__ == '__main__':
+	sys.exit(main(sys.argv))
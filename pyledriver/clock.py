@@ -0,0 +1,105 @@
+'''
+Shared clock for anything that needs to tell time or wait on it (countdowns,
+sensor delays, etc). By default this simply wraps the time module, but it can be
+swapped for a virtual clock (see simulation.py) so that time-dependent logic can
+be driven deterministically and much faster than real time.
+
+Use the module-level functions (eg clock.sleep) rather than holding a reference
+to a clock object so that the swap is seen everywhere.
+'''
+
+import time, heapq
+from threading import Condition
+
+class RealClock:
+	'''
+	Wall clock time, ie the time module
+	'''
+	def monotonic(self):
+		return time.monotonic()
+
+	def time(self):
+		return time.time()
+
+	def sleep(self, seconds):
+		time.sleep(seconds)
+
+	def wait(self, event, timeout=None):
+		return event.wait(timeout)
+
+class VirtualClock:
+	'''
+	Clock that only moves when told to via advance. Threads that sleep on this
+	clock block until virtual time passes their deadline. Every time a sleeper is
+	woken the clock pauses for a short (real) settle period to let the woken
+	thread run (and possibly go back to sleep) before time moves on, which keeps
+	the order of events the same as it would be in real time.
+	'''
+	def __init__(self, start=0, settle=0.005):
+		self._now = start
+		self._epoch = time.time() - start
+		self._settle = settle
+		self._deadlines = []
+		self._cond = Condition()
+
+	def monotonic(self):
+		return self._now
+
+	def time(self):
+		return self._epoch + self._now
+
+	def sleep(self, seconds):
+		with self._cond:
+			deadline = self._now + seconds
+			heapq.heappush(self._deadlines, deadline)
+			while self._now < deadline:
+				self._cond.wait()
+
+	def wait(self, event, timeout=None):
+		if timeout is None:
+			return event.wait()
+		with self._cond:
+			deadline = self._now + timeout
+			heapq.heappush(self._deadlines, deadline)
+			# events do not notify our condition, so poll them in real time
+			while not event.is_set() and self._now < deadline:
+				self._cond.wait(self._settle)
+		return event.is_set()
+
+	def advance(self, seconds):
+		'''
+		Move time forward, waking each sleeper in order of its deadline
+		'''
+		with self._cond:
+			target = self._now + seconds
+			while self._deadlines and self._deadlines[0] <= target:
+				self._now = max(self._now, heapq.heappop(self._deadlines))
+				self._cond.notify_all()
+				self._cond.wait(self._settle)
+			self._now = target
+			self._cond.notify_all()
+
+	def advanceTo(self, t):
+		if t > self._now:
+			self.advance(t - self._now)
+
+_clock = RealClock()
+
+def getClock():
+	return _clock
+
+def setClock(c):
+	global _clock
+	_clock = c
+
+def monotonic():
+	return _clock.monotonic()
+
+def now():
+	return _clock.time()
+
+def sleep(seconds):
+	_clock.sleep(seconds)
+
+def wait(event, timeout=None):
+	return _clock.wait(event, timeout)
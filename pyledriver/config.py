@@ -34,6 +34,9 @@ class _ReadOnlyFile():
 	def __getitem__(self, key):
 		return self._dict[key]
 		
+	def get(self, key, default=None):
+		return self._dict.get(key, default)
+		
 	def _load(self):
 		with open(self._path, 'r') as f:
 			self._dict = yaml.safe_load(f)
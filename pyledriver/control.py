@@ -0,0 +1,125 @@
+'''
+Control API over a unix domain socket, meant for scripts and ssh sessions that
+need to send secrets to the state machine (eg "secret" or "secret zone").
+
+Clients connect and send commands as lines of text. Any number of commands may
+be sent over one connection, and they may be pipelined (sent without waiting
+for replies); each gets exactly one reply, in order, as a line of json. A reply
+is only sent once the command has been carried out, so for secrets it reflects
+the state after the transition, eg:
+
+	$ echo rudess | socat - UNIX-CONNECT:/tmp/pyledriver.sock
+	{"ok": true, "state": "armed", "zones": {"house": "armed"}}
+
+Any number of clients may be connected at once. All of them are served by the
+input reactor (see reactor.py), so no thread is needed per client. The socket
+is only accessible to the owner and group.
+'''
+
+import os, socket, json, logging
+from profiling import markOrigin
+
+logger = logging.getLogger(__name__)
+
+class _Client:
+	def __init__(self, sock):
+		self.sock = sock
+		self.partial = b''
+
+class ControlServer:
+	'''
+	Listens on path and calls handler(command) for each command received.
+	handler returns a dict which is sent back as the reply
+	'''
+	_mode = 0o660
+
+	# max length of one command; longer lines drop the connection
+	_maxLine = 4096
+
+	def __init__(self, path, handler, reactor):
+		self._path = path
+		self._handler = handler
+		self._reactor = reactor
+		self._sock = None
+		self._clients = {}
+
+	def start(self):
+		try:
+			os.remove(self._path)
+		except FileNotFoundError:
+			pass
+
+		self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+		self._sock.bind(self._path)
+		os.chmod(self._path, self._mode)
+		self._sock.listen()
+		self._sock.setblocking(False)
+		self._reactor.register(self._sock, self._accept, 'control')
+		logger.debug('Started control server at %s', self._path)
+
+	def stop(self):
+		for client in list(self._clients.values()):
+			self._close(client)
+		if self._sock:
+			self._reactor.unregister(self._sock)
+			self._sock.close()
+			self._sock = None
+		try:
+			os.remove(self._path)
+			logger.debug('Cleaned up control server at %s', self._path)
+		except FileNotFoundError:
+			pass
+
+	def _accept(self):
+		try:
+			sock, _ = self._sock.accept()
+		except BlockingIOError:
+			return
+		sock.setblocking(False)
+		client = self._clients[sock.fileno()] = _Client(sock)
+		self._reactor.register(sock, lambda: self._read(client), 'control.client')
+		logger.debug('Control client connected (%s total)', len(self._clients))
+
+	def _read(self, client):
+		try:
+			data = client.sock.recv(4096)
+		except (BlockingIOError, InterruptedError):
+			return
+		except OSError:
+			data = b''
+
+		if not data:
+			self._close(client)
+			return
+
+		*lines, client.partial = (client.partial + data).split(b'\n')
+		if len(client.partial) > self._maxLine:
+			logger.warning('Dropping control client that sent an overlong command')
+			self._close(client)
+			return
+
+		replies = []
+		for line in lines:
+			command = line.decode(errors='replace').strip()
+			if command:
+				markOrigin('control')
+				replies.append(json.dumps(self._handler(command)))
+
+		if replies:
+			self._send(client, ('\n'.join(replies) + '\n').encode())
+
+	def _send(self, client, data):
+		try:
+			client.sock.sendall(data)
+		except BlockingIOError:
+			# the client is not reading its replies
+			logger.warning('Dropping control client with a full reply buffer')
+			self._close(client)
+		except OSError:
+			self._close(client)
+
+	def _close(self, client):
+		self._reactor.unregister(client.sock)
+		self._clients.pop(client.sock.fileno(), None)
+		client.sock.close()
+		logger.debug('Control client disconnected (%s total)', len(self._clients))
@@ -0,0 +1,131 @@
+'''
+Confirmation stage between the sensors and the state machine. A single filtered
+edge from one sensor is not necessarily an intruder (mains spikes, pets,
+sunlight on an IR sensor, etc) so sensor hits are only passed on as a TRIP once
+they satisfy at least one rule. Each rule says how many hits from which sensors
+must occur within a time window, eg:
+
+	tripRules:
+	- sensors: [door]         # the door alone suffices
+	  count: 1
+	- count: 2                # any two different sensors within 10 seconds
+	  window: 10
+	- sensors: [kitchen bar]  # three hits from the same sensor within 30 s
+	  count: 3
+	  window: 30
+	  distinct: false
+
+If sensors is omitted the rule applies to every sensor. By default hits must
+come from different sensors (distinct); otherwise repeated hits from the same
+sensor count as well. With no rules configured any single hit confirms, which
+is the same as having no confirmation stage.
+'''
+
+import logging, time, clock
+from collections import deque
+from threading import Lock
+
+logger = logging.getLogger(__name__)
+
+class _Rule:
+	def __init__(self, sensors=None, count=1, window=0, distinct=True):
+		self.sensors = None if sensors is None else frozenset(sensors)
+		self.count = count
+		self.window = window
+		self.distinct = distinct
+
+	def applies(self, sensor):
+		return self.sensors is None or sensor in self.sensors
+
+	def matches(self, hits, now):
+		'''
+		Evaluates the rule against hits (a dict of sensor: deque of timestamps,
+		newest last)
+		'''
+		since = now - self.window
+		n = 0
+		for sensor, times in hits.items():
+			if not self.applies(sensor) or not times or times[-1] < since:
+				continue
+			if self.distinct:
+				n += 1
+			else:
+				# timestamps are sorted, so count back from the newest
+				for t in reversed(times):
+					if t < since:
+						break
+					n += 1
+			if n >= self.count:
+				return True
+		return False
+
+	def __str__(self):
+		sensors = 'any' if self.sensors is None else ', '.join(sorted(self.sensors))
+		return '{} {}hits from [{}] within {}s'.format(self.count,
+			'distinct ' if self.distinct else '', sensors, self.window)
+
+class CorrelationFilter:
+	'''
+	Keeps a sliding window of recent hits for each sensor and decides whether a
+	new hit confirms a trip. Hits older than the longest rule window are
+	discarded as new hits arrive, so memory is bounded by the hit rate. Also
+	keeps counts of confirmed/suppressed hits and the time spent evaluating rules
+	'''
+	def __init__(self, rules=None):
+		self._rules = [_Rule(**r) for r in rules] if rules else [_Rule()]
+		self._maxWindow = max(r.window for r in self._rules)
+		self._hits = {}
+		self._lock = Lock()
+
+		self.confirmed = 0
+		self.suppressed = 0
+		self._evalCount = 0
+		self._evalTotal = 0
+		self._evalMax = 0
+
+	def hit(self, sensor):
+		'''
+		Record a hit from sensor and return True if any rule is now satisfied
+		'''
+		now = clock.monotonic()
+		start = time.perf_counter()
+
+		with self._lock:
+			times = self._hits.setdefault(sensor, deque())
+			times.append(now)
+			since = now - self._maxWindow
+			while times and times[0] < since:
+				times.popleft()
+
+			rule = next((r for r in self._rules if r.applies(sensor) and r.matches(self._hits, now)), None)
+
+			if rule:
+				self.confirmed += 1
+			else:
+				self.suppressed += 1
+
+			elapsed = time.perf_counter() - start
+			self._evalCount += 1
+			self._evalTotal += elapsed
+			self._evalMax = max(self._evalMax, elapsed)
+
+		if rule:
+			logger.debug('Hit on %s confirmed by rule: %s', sensor, rule)
+		else:
+			logger.debug('Hit on %s not confirmed by any rule', sensor)
+
+		return rule is not None
+
+	def clear(self):
+		with self._lock:
+			self._hits.clear()
+
+	def stats(self):
+		with self._lock:
+			return {
+				'confirmed': self.confirmed,
+				'suppressed': self.suppressed,
+				'evaluations': self._evalCount,
+				'meanLatency': self._evalTotal / self._evalCount if self._evalCount else None,
+				'maxLatency': self._evalMax
+			}
@@ -0,0 +1,256 @@
+'''
+Debounce/filter engine for binary GPIO inputs. This exists to filter out
+voltage spikes that are induced by mains current fluctuations without ever
+sleeping in the GPIO callback thread (RPi.GPIO runs all edge callbacks serially
+on one thread, so sleeping there holds up every other pin).
+
+The edge callback merely reads the level, timestamps it and pushes it onto a
+per-pin ring buffer, then schedules a decision deadline. A single worker thread
+waits on the earliest deadline; once reached, the level is accepted if no other
+edge has arrived on that pin since and the pin still reads the same level. Thus
+a level must be stable for a given time (the filter profile) to be passed on to
+the handler, and anything shorter counts as a rejected spike.
+
+Only changes in the stable level are passed on, as handler(pin, level). A
+holdoff can be set so that changes on one pin are delivered at most once per
+holdoff; changes within the holdoff are delayed (not dropped) until it expires.
+
+Edges come from a backend, which must implement setup(pin), read(pin) and
+watch(pin, callback) where callback is called as callback(pin, level, t) on
+every edge (t being the time of the edge on the shared clock). The default
+backend is RPi.GPIO; see gpiochip.py for the character device backend.
+
+The worker thread doubles as a scheduler (see schedule) so that delayed work
+such as sensor warm-up does not need a thread of its own.
+'''
+
+import RPi.GPIO as GPIO
+import logging, time, heapq, itertools, clock
+from array import array
+from threading import Event, Lock
+from exceptionThreading import ExceptionThread
+from profiling import markOrigin
+
+logger = logging.getLogger(__name__)
+
+class RPiGPIOBackend:
+	'''
+	Edge source using RPi.GPIO. Note the level is read in the callback since
+	RPi.GPIO does not say which edge occurred
+	'''
+	def setup(self, pin):
+		GPIO.setup(pin, GPIO.IN, pull_up_down=GPIO.PUD_DOWN)
+
+	def read(self, pin):
+		return GPIO.input(pin)
+
+	def watch(self, pin, callback):
+		def edge(channel):
+			callback(pin, GPIO.input(pin), clock.monotonic())
+		GPIO.add_event_detect(pin, GPIO.BOTH, callback=edge)
+
+class FilterProfile:
+	'''
+	Parameters for one pin. stableTime is how long (in seconds) a level must hold
+	to be accepted; holdoff is the minimum time between delivered changes
+	'''
+	def __init__(self, stableTime=0.001, holdoff=0.5):
+		self.stableTime = stableTime
+		self.holdoff = holdoff
+
+	@classmethod
+	def fromConfig(cls, conf):
+		return cls(**conf) if conf else cls()
+
+class _PinFilter:
+	'''
+	State of one pin, including a ring buffer of the last few edges (timestamp
+	and level) for diagnostics
+	'''
+	_ringSize = 64
+
+	def __init__(self, pin, handler, profile, level):
+		self.pin = pin
+		self.handler = handler
+		self.profile = profile
+		self.stableLevel = level
+		self.stableSince = clock.monotonic()
+		self.highTime = 0
+		self.lastEdge = None
+		self.lastDelivery = None
+		self.pending = False
+
+		self.edgeTimes = array('d', [0] * self._ringSize)
+		self.edgeLevels = array('b', [0] * self._ringSize)
+		self.edges = 0
+		self.accepted = 0
+		self.rejected = 0
+
+	def recordEdge(self, t, level):
+		i = self.edges % self._ringSize
+		self.edgeTimes[i] = t
+		self.edgeLevels[i] = level
+		self.edges += 1
+		self.lastEdge = (t, level, time.perf_counter())
+
+	def recentEdges(self):
+		'''
+		Returns the edges in the ring buffer as (timestamp, level), oldest first
+		'''
+		n = min(self.edges, self._ringSize)
+		start = self.edges - n
+		return [(self.edgeTimes[i % self._ringSize], self.edgeLevels[i % self._ringSize])
+			for i in range(start, self.edges)]
+
+class DebounceEngine(ExceptionThread):
+	'''
+	Manages the filters for all pins with one worker thread. Pins are set up
+	and added with register, which also starts watching the pin for edges
+	'''
+	def __init__(self, backend=None):
+		self._backend = backend or RPiGPIOBackend()
+		self._filters = {}
+		self._deadlines = []
+		self._seq = itertools.count()
+		self._lock = Lock()
+		self._wake = Event()
+		self._stopper = Event()
+		super().__init__(target=self._run, daemon=True)
+
+	def _ensureStarted(self):
+		if not self.is_alive():
+			try:
+				self.start()
+			except RuntimeError:
+				pass # another thread beat us to it
+
+	def register(self, pin, handler, profile=None):
+		self._backend.setup(pin)
+		with self._lock:
+			self._filters[pin] = _PinFilter(pin, handler, profile or FilterProfile(),
+				self._backend.read(pin))
+		self._backend.watch(pin, self._edge)
+		self._ensureStarted()
+
+	def schedule(self, delay, fn):
+		'''
+		Call fn on the worker thread after delay seconds
+		'''
+		with self._lock:
+			heapq.heappush(self._deadlines, (clock.monotonic() + delay, next(self._seq), None, fn))
+		self._ensureStarted()
+		self._wake.set()
+
+	def read(self, pin):
+		'''
+		Current (unfiltered) level of pin
+		'''
+		return self._backend.read(pin)
+
+	def level(self, pin):
+		'''
+		Last accepted (stable) level of pin
+		'''
+		return self._filters[pin].stableLevel
+
+	def stats(self):
+		return {pin: {'edges': f.edges, 'accepted': f.accepted, 'rejected': f.rejected}
+			for pin, f in self._filters.items()}
+
+	def recentEdges(self, pin):
+		return self._filters[pin].recentEdges()
+
+	def counters(self, pin):
+		'''
+		Cumulative counters of pin (or None if not registered) for health
+		monitoring. highTime is the total time the stable level has been high
+		'''
+		with self._lock:
+			f = self._filters.get(pin)
+			if f is None:
+				return None
+			now = clock.monotonic()
+			return {
+				'edges': f.edges,
+				'accepted': f.accepted,
+				'rejected': f.rejected,
+				'level': f.stableLevel,
+				'since': f.stableSince,
+				'highTime': f.highTime + (now - f.stableSince if f.stableLevel else 0),
+				'lastEdge': f.lastEdge and f.lastEdge[0]
+			}
+
+	def lastEdgeTime(self, pin):
+		'''
+		Time of the last (unfiltered) edge on pin or None if there has been none
+		'''
+		lastEdge = self._filters[pin].lastEdge
+		return lastEdge and lastEdge[0]
+
+	def stop(self):
+		self._stopper.set()
+		self._wake.set()
+
+	def _edge(self, pin, level, t):
+		'''
+		Edge callback. Must stay fast; it never sleeps or waits on anything but
+		a short uncontended lock
+		'''
+		with self._lock:
+			f = self._filters[pin]
+			f.recordEdge(t, level)
+			f.pending = True
+			heapq.heappush(self._deadlines, (t + f.profile.stableTime, next(self._seq), pin, None))
+		self._wake.set()
+
+	def _run(self):
+		while not self._stopper.is_set():
+			self._wake.clear()
+
+			with self._lock:
+				if self._deadlines:
+					deadline, seq, pin, fn = self._deadlines[0]
+					timeout = deadline - clock.monotonic()
+					if timeout <= 0:
+						heapq.heappop(self._deadlines)
+				else:
+					timeout = None
+
+			if timeout is None or timeout > 0:
+				clock.wait(self._wake, timeout)
+			elif fn:
+				fn()
+			else:
+				self._decide(pin, deadline)
+
+	def _decide(self, pin, deadline):
+		with self._lock:
+			f = self._filters[pin]
+			edgeTime, edgeLevel, edgePerf = f.lastEdge
+
+			# a newer edge has its own (later) deadline; let that one decide
+			if not f.pending or edgeTime + f.profile.stableTime > deadline:
+				return
+
+			# delay the change until the holdoff expires
+			if f.lastDelivery is not None and deadline < f.lastDelivery + f.profile.holdoff:
+				heapq.heappush(self._deadlines, (f.lastDelivery + f.profile.holdoff,
+					next(self._seq), pin, None))
+				return
+
+			f.pending = False
+			level = self._backend.read(pin)
+
+			if level != edgeLevel or level == f.stableLevel:
+				f.rejected += 1
+				return
+
+			if f.stableLevel:
+				f.highTime += deadline - f.stableSince
+			f.stableLevel = level
+			f.stableSince = deadline
+			f.lastDelivery = deadline
+			f.accepted += 1
+
+		markOrigin('gpio', edgePerf)
+		f.handler(pin, level)
@@ -46,7 +46,7 @@ class ExceptionThread(Thread):
 		except BaseException as e:
 			self._queue.put(e)
 
-class async:
+class threaded:
 	'''
 	Wraps any function in an exception-aware thread and starts the thread.
 	Intended to be used as a decorator
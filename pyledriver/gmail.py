@@ -1,6 +1,6 @@
 import logging, time
 from config import configFile
-from exceptionThreading import async
+from exceptionThreading import threaded
 from smtplib import SMTP
 from datetime import datetime
 from email.mime.multipart import MIMEMultipart
@@ -16,7 +16,7 @@ def _getNextDate():
 	y = y + 1 if m > 12 else y
 	return datetime(year=y, month=((m-1)%12)+1, day=1, hour=12, minute=0)
 
-@async(daemon=True)
+@threaded(daemon=True)
 def _scheduleAction(action):
 	while 1:
 		nextDate = _getNextDate()
@@ -25,7 +25,7 @@ def _scheduleAction(action):
 		time.sleep(sleepTime.days * 86400 + sleepTime.seconds)
 		action()
 
-@async(daemon=False)
+@threaded(daemon=False)
 def _sendToGmail(username, passwd, recipiantList, subject, body, server='smtp.gmail.com', port=587):
 	msg = MIMEMultipart()
 	msg['Subject'] =  subject
@@ -0,0 +1,129 @@
+'''
+Sensor input backend using the linux GPIO character device (/dev/gpiochipN)
+rather than RPi.GPIO. Each line is requested for edge events (both edges, with
+pull-down) and all line fds are multiplexed in one epoll reactor thread, so
+adding sensors costs no extra threads. Edge events carry kernel timestamps,
+which are more accurate than timestamping in userspace.
+
+This talks to the kernel directly through the v1 uAPI ioctls (no libgpiod
+needed). Note that on kernels before 5.7 the event timestamps are
+CLOCK_REALTIME rather than CLOCK_MONOTONIC; both are handled.
+
+The line implementation is a class attribute (lineClass) so that it may be
+swapped for a fake (see simulation.py), and since the backend only needs a
+path to a chip it works just as well with a gpio-sim chip.
+'''
+
+import os, fcntl, errno, struct, selectors, logging, time, clock
+from threading import Event
+from exceptionThreading import ExceptionThread
+
+logger = logging.getLogger(__name__)
+
+# from linux/gpio.h
+_GPIO_GET_LINEEVENT_IOCTL = 0xC030B404
+_GPIOHANDLE_GET_LINE_VALUES_IOCTL = 0xC040B408
+_GPIOHANDLE_REQUEST_INPUT = 1 << 0
+_GPIOHANDLE_REQUEST_BIAS_PULL_DOWN = 1 << 6
+_GPIOEVENT_REQUEST_BOTH_EDGES = 0x3
+_GPIOEVENT_EVENT_RISING_EDGE = 0x1
+
+# struct gpioevent_request and struct gpioevent_data (padded to 8 bytes)
+_REQUEST = struct.Struct('=III32si')
+EVENT = struct.Struct('=QI4x')
+
+class ChipLine:
+	'''
+	One line of a gpio chip requested for edge events
+	'''
+	def __init__(self, chipFd, offset, consumer):
+		flags = _GPIOHANDLE_REQUEST_INPUT | _GPIOHANDLE_REQUEST_BIAS_PULL_DOWN
+		try:
+			self.fd = self._request(chipFd, offset, flags, consumer)
+		except OSError as e:
+			# bias flags are only supported since linux 5.5
+			if e.errno != errno.EINVAL:
+				raise
+			logger.warning('Cannot set pull-down on line %s, relying on external resistor', offset)
+			self.fd = self._request(chipFd, offset, _GPIOHANDLE_REQUEST_INPUT, consumer)
+
+	@staticmethod
+	def _request(chipFd, offset, flags, consumer):
+		req = bytearray(_REQUEST.pack(offset, flags, _GPIOEVENT_REQUEST_BOTH_EDGES,
+			consumer.encode()[:31], 0))
+		fcntl.ioctl(chipFd, _GPIO_GET_LINEEVENT_IOCTL, req)
+		return _REQUEST.unpack(req)[4]
+
+	def value(self):
+		data = bytearray(64)
+		fcntl.ioctl(self.fd, _GPIOHANDLE_GET_LINE_VALUES_IOCTL, data)
+		return data[0]
+
+	def close(self):
+		os.close(self.fd)
+
+def _toClock(ns):
+	'''
+	Convert a kernel event timestamp (in ns) to the shared clock. The age of the
+	event is worked out against whichever kernel clock the timestamp is from
+	'''
+	t = ns / 1e9
+	realtime = time.time()
+	monotonic = time.monotonic()
+	ref = realtime if abs(t - realtime) < abs(t - monotonic) else monotonic
+	return clock.monotonic() - max(0, ref - t)
+
+class GpioChipBackend(ExceptionThread):
+	'''
+	Edge source for the debounce engine (see debounce.py). Pins are line offsets
+	on the chip
+	'''
+	lineClass = ChipLine
+
+	# max events read from a line per wakeup
+	_batch = 16
+
+	def __init__(self, path='/dev/gpiochip0', consumer='pyledriver'):
+		self._path = path
+		self._consumer = consumer
+		self._chipFd = None
+		self._lines = {}
+		self._callbacks = {}
+		self._selector = selectors.DefaultSelector()
+		self._stopper = Event()
+		super().__init__(target=self._run, daemon=True)
+
+	def setup(self, pin):
+		if self._chipFd is None:
+			self._chipFd = os.open(self._path, os.O_RDWR | os.O_CLOEXEC)
+			logger.debug('Opened gpio chip %s', self._path)
+		self._lines[pin] = self.lineClass(self._chipFd, pin, self._consumer)
+
+	def read(self, pin):
+		return self._lines[pin].value()
+
+	def watch(self, pin, callback):
+		self._callbacks[pin] = callback
+		self._selector.register(self._lines[pin].fd, selectors.EVENT_READ, pin)
+		if not self.is_alive():
+			self.start()
+			logger.debug('Started gpio chip reactor for %s', self._path)
+
+	def stop(self):
+		self._stopper.set()
+		for line in self._lines.values():
+			line.close()
+		if self._chipFd is not None:
+			os.close(self._chipFd)
+			self._chipFd = None
+
+	def _run(self):
+		while not self._stopper.is_set():
+			for key, mask in self._selector.select(timeout=1):
+				self._dispatch(key.fd, key.data)
+
+	def _dispatch(self, fd, pin):
+		data = os.read(fd, EVENT.size * self._batch)
+		callback = self._callbacks[pin]
+		for ts, id in EVENT.iter_unpack(data[:len(data) - len(data) % EVENT.size]):
+			callback(pin, 1 if id == _GPIOEVENT_EVENT_RISING_EDGE else 0, _toClock(ts))
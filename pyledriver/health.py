@@ -0,0 +1,112 @@
+'''
+Sensor health monitoring. A dead sensor shows up as silence and a flapping one
+as a stream of hits (and possibly false trips), neither of which is obvious
+from the logs. The debounce engine keeps cheap cumulative counters for each pin
+(edges, accepted and rejected changes, time spent high) which are sampled
+periodically here; rates are worked out from the difference between samples
+so nothing extra happens on the hot path.
+
+Each sensor may be flagged as:
+- stuckHigh: a motion sensor has been high for longer than stuckHigh seconds
+- silent: a sensor has not had a single edge for longer than silent seconds
+- flapping: edges arrive faster than flapRate per minute, or more than
+  flapRejected of the level changes seen by the filter are rejected (ie
+  spikes; each of these is two edges, so the rate is not worked out per edge)
+
+Thresholds may be set in the config under sensorHealth. Flags are logged when
+raised and cleared.
+'''
+
+import logging, clock
+from threading import Event
+from exceptionThreading import ExceptionThread
+from sensors import getSensorCounters, isSensorReady
+
+logger = logging.getLogger(__name__)
+
+_DEFAULTS = {
+	'interval': 10,
+	'stuckHigh': 600,
+	'silent': 86400,
+	'flapRate': 30,
+	'flapRejected': 0.5
+}
+
+class SensorHealth(ExceptionThread):
+	'''
+	Samples the counters of sensors (a dict of name: (pin, type)) every interval
+	seconds and keeps the latest metrics and flags for each
+	'''
+	def __init__(self, sensors, conf=None):
+		self._sensors = sensors
+		self._conf = dict(_DEFAULTS, **(conf or {}))
+		self._stopper = Event()
+		self._last = {}
+		self._startTime = clock.monotonic()
+		self.metrics = {}
+
+		def poll():
+			while not clock.wait(self._stopper, self._conf['interval']):
+				self.sample()
+
+		super().__init__(target=poll, daemon=True)
+
+	def sample(self):
+		now = clock.monotonic()
+		for name, (pin, sensorType) in self._sensors.items():
+			counters = getSensorCounters(pin)
+			if counters is None:
+				continue
+
+			last, lastTime = self._last.get(name, (None, None))
+			self._last[name] = (counters, now)
+
+			metrics = {
+				'level': counters['level'],
+				'timeInState': now - counters['since'],
+				'highFraction': counters['highTime'] / max(now - self._startTime, 1e-9),
+				'edges': counters['edges'],
+				'rejected': counters['rejected']
+			}
+
+			if last:
+				edges = counters['edges'] - last['edges']
+				rejected = counters['rejected'] - last['rejected']
+				changes = counters['accepted'] - last['accepted'] + rejected
+				metrics['edgeRate'] = edges * 60 / (now - lastTime)
+				metrics['rejectRate'] = rejected / changes if changes else 0
+			else:
+				metrics['edgeRate'] = metrics['rejectRate'] = None
+
+			metrics['flags'] = self._flags(sensorType, pin, metrics, counters, now)
+			self._report(name, self.metrics.get(name, {}).get('flags', []), metrics['flags'])
+			self.metrics[name] = metrics
+
+	def _flags(self, sensorType, pin, metrics, counters, now):
+		conf = self._conf
+		flags = []
+		if sensorType == 'motion' and counters['level'] and metrics['timeInState'] > conf['stuckHigh']:
+			flags.append('stuckHigh')
+		if isSensorReady(pin) and now - (counters['lastEdge'] or self._startTime) > conf['silent']:
+			flags.append('silent')
+		if metrics['edgeRate'] is not None and (metrics['edgeRate'] > conf['flapRate'] or
+				metrics['rejectRate'] > conf['flapRejected']):
+			flags.append('flapping')
+		return flags
+
+	def _report(self, name, lastFlags, flags):
+		for flag in flags:
+			if flag not in lastFlags:
+				logger.warning('Sensor \"%s\" is %s', name, flag)
+		for flag in lastFlags:
+			if flag not in flags:
+				logger.info('Sensor \"%s\" is no longer %s', name, flag)
+
+	def flagged(self):
+		'''
+		Names of sensors with at least one flag, with their flags
+		'''
+		return {name: m['flags'] for name, m in self.metrics.items() if m['flags']}
+
+	def stop(self):
+		self._stopper.set()
@@ -0,0 +1,168 @@
+'''
+In-memory history of filtered sensor events, so hits can be reviewed (and
+plotted) without digging through the logs.
+
+Events are kept in a fixed-capacity ring buffer stored as columns (one array
+per field) which keeps memory small and constant: about 14 bytes per event. Each
+event has a timestamp, pin, kind (eg motion, door opened), the state of the
+sensor's zone when it arrived and whether it caused that zone to transition.
+Kinds and states are stored as small integer codes into fixed vocabularies.
+
+Events are appended in time order (timestamps are clamped so they never go
+backwards), hence time range queries are a binary search over the ring.
+'''
+
+import math, clock
+from array import array
+from bisect import bisect_left, bisect_right
+from threading import Lock
+
+KINDS = ('motion', 'motionEnd', 'doorOpened', 'doorClosed', 'sound')
+
+# most buckets a heatmap may have per pin (a week in minutes is about 10000)
+MAX_BUCKETS = 20000
+
+def heatmapBuckets(start, end, bucket):
+	'''
+	Number of buckets of bucket seconds from start to end. Raises ValueError if
+	bucket is not positive or there would be more than MAX_BUCKETS
+	'''
+	if not bucket > 0:
+		raise ValueError('bucket must be positive, got {}'.format(bucket))
+	if not (math.isfinite(start) and math.isfinite(end)):
+		raise ValueError('start and end must be finite')
+	nBuckets = max(1, int((end - start) // bucket) + 1)
+	if nBuckets > MAX_BUCKETS:
+		raise ValueError('{} buckets of {} s from {} to {}, at most {} allowed'.format(
+			nBuckets, bucket, start, end, MAX_BUCKETS))
+	return nBuckets
+
+class _Times:
+	'''
+	Read-only view of the timestamps in logical (oldest first) order, for bisect
+	'''
+	def __init__(self, history):
+		self._h = history
+
+	def __len__(self):
+		return self._h._size
+
+	def __getitem__(self, i):
+		return self._h._times[self._h._index(i)]
+
+class SensorHistory:
+	'''
+	Ring buffer of the last capacity sensor events. States is the list of state
+	names that may be recorded
+	'''
+	def __init__(self, states, capacity=65536):
+		self._states = list(states)
+		self._capacity = capacity
+		self._times = array('d', [0]) * capacity
+		self._pins = array('H', [0]) * capacity
+		self._kinds = array('b', [0]) * capacity
+		self._stateCodes = array('b', [0]) * capacity
+		self._transitions = array('b', [0]) * capacity
+		self._start = 0
+		self._size = 0
+		self._lock = Lock()
+
+	def _index(self, i):
+		return (self._start + i) % self._capacity
+
+	def record(self, pin, kind, state, causedTransition=False, t=None):
+		t = clock.now() if t is None else t
+		with self._lock:
+			if self._size:
+				t = max(t, self._times[self._index(self._size - 1)])
+			if self._size < self._capacity:
+				i = self._index(self._size)
+				self._size += 1
+			else:
+				i = self._start
+				self._start = (self._start + 1) % self._capacity
+			self._times[i] = t
+			self._pins[i] = pin
+			self._kinds[i] = KINDS.index(kind)
+			self._stateCodes[i] = self._states.index(state)
+			self._transitions[i] = causedTransition
+
+	def __len__(self):
+		return self._size
+
+	def _range(self, start, end):
+		'''
+		Logical indices of events with start <= timestamp <= end (either may be
+		None for an open range). Call with the lock held
+		'''
+		times = _Times(self)
+		lo = 0 if start is None else bisect_left(times, start)
+		hi = self._size if end is None else bisect_right(times, end)
+		return range(lo, hi)
+
+	def query(self, start=None, end=None, pins=None, limit=None):
+		'''
+		Events between start and end (epoch seconds) as a list of dicts, oldest
+		first. Optionally restricted to pins and to the newest limit events
+		'''
+		with self._lock:
+			events = []
+			for n in self._range(start, end):
+				i = self._index(n)
+				if pins is not None and self._pins[i] not in pins:
+					continue
+				events.append({
+					'time': self._times[i],
+					'pin': self._pins[i],
+					'kind': KINDS[self._kinds[i]],
+					'state': self._states[self._stateCodes[i]],
+					'causedTransition': bool(self._transitions[i])
+				})
+		return events[-limit:] if limit else events
+
+	def aggregates(self, start=None, end=None):
+		'''
+		Per-pin totals between start and end: number of events by kind, number
+		that caused a transition, the time of the last one and the hit (motion
+		or door opened) rate per hour over the range
+		'''
+		with self._lock:
+			r = self._range(start, end)
+			if not r:
+				return {}
+			first = self._times[self._index(r[0])]
+			result = {}
+			for n in r:
+				i = self._index(n)
+				agg = result.get(self._pins[i])
+				if agg is None:
+					agg = result[self._pins[i]] = dict({k: 0 for k in KINDS}, transitions=0, last=None)
+				agg[KINDS[self._kinds[i]]] += 1
+				agg['transitions'] += self._transitions[i]
+				agg['last'] = self._times[i]
+
+		hours = ((end if end is not None else clock.now()) -
+			(start if start is not None else first)) / 3600
+		for agg in result.values():
+			hits = agg['motion'] + agg['doorOpened']
+			agg['hitsPerHour'] = hits / hours if hours > 0 else None
+		return result
+
+	def heatmap(self, start, end, bucket=3600):
+		'''
+		Per-pin hit counts in buckets of bucket seconds from start to end (see
+		heatmapBuckets for the limits)
+		'''
+		nBuckets = heatmapBuckets(start, end, bucket)
+		hitKinds = (KINDS.index('motion'), KINDS.index('doorOpened'))
+		result = {}
+		with self._lock:
+			for n in self._range(start, end):
+				i = self._index(n)
+				if self._kinds[i] not in hitKinds:
+					continue
+				counts = result.get(self._pins[i])
+				if counts is None:
+					counts = result[self._pins[i]] = array('L', [0]) * nBuckets
+				counts[int((self._times[i] - start) // bucket)] += 1
+		return {pin: counts.tolist() for pin, counts in result.items()}
@@ -0,0 +1,82 @@
+'''
+Notification of devices (dis)appearing under /dev, using inotify through libc
+directly (no extra dependencies). Watches are added for a number of directories
+and the callback is called (on the input reactor thread) whenever an entry in
+any of them is created, deleted or moved. This is coarse on purpose; the
+callback is expected to check whatever it cares about itself.
+'''
+
+import os, ctypes, ctypes.util, struct, logging
+
+logger = logging.getLogger(__name__)
+
+# from sys/inotify.h
+_IN_CREATE = 0x100
+_IN_DELETE = 0x200
+_IN_MOVED_FROM = 0x40
+_IN_MOVED_TO = 0x80
+_IN_ATTRIB = 0x4
+_IN_IGNORED = 0x8000
+_IN_NONBLOCK = os.O_NONBLOCK
+_IN_CLOEXEC = os.O_CLOEXEC
+
+_MASK = _IN_CREATE | _IN_DELETE | _IN_MOVED_FROM | _IN_MOVED_TO | _IN_ATTRIB
+
+# struct inotify_event, followed by len bytes of name
+_EVENT = struct.Struct('=iIII')
+
+_libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+
+class DirectoryWatcher:
+	'''
+	Calls callback() whenever something changes in one of paths. Paths that
+	do not exist yet (eg /dev/input/by-id with nothing plugged in) are watched
+	once they appear, provided their parent is also being watched
+	'''
+	def __init__(self, paths, callback, reactor, name='hotplug'):
+		self._paths = paths
+		self._callback = callback
+		self._reactor = reactor
+		self._name = name
+		self._fd = None
+		self._watched = {}
+
+	def start(self):
+		self._fd = _libc.inotify_init1(_IN_NONBLOCK | _IN_CLOEXEC)
+		if self._fd < 0:
+			raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+		self._addWatches()
+		self._reactor.register(self._fd, self._read, self._name)
+
+	def stop(self):
+		if self._fd is not None:
+			self._reactor.unregister(self._fd)
+			os.close(self._fd)
+			self._fd = None
+			self._watched.clear()
+
+	def _addWatches(self):
+		for path in self._paths:
+			if path not in self._watched.values() and os.path.isdir(path):
+				wd = _libc.inotify_add_watch(self._fd, path.encode(), _MASK)
+				if wd < 0:
+					logger.error('Cannot watch %s: %s', path, os.strerror(ctypes.get_errno()))
+				else:
+					self._watched[wd] = path
+					logger.debug('Watching %s for hotplug', path)
+
+	def _read(self):
+		try:
+			while 1:
+				data = os.read(self._fd, 4096)
+				offset = 0
+				while offset < len(data):
+					wd, mask, cookie, length = _EVENT.unpack_from(data, offset)
+					offset += _EVENT.size + length
+					# the directory itself was removed
+					if mask & _IN_IGNORED:
+						self._watched.pop(wd, None)
+		except BlockingIOError:
+			pass
+		self._addWatches()
+		self._callback()
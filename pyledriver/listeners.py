@@ -1,13 +1,13 @@
 '''
-Classes that listen for user input
+Classes that listen for user input. None of these have threads of their own;
+they are input sources for the input reactor (see reactor.py)
 '''
 
-import logging, os, sys, stat
-from threading import Timer
-from exceptionThreading import ExceptionThread
+import logging, os
+from threading import Timer, Lock
 from evdev import InputDevice, ecodes
-from select import select
-from auxilary import waitForPath
+from hotplug import DirectoryWatcher
+from profiling import markOrigin
 import stateMachine
 
 logger = logging.getLogger(__name__)
@@ -19,11 +19,18 @@ class KeypadListener:
 	- volume control
 	- arm/disarm the stateMachine
 	
-	This launches two daemon threads:
-	- input listener that accepts events and reacts in fun ways
-	- countdown timer to reset the input buffer after 30 seconds of inactivity
+	Key events are read by the input reactor, which calls the listener whenever
+	the device is readable. A countdown timer resets the input buffer after 30
+	seconds of inactivity
+
+	The keypad is attached whenever it shows up (watching /dev/input) so it
+	need not be plugged in on startup and may be unplugged and replugged at
+	any time. The input buffer survives this and the LED is restored
 	'''
-	def __init__(self, stateMachine, passwd):
+	_devPath = '/dev/input/by-id/usb-04d9_1203-event-kbd'
+	
+	def __init__(self, stateMachine, passwd, reactor):
+		self._reactor = reactor
 
 		ctrlKeys = { 69: 'NUML', 98: '/', 55: '*', 14: 'BS', 96: 'ENTER'}
 		
@@ -58,82 +65,91 @@ class KeypadListener:
 				wrongPassSound.play()
 				
 		def getInput():
-			while 1:
-				select([self._dev], [], [])
-				for event in self._dev.read():
-					if event.type == 1 and event.value == 1:
-						
-						# numeral input
-						if event.code in numKeys:
-							self._buf = self._buf + numKeys[event.code]
-							self._startResetTimer()
-							numKeySound.play()
+			try:
+				events = list(self._dev.read())
+			except BlockingIOError:
+				# woken up with nothing to read, the device is still there
+				return
+			except OSError as e:
+				self._detach(e)
+				return
+			for event in events:
+				if event.type == 1 and event.value == 1:
+					markOrigin('keypad')
+					
+					# numeral input
+					if event.code in numKeys:
+						self._buf = self._buf + numKeys[event.code]
+						self._startResetTimer()
+						numKeySound.play()
 
-						# ctrl input
-						elif event.code in ctrlKeys:
-							val = ctrlKeys[event.code]
-							
-							# disarm if correct passwd
-							if val=='ENTER':
-								if stateMachine.currentState == stateMachine.states.disarmed:
-									ctrlKeySound.play()
-								else:
-									checkPasswd(stateMachine.DISARM)
+					# ctrl input
+					elif event.code in ctrlKeys:
+						val = ctrlKeys[event.code]
+						
+						# disarm if correct passwd
+						if val=='ENTER':
+							if stateMachine.currentState == stateMachine.states.disarmed:
+								ctrlKeySound.play()
+							else:
+								checkPasswd(stateMachine.DISARM)
 
-							# lock
-							elif val == 'NUML':
-								checkPasswd(stateMachine.LOCK)
+						# lock
+						elif val == 'NUML':
+							checkPasswd(stateMachine.LOCK)
 
-							# instant lock
-							elif val == '/':
-								checkPasswd(stateMachine.INSTANT_LOCK)
-								
-							# arm
-							elif val == '*':
-								checkPasswd(stateMachine.ARM)
-								
-							# delete last char in buffer
-							elif val == 'BS':
-								self._buf = self._buf[:-1]
-								if self._buf == '':
-									self._stopResetTimer()
-								else:
-									self._startResetTimer()
-								backspaceSound.play()
+						# instant lock
+						elif val == '/':
+							checkPasswd(stateMachine.INSTANT_LOCK)
+							
+						# arm
+						elif val == '*':
+							checkPasswd(stateMachine.ARM)
+							
+						# delete last char in buffer
+						elif val == 'BS':
+							self._buf = self._buf[:-1]
+							if self._buf == '':
+								self._stopResetTimer()
+							else:
+								self._startResetTimer()
+							backspaceSound.play()
+						
+					# volume input
+					elif event.code in volKeys:
+						val = volKeys[event.code]
+							
+						if val == '+':
+							soundLib.changeVolume(10)
 							
-						# volume input
-						elif event.code in volKeys:
-							val = volKeys[event.code]
-								
-							if val == '+':
-								soundLib.changeVolume(10)
-								
-							elif val == '-':
-								soundLib.changeVolume(-10)
-								
-							elif val == '.':
-								soundLib.mute()
+						elif val == '-':
+							soundLib.changeVolume(-10)
+							
+						elif val == '.':
+							soundLib.mute()
 
-							ctrlKeySound.play()
-							self._setLED()
+						ctrlKeySound.play()
+						self._setLED()
 		
-		self._listener = ExceptionThread(target=getInput, daemon=True)
+		self._getInput = getInput
+		self._dev = None
+		self._attachLock = Lock()
 		self._clearBuffer()
-		
-	def start(self):
-		devPath = '/dev/input/by-id/usb-04d9_1203-event-kbd'
-		
-		waitForPath(devPath, logger)
 
-		self._dev = InputDevice(devPath)
-		self._dev.grab()
-		self._setLED()
+		devDir = os.path.dirname(self._devPath)
+		self._watcher = DirectoryWatcher([os.path.dirname(devDir), devDir], self._attach,
+			reactor, 'keypad.hotplug')
 		
-		self._listener.start()
-		logger.debug('Started keypad listener')
+	def start(self):
+		self._watcher.start()
+		self._attach()
+		if not self._dev:
+			logger.warning('Keypad not found at %s, waiting for it to be plugged in', self._devPath)
 		
 	def stop(self):
+		self._watcher.stop()
 		try:
+			self._reactor.unregister(self._dev)
 			self._dev.ungrab()
 			self._dev = None
 			logger.debug('Released keypad device')
@@ -141,6 +157,33 @@ class KeypadListener:
 			logger.error('Failed to release keypad device')
 		except AttributeError:
 			pass
+
+	def _attach(self):
+		with self._attachLock:
+			if self._dev or not os.path.exists(self._devPath):
+				return
+			try:
+				dev = InputDevice(self._devPath)
+				dev.grab()
+			except OSError as e:
+				# udev may not be done setting up the node; we will hear about it again
+				logger.debug('Keypad not ready: %s', e)
+				return
+			self._dev = dev
+			self._setLED()
+			self._reactor.register(self._dev, self._getInput, 'keypad')
+			logger.info('Attached keypad at %s', self._devPath)
+
+	def _detach(self, error):
+		logger.warning('Lost keypad: %s', error)
+		self._reactor.unregister(self._dev)
+		try:
+			self._dev.close()
+		except OSError:
+			pass
+		self._dev = None
+		# it may have come back already
+		self._attach()
 		
 	def resetBuffer(self):
 		self._stopResetTimer()
@@ -161,53 +204,8 @@ class KeypadListener:
 		self._buf = ''
 		
 	def _setLED(self):
-		self._dev.set_led(ecodes.LED_NUML, 0 if self._soundLib.volume > 0 else 1)
+		if self._dev:
+			self._dev.set_led(ecodes.LED_NUML, 0 if self._soundLib.volume > 0 else 1)
 		
 	def __del__(self):
 		self.stop()
-			
-class PipeListener(ExceptionThread):
-	'''
-	Creates a pipe in the /tmp directory and listens for input. Primarily
-	meant as a receiver for ssh sessions to echo messages to the stateMachine
-	(aka secrets) that trigger a signal
-	'''
-	def __init__(self, callback, name):
-		self._path = os.path.join('/tmp', name)
-
-		pipeMode = 0o0777
-		
-		if not os.path.exists(self._path):
-			os.mkfifo(self._path)
-			os.chmod(self._path, pipeMode)
-		else:
-			st_mode = os.stat(self._path).st_mode
-			if not stat.S_ISFIFO(st_mode):
-				os.remove(self._path)
-				os.mkfifo(self._path)
-				os.chmod(self._path, pipeMode)
-			elif st_mode % 0o10000 != pipeMode:
-				os.chmod(self._path, pipeMode)
-		
-		def listen():
-			while 1:
-				with open(self._path, 'r') as f:
-					msg = f.readline()[:-1]
-					callback(msg, logger)
-		
-		super().__init__(target=listen, daemon=True)
-		
-	def start(self):
-		ExceptionThread.start(self)
-		logger.debug('Started pipe listener at path %s', self._path)
-		
-	def stop(self):
-		try:
-			os.remove(self._path)
-			logger.debug('Cleaned up pipe listener at path %s', self._path)
-		except FileNotFoundError:
-			pass
-
-	def __del__(self):
-		self.stop()
-
@@ -0,0 +1,115 @@
+'''
+Benchmark of the CPU spent encoding camera audio, with and without the silence
+gate (see SilenceGate in audioLevel.py). A recording is run through the same
+elements as the audio branch of the camera, minus the microphone and network:
+
+	filesrc ! wavparse ! audioconvert ! audioresample ! level ! opusenc ! rtpopuspay ! fakesink
+
+as fast as possible, and the CPU time of the whole process is measured, eg:
+
+	python opusBench.py [RECORDING.wav]
+
+The recording should be representative of the room (mostly silence with the
+occasional noise). Without one, a minute of synthetic room tone with a few
+loud bursts is used.
+
+The gate is driven from the streaming thread (via sync bus messages) so that
+it switches exactly where it would live rather than lagging behind a pipeline
+that runs many times faster than real time. Also reported are the number of
+RTP packets, which must be the same for both runs (the timeline is unchanged),
+and the bytes sent.
+'''
+
+import os, sys, time, wave, tempfile
+
+import gi
+gi.require_version('Gst', '1.0')
+from gi.repository import Gst
+
+from audioLevel import SilenceGate
+
+_INTERVAL = 0.05
+
+def _synthesize(path, seconds=60, rate=48000):
+	import numpy
+	rng = numpy.random.default_rng(0)
+	samples = rng.normal(0, 0.001, seconds * rate)
+	for start in (10, 31, 47):
+		burst = slice(start * rate, (start + 2) * rate)
+		samples[burst] += rng.normal(0, 0.1, 2 * rate)
+	with wave.open(path, 'wb') as w:
+		w.setnchannels(1)
+		w.setsampwidth(2)
+		w.setframerate(rate)
+		w.writeframes((numpy.clip(samples, -1, 1) * 32767).astype('<i2').tobytes())
+
+def _bench(path, gated):
+	pipeline = Gst.parse_launch(
+		'filesrc location="{}" ! wavparse ! audioconvert ! audioresample '
+		'! audio/x-raw,rate=48000,channels=1 ! level name=level interval={} '
+		'! opusenc name=encoder ! rtpopuspay ! fakesink name=sink sync=false signal-handoffs=true'
+		.format(path, int(_INTERVAL * Gst.SECOND)))
+
+	result = {'packets': 0, 'bytes': 0}
+	def handoff(sink, buffer, pad):
+		result['packets'] += 1
+		result['bytes'] += buffer.get_size()
+	pipeline.get_by_name('sink').connect('handoff', handoff)
+
+	gate = None
+	bus = pipeline.get_bus()
+	if gated:
+		gate = SilenceGate(pipeline.get_by_name('encoder'), _INTERVAL)
+		def onMessage(bus, msg):
+			structure = msg.get_structure()
+			if structure and structure.get_name() == 'level':
+				gate.feed(max(structure.get_value('rms')), max(structure.get_value('peak')))
+		bus.enable_sync_message_emission()
+		bus.connect('sync-message::element', onMessage)
+
+	cpu = time.process_time()
+	pipeline.set_state(Gst.State.PLAYING)
+	msg = bus.timed_pop_filtered(Gst.CLOCK_TIME_NONE, Gst.MessageType.EOS | Gst.MessageType.ERROR)
+	result['cpu'] = time.process_time() - cpu
+	pipeline.set_state(Gst.State.NULL)
+
+	if msg.type == Gst.MessageType.ERROR:
+		raise RuntimeError(msg.parse_error()[0].message)
+	if gate:
+		result.update(gate.stats())
+	return result
+
+def main(argv):
+	Gst.init(None)
+	synthetic = len(argv) < 2
+	if synthetic:
+		fd, path = tempfile.mkstemp(suffix='.wav', prefix='pyledriver-room-')
+		os.close(fd)
+		_synthesize(path)
+	else:
+		path = argv[1]
+
+	try:
+		with wave.open(path) as w:
+			seconds = w.getnframes() / w.getframerate()
+		print('{} ({:.0f} s of audio)'.format('synthetic room tone' if synthetic else path, seconds))
+
+		results = {}
+		for description, gated in (('always on', False), ('gated', True)):
+			r = results[description] = _bench(path, gated)
+			print('{:<10} cpu {:7.3f} s ({:5.2f}% of real time)   {} packets, {} bytes'.format(
+				description, r['cpu'], 100 * r['cpu'] / seconds, r['packets'], r['bytes']))
+			if gated:
+				print('           silent {:.0f} s, active {:.0f} s, {} switches'.format(
+					r['silentSeconds'], r['activeSeconds'], r['switches']))
+
+		on, gated = results['always on'], results['gated']
+		print('saved {:.1f}% cpu, {:.1f}% bytes'.format(
+			100 * (1 - gated['cpu'] / on['cpu']), 100 * (1 - gated['bytes'] / on['bytes'])))
+	finally:
+		if synthetic:
+			os.remove(path)
+	return 0
+
+if __name__ == '__main__':
+	sys.exit(main(sys.argv))
@@ -0,0 +1,105 @@
+'''
+Lightweight instrumentation of the signal path, from where a signal originates
+(GPIO callback, keypad event, pipe read, countdown timer) through the state
+machine (lock acquisition, next, exit and entry callbacks).
+
+The origin of a signal is recorded in a thread-local with markOrigin. Since
+signals are delivered synchronously on the thread they originate from, the state
+machine can pick this up with getOrigin without having to thread timestamps
+through every call.
+
+Timings are kept in histograms with fixed-size arrays of log2-spaced buckets
+(1us, 2us, 4us...), so memory does not grow no matter how long we run. Updates
+take no lock so they never hold up the hot path; the price is that concurrent
+updates to the same histogram may very rarely lose a count.
+'''
+
+import time, yaml, threading
+from array import array
+
+_local = threading.local()
+
+def markOrigin(kind, t=None):
+	'''
+	Mark the current time (or t, as given by time.perf_counter) as the origin of
+	any signal subsequently sent from this thread. Kind is a short description
+	(eg 'gpio', 'keypad')
+	'''
+	_local.origin = (kind, time.perf_counter() if t is None else t)
+
+def getOrigin():
+	return getattr(_local, 'origin', None)
+
+class Histogram:
+	'''
+	Histogram of durations (in seconds). Bucket i holds durations less than
+	2^i microseconds (the last bucket holds everything else)
+	'''
+	_nBuckets = 32
+
+	def __init__(self):
+		self._buckets = array('L', [0] * self._nBuckets)
+		self.count = 0
+		self.total = 0
+		self.max = 0
+
+	def record(self, seconds):
+		us = int(seconds * 1e6)
+		self._buckets[min(us.bit_length(), self._nBuckets - 1)] += 1
+		self.count += 1
+		self.total += seconds
+		if seconds > self.max:
+			self.max = seconds
+
+	def percentile(self, p):
+		'''
+		Upper bound (in seconds) of the bucket containing the pth percentile
+		'''
+		if not self.count:
+			return None
+		target = self.count * p / 100
+		n = 0
+		for i, c in enumerate(self._buckets):
+			n += c
+			if n >= target:
+				return (1 << i) / 1e6
+		return self.max
+
+	def summary(self):
+		return {
+			'count': self.count,
+			'mean': self.total / self.count if self.count else None,
+			'p50': self.percentile(50),
+			'p99': self.percentile(99),
+			'max': self.max,
+			'buckets': self._buckets.tolist()
+		}
+
+class Profiler:
+	'''
+	Collection of histograms keyed by name, created on first use
+	'''
+	def __init__(self):
+		self._histograms = {}
+		self._lock = threading.Lock()
+
+	def record(self, name, seconds):
+		try:
+			h = self._histograms[name]
+		except KeyError:
+			with self._lock:
+				h = self._histograms.setdefault(name, Histogram())
+		h.record(seconds)
+
+	def summary(self):
+		return {name: h.summary() for name, h in sorted(self._histograms.items())}
+
+	def dump(self, path):
+		with open(path, 'w') as f:
+			yaml.safe_dump(self.summary(), f, default_flow_style=False)
+
+	def reset(self):
+		with self._lock:
+			self._histograms = {}
+
+profiler = Profiler()
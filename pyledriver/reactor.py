@@ -0,0 +1,82 @@
+'''
+Single thread that waits on every input source (keypad, control channels,
+hotplug notifications...) with one selector (epoll on linux) and dispatches to
+the handler registered for each. Adding an input source therefore costs a file
+descriptor rather than a thread.
+
+Handlers are called on the reactor thread whenever their file is readable and
+must not block, since that holds up every other input. The time spent in each
+handler is recorded in the profiler under 'reactor.<name>'.
+'''
+
+import os, selectors, logging, time
+from threading import Event
+from exceptionThreading import ExceptionThread
+from profiling import profiler
+
+logger = logging.getLogger(__name__)
+
+class InputReactor(ExceptionThread):
+	'''
+	Sources are added with register and may be added or removed at any time,
+	including from within a handler
+	'''
+	def __init__(self):
+		self._selector = selectors.DefaultSelector()
+		self._stopper = Event()
+
+		# written to in order to wake the selector (eg to stop)
+		self._wakeR, self._wakeW = os.pipe()
+		os.set_blocking(self._wakeR, False)
+		os.set_blocking(self._wakeW, False)
+		self._selector.register(self._wakeR, selectors.EVENT_READ, None)
+
+		super().__init__(target=self._run, daemon=True)
+
+	def register(self, fileobj, handler, name):
+		'''
+		Call handler() whenever fileobj (a file descriptor or anything with a
+		fileno method) is readable
+		'''
+		self._selector.register(fileobj, selectors.EVENT_READ, (name, handler))
+		self._wake()
+		logger.debug('Registered input source: %s', name)
+
+	def unregister(self, fileobj):
+		try:
+			name, _ = self._selector.unregister(fileobj).data
+			logger.debug('Unregistered input source: %s', name)
+		except (KeyError, ValueError):
+			pass
+		self._wake()
+
+	def start(self):
+		ExceptionThread.start(self)
+		logger.debug('Started input reactor')
+
+	def stop(self):
+		self._stopper.set()
+		self._wake()
+
+	def _wake(self):
+		try:
+			os.write(self._wakeW, b'\0')
+		except BlockingIOError:
+			pass # already pending
+
+	def _run(self):
+		while not self._stopper.is_set():
+			for key, mask in self._selector.select():
+				if key.data is None:
+					os.read(self._wakeR, 4096)
+					continue
+
+				name, handler = key.data
+
+				# an earlier handler in this batch may have removed this source
+				if self._selector.get_map().get(key.fileobj) is not key:
+					continue
+
+				start = time.perf_counter()
+				handler()
+				profiler.record('reactor.' + name, time.perf_counter() - start)
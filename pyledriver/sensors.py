@@ -1,10 +1,14 @@
 '''
-IR and magnetic sensors
+IR and magnetic sensors. All edges are filtered through the debounce engine
+(see debounce.py) which passes on stable level changes only. Edges come from
+RPi.GPIO unless a gpio chip is configured, in which case the character device
+backend is used (see gpiochip.py)
 '''
-import RPi.GPIO as GPIO
-import logging, time
+import logging, clock
 from functools import partial
-from threading import Timer
+from config import configFile
+from debounce import DebounceEngine
+from gpiochip import GpioChipBackend
 
 logger = logging.getLogger(__name__)
 
@@ -13,55 +17,148 @@ logger = logging.getLogger(__name__)
 # "sensitive states" (armed, trippedCountdown, tripped)
 logger.setLevel(logging.INFO)
 
-# delay GPIO init to avoid false positive during powerup
-INIT_DELAY = 60
+# IR sensors give false positives while warming up after power on. A sensor is
+# considered warmed up once its line has been low and quiet for the stable
+# window, or after the max time regardless (config sensorWarmup)
+WARMUP_STABLE = 10
+WARMUP_MAX = 60
 
-def _lowPassFilter(pin, targetVal, period=0.001):
+# warm-up status and last signal of each sensor, keyed by name. This is what
+# gets saved in the crash recovery snapshot
+sensorStatus = {}
+
+# status recovered from the last snapshot (if any)
+_restoredStatus = {}
+
+def getSensorStatus():
+	return {name: dict(status) for name, status in sensorStatus.items()}
+
+def restoreSensorStatus(status):
 	'''
-	Crude implementation of an LPF for a binary signal. This exists to filter
-	out voltage spikes that are induced by mains current fuctuations.
-	
-	Basically uses a timed loop to determine if a pin is changing within a
-	given period. If a change occurs within period, this is considered 'high
-	frequency' and the function returns False. If not, the pin is evaluated with
-	a target value, which returns a boolean	result that can be used elsewhere
+	Load sensor status from a snapshot taken during this boot. Sensors that were
+	ready at the time of the snapshot have been powered on ever since, so they
+	will skip the warm-up
 	'''
-	divisions = 10
-	sleepTime = period/divisions
-	
-	for i in range(0, divisions):
-		time.sleep(sleepTime)
-		if GPIO.input(pin) != targetVal:
-			return False
+	_restoredStatus.update(status)
+
+def isSensorReady(pin):
+	return any(s['ready'] for s in sensorStatus.values() if s['pin'] == pin)
+
+def _makeBackend():
+	path = configFile.get('gpiochip')
+	if path:
+		logger.debug('Using gpio chip %s for sensors', path)
+		return GpioChipBackend(path)
 
-	return GPIO.input(pin) == targetVal
+# all sensors share one debounce engine (and thus one filter thread), which
+# also takes care of delayed init
+_debounce = DebounceEngine(_makeBackend())
 
-def _initGPIO(name, pin, GPIOEvent, callback):
+def readSensor(pin):
+	return _debounce.read(pin)
+
+def scheduleSensorTask(delay, fn):
+	'''
+	Call fn after delay seconds on the debounce engine's worker thread. fn must
+	return promptly as it holds up edge filtering
+	'''
+	_debounce.schedule(delay, fn)
+
+def getSensorCounters(pin):
+	return _debounce.counters(pin)
+
+def getFilterStats():
+	return {name: _debounce.stats().get(status['pin']) for name, status in sensorStatus.items()}
+
+def _initGPIO(name, pin, callback, profile):
 	logger.debug('starting \"%s\" on pin %s', name, pin)
-	GPIO.setup(pin, GPIO.IN, pull_up_down=GPIO.PUD_DOWN)
-	GPIO.add_event_detect(pin, GPIOEvent, callback=callback, bouncetime=500)
+	_debounce.register(pin, callback, profile)
+
+def _setReady(name, warmup=None):
+	status = sensorStatus[name]
+	status['ready'] = True
+	status['warmup'] = warmup
 
-def startMotionSensor(pin, location, action):
+def _checkWarmup(name, pin, started, stable, maxTime):
+	'''
+	Runs on the debounce worker until the sensor is ready, rescheduling itself
+	for when the line could next have been quiet long enough
+	'''
+	now = clock.monotonic()
+	lastEdge = _debounce.lastEdgeTime(pin)
+	quiet = now - max(started, lastEdge or started)
+
+	if quiet >= stable and not _debounce.read(pin):
+		logger.info('%s ready after %.1fs warm-up', name, now - started)
+		_setReady(name, now - started)
+	elif now - started >= maxTime:
+		logger.warning('%s not stable after %ss warm-up, enabling anyway', name, maxTime)
+		_setReady(name, now - started)
+	else:
+		delay = min(stable - quiet if quiet < stable else stable, started + maxTime - now)
+		_debounce.schedule(delay, partial(_checkWarmup, name, pin, started, stable, maxTime))
+
+def _recordSignal(name, value):
+	status = sensorStatus[name]
+	status['lastSignal'] = clock.now()
+	status['value'] = value
+
+def startMotionSensor(pin, location, action, profile=None, release=None):
+	'''
+	Calls action when motion starts and (optionally) release when it stops,
+	both as fn(location, logger)
+	'''
 	name = 'MotionSensor@' + location
+	sensorStatus[name] = {'pin': pin, 'ready': False, 'warmup': None, 'lastSignal': None, 'value': None}
 
-	def trip(channel):
-		if _lowPassFilter(pin, 1):
+	# the line is watched during warm-up (to see when it settles) but nothing
+	# is passed on until the sensor is ready
+	def trip(pin, level):
+		if not sensorStatus[name]['ready']:
+			return
+		if level:
+			_recordSignal(name, 1)
 			action(location, logger)
+		else:
+			status = sensorStatus[name]
+			status['value'] = 0
+			if release:
+				release(location, logger)
 	
-	logger.debug('waiting %s for %s to power on', INIT_DELAY, name)
-	t = Timer(INIT_DELAY, partial(_initGPIO, name, pin, GPIO.RISING, trip))
-	t.daemon = True
-	t.start()
-
-def startDoorSensor(pin, action):
-	def trip(channel):
-		nonlocal closed
-		val = GPIO.input(pin)
-		
-		if val != closed:
-			if _lowPassFilter(pin, val):
-				closed = val
-				action(closed, logger)
+	_initGPIO(name, pin, trip, profile)
+
+	if _restoredStatus.get(name, {}).get('ready'):
+		logger.debug('%s already powered on, skipping warm-up', name)
+		_setReady(name)
+	else:
+		warmup = configFile.get('sensorWarmup') or {}
+		stable = warmup.get('stable', WARMUP_STABLE)
+		maxTime = warmup.get('max', WARMUP_MAX)
+		logger.debug('waiting up to %ss for %s to warm up', maxTime, name)
+		_debounce.schedule(min(stable, maxTime),
+			partial(_checkWarmup, name, pin, clock.monotonic(), stable, maxTime))
+
+def startDoorSensor(pin, location, action, profile=None):
+	'''
+	Start watching a door. If the door changed while we were down (eg crashed)
+	this returns a function that acts on the change, to be called once the
+	states have been entered; otherwise None
+	'''
+	name = 'DoorSensor@' + location
+	sensorStatus[name] = {'pin': pin, 'ready': False, 'warmup': None, 'lastSignal': None, 'value': None}
+
+	def trip(pin, closed):
+		_recordSignal(name, closed)
+		action(closed, logger)
 	
-	_initGPIO('DoorSensor', pin, GPIO.BOTH, trip)
-	closed = GPIO.input(pin)
+	_initGPIO(name, pin, trip, profile)
+	_setReady(name)
+	closed = _debounce.level(pin)
+	sensorStatus[name]['value'] = closed
+
+	lastClosed = _restoredStatus.get(name, {}).get('value')
+	if lastClosed is not None and lastClosed != closed:
+		def replay():
+			_recordSignal(name, closed)
+			action(closed, logger)
+		return replay
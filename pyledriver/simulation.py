@@ -0,0 +1,754 @@
+'''
+Simulation harness for the state machine. Replaces all hardware (RPi.GPIO,
+evdev, pygame.mixer, gstreamer pipelines) and anything that talks to the outside
+world (email, web interface) with fakes, and swaps the shared clock for a
+virtual clock. This allows the StateMachine to run on any linux box, either
+interactively:
+
+	with Simulation() as sim:
+		sim.signal('INSTANT_ARM')
+		sim.motion(5)
+		sim.assertState('trippedCountdown')
+		sim.advance(30)
+		sim.assertState('tripped')
+
+or by replaying a trace (a yaml list of timestamped events) at accelerated
+speed:
+
+	python simulation.py trace.yaml
+
+Each trace entry has a time 't' (seconds since start) and exactly one of:
+- pin/value: set a GPIO input (eg {t: 1, pin: 22, value: 0})
+- motion: pulse an IR sensor pin high for 'hold' seconds (default 1)
+- level: one window of microphone levels [rms, peak] in dBFS, fed to the
+  audio sensor (if one is configured)
+- key: press a keypad key (evdev keycode, or list of keycodes)
+- secret: send a secret through the control socket
+- signal: send a signal directly to the state machine (eg ARM)
+- expect: assert the current state name
+
+Signals and expectations apply to the whole house unless a 'zone' is given.
+
+The report gives the number of events per second (real time) and the latency
+of each transition, measured from the injection of the event that caused it
+(in real time, countdown timeouts excluded).
+
+Note the fakes must be installed before any pyledriver module that imports
+hardware libraries is imported; Simulation takes care of this. It imports the
+pyledriver modules afresh on every start, so any number of simulations (eg the
+tests) can run one after the other in the same process.
+'''
+
+import os, sys, math, time, types, queue, shutil, tempfile, logging, statistics
+from collections import namedtuple, deque
+from threading import Thread, Lock
+
+import clock
+
+logger = logging.getLogger(__name__)
+
+_PKG_DIR = os.path.dirname(os.path.realpath(__file__))
+
+class SimulationError(Exception):
+	pass
+
+class FakeGPIO(types.ModuleType):
+	'''
+	Stand-in for RPi.GPIO. Edge callbacks are dispatched serially from one
+	thread, just like the real library
+	'''
+	BCM = 11
+	BOARD = 10
+	IN = 1
+	OUT = 0
+	PUD_OFF = 20
+	PUD_DOWN = 21
+	PUD_UP = 22
+	RISING = 31
+	FALLING = 32
+	BOTH = 33
+
+	def __init__(self):
+		super().__init__('RPi.GPIO')
+		self._levels = {}
+		self._detect = {}
+		self._callbacks = queue.Queue()
+		self.chipLines = {}
+
+		def dispatch():
+			while 1:
+				callback, pin = self._callbacks.get()
+				try:
+					callback(pin)
+				finally:
+					self._callbacks.task_done()
+
+		Thread(target=dispatch, daemon=True).start()
+
+	def setwarnings(self, flag):
+		pass
+
+	def setmode(self, mode):
+		pass
+
+	def cleanup(self):
+		self._detect.clear()
+
+	def setup(self, pin, direction, pull_up_down=None, initial=0):
+		self._levels.setdefault(pin, 0 if pull_up_down != self.PUD_UP else 1)
+
+	def input(self, pin):
+		try:
+			return self._levels[pin]
+		except KeyError:
+			raise RuntimeError('You must setup() the GPIO channel first')
+
+	def output(self, pin, value):
+		self._levels[pin] = value
+
+	def add_event_detect(self, pin, edge, callback=None, bouncetime=None):
+		self._detect[pin] = (edge, callback)
+
+	def remove_event_detect(self, pin):
+		self._detect.pop(pin, None)
+
+	def PWM(self, pin, frequency):
+		return _FakePWM(pin, frequency)
+
+	def setLevel(self, pin, value):
+		'''
+		Drive an input pin to value, firing any matching edge callbacks (or
+		events on the fake gpio chip line)
+		'''
+		old = self._levels.get(pin, 0)
+		self._levels[pin] = value
+		if pin in self.chipLines and old != value:
+			self.chipLines[pin].inject(value)
+		if pin in self._detect and old != value:
+			edge, callback = self._detect[pin]
+			if edge == self.BOTH or edge == (self.RISING if value else self.FALLING):
+				self._callbacks.put((callback, pin))
+
+	def isDetecting(self, pin):
+		return pin in self._detect
+
+	def pending(self):
+		return self._callbacks.unfinished_tasks
+
+class _FakePWM:
+	def __init__(self, pin, frequency):
+		self.pin = pin
+		self.dutyCycle = 0
+
+	def start(self, dutyCycle):
+		self.dutyCycle = dutyCycle
+
+	def ChangeDutyCycle(self, dutyCycle):
+		self.dutyCycle = dutyCycle
+
+	def stop(self):
+		pass
+
+class _FakeChipLine:
+	'''
+	Stand-in for a gpiochip.ChipLine. Edge events are written to a real pipe in
+	the same format the kernel uses, so the backend's reactor is exercised
+	'''
+	def __init__(self, gpio, offset):
+		import gpiochip
+		self._event = gpiochip.EVENT
+		self._gpio = gpio
+		self.offset = offset
+		self.fd, self._w = os.pipe()
+		gpio.setup(offset, gpio.IN)
+		gpio.chipLines[offset] = self
+
+	def value(self):
+		return self._gpio.input(self.offset)
+
+	def inject(self, value):
+		os.write(self._w, self._event.pack(time.monotonic_ns(), 1 if value else 2))
+
+	def close(self):
+		os.close(self.fd)
+		os.close(self._w)
+
+InputEvent = namedtuple('InputEvent', ['type', 'code', 'value'])
+
+class _FakeInputDevice:
+	'''
+	Stand-in for evdev.InputDevice. A real pipe backs fileno so select works
+	'''
+	def __init__(self, path):
+		self.path = path
+		self.leds = {}
+		self.unplugged = False
+		self._events = deque()
+		self._r, self._w = os.pipe()
+		_fakeEvdev.devices.append(self)
+
+	def fileno(self):
+		return self._r
+
+	def read(self):
+		os.read(self._r, 4096)
+		if self.unplugged:
+			raise OSError(19, 'No such device')
+		while self._events:
+			yield self._events.popleft()
+
+	def grab(self):
+		pass
+
+	def ungrab(self):
+		pass
+
+	def set_led(self, led, value):
+		self.leds[led] = value
+
+	def close(self):
+		os.close(self._r)
+		os.close(self._w)
+
+	def unplug(self):
+		self.unplugged = True
+		os.write(self._w, b'\0')
+
+	def inject(self, code):
+		self._events.append(InputEvent(1, code, 1))
+		self._events.append(InputEvent(1, code, 0))
+		os.write(self._w, b'\0')
+
+_fakeEvdev = types.ModuleType('evdev')
+_fakeEvdev.InputDevice = _FakeInputDevice
+_fakeEvdev.ecodes = types.SimpleNamespace(EV_KEY=1, LED_NUML=0)
+_fakeEvdev.devices = []
+
+class _FakeChannel:
+	'''
+	Stand-in for pygame.mixer.Channel. A sound is busy for its length (times
+	the number of plays) on the shared clock
+	'''
+	def __init__(self, id):
+		self.id = id
+		self.sound = None
+		self.volume = 1.0
+		self._end = None
+
+	def play(self, sound, loops=0, maxtime=0, fade_ms=0):
+		self.sound = sound
+		self._end = math.inf if loops < 0 else clock.monotonic() + sound.get_length() * (loops + 1)
+		_fakeMixer.played.append(sound)
+
+	def stop(self):
+		self.sound = None
+
+	def fadeout(self, time):
+		self.sound = None
+
+	def get_busy(self):
+		return self.sound is not None and clock.monotonic() < self._end
+
+	def get_sound(self):
+		return self.sound if self.get_busy() else None
+
+	def set_volume(self, volume, right=None):
+		self.volume = volume
+
+	def get_volume(self):
+		return self.volume
+
+class _FakeSound:
+	'''
+	Stand-in for pygame.mixer.Sound. Nothing is decoded; every sound is one
+	second long
+	'''
+	def __init__(self, file=None, buffer=None):
+		self._volume = 1.0
+		self._length = 1.0
+
+	def play(self, loops=0, maxtime=0, fade_ms=0):
+		channel = _fakeMixer.find_channel(True)
+		channel.play(self, loops)
+		return channel
+
+	def stop(self):
+		for c in _fakeMixer.channels:
+			if c.sound is self:
+				c.stop()
+
+	def fadeout(self, time):
+		self.stop()
+
+	def set_volume(self, volume):
+		self._volume = volume
+
+	def get_volume(self):
+		return self._volume
+
+	def get_length(self):
+		return self._length
+
+	def get_raw(self):
+		return b''
+
+class _FakeMusic:
+	'''
+	Stand-in for pygame.mixer.music
+	'''
+	def __init__(self):
+		self.path = None
+		self.playing = False
+		self.volume = 1.0
+
+	def load(self, path):
+		self.path = path
+		self.playing = False
+
+	def play(self, loops=0, start=0.0, fade_ms=0):
+		self.playing = True
+		_fakeMixer.played.append(self.path)
+
+	def stop(self):
+		self.playing = False
+
+	def get_busy(self):
+		return self.playing
+
+	def set_volume(self, volume):
+		self.volume = volume
+
+	def get_volume(self):
+		return self.volume
+
+_fakeMixer = types.ModuleType('pygame.mixer')
+_fakeMixer.Sound = _FakeSound
+_fakeMixer.music = _FakeMusic()
+_fakeMixer.played = []
+_fakeMixer.channels = [_FakeChannel(i) for i in range(8)]
+_fakeMixer.format = (44100, -16, 2)
+
+def _preInit(frequency=44100, size=-16, channels=2, buffer=512):
+	_fakeMixer.format = (frequency, size, channels)
+
+_fakeMixer.pre_init = _preInit
+_fakeMixer.init = lambda *args, **kwargs: None
+_fakeMixer.quit = lambda: None
+_fakeMixer.get_init = lambda: _fakeMixer.format
+_fakeMixer.get_num_channels = lambda: len(_fakeMixer.channels)
+_fakeMixer.get_busy = lambda: any(c.get_busy() for c in _fakeMixer.channels)
+_fakeMixer.reserved = 0
+
+def _setReserved(n):
+	_fakeMixer.reserved = n
+	return n
+
+_fakeMixer.set_reserved = _setReserved
+_fakeMixer.Channel = lambda id: _fakeMixer.channels[id]
+
+def _setNumChannels(n):
+	c = _fakeMixer.channels
+	del c[n:]
+	c.extend(_FakeChannel(i) for i in range(len(c), n))
+
+def _findChannel(force=False):
+	unreserved = _fakeMixer.channels[_fakeMixer.reserved:]
+	for c in unreserved:
+		if not c.get_busy():
+			return c
+	return unreserved[0] if force and unreserved else None
+
+_fakeMixer.set_num_channels = _setNumChannels
+_fakeMixer.find_channel = _findChannel
+
+class _FakePipeline:
+	'''
+	Stand-in for the Camera and FileDump pipelines in stream.py
+	'''
+	def __init__(self, *args, **kwargs):
+		self._initiators = []
+		self._lock = Lock()
+		self.recordings = 0
+
+	def start(self):
+		pass
+
+	def stop(self):
+		pass
+
+	@property
+	def initiators(self):
+		with self._lock:
+			return list(self._initiators)
+
+	def addInitiator(self, identifier):
+		with self._lock:
+			if not self._initiators:
+				self.recordings += 1
+			if identifier not in self._initiators:
+				self._initiators.append(identifier)
+
+	def removeInitiator(self, identifier):
+		with self._lock:
+			if identifier in self._initiators:
+				self._initiators.remove(identifier)
+
+class _FakeCamera(_FakePipeline):
+	'''
+	Stand-in for the Camera, noting which sensors were already up when it was
+	started (it may wait a long time for its device)
+	'''
+	def start(self):
+		import sensors
+		self.sensorsAtStart = sorted(sensors.sensorStatus)
+
+_fakeStream = types.ModuleType('stream')
+_fakeStream.Camera = _FakeCamera
+_fakeStream.FileDump = _FakePipeline
+
+_fakeGmail = types.ModuleType('gmail')
+_fakeGmail.alerts = []
+_fakeGmail.intruderAlert = lambda: _fakeGmail.alerts.append(clock.now())
+
+_fakeWebInterface = types.ModuleType('webInterface')
+_fakeWebInterface.startWebInterface = lambda stateMachine: None
+
+def _resetFakes():
+	_fakeMixer.played = []
+	_fakeMixer.channels = [_FakeChannel(i) for i in range(8)]
+	_fakeMixer.music = _FakeMusic()
+	_fakeMixer.format = (44100, -16, 2)
+	_fakeMixer.reserved = 0
+	_fakeEvdev.devices = []
+	_fakeGmail.alerts = []
+
+def _forgetModules():
+	'''
+	Drop the pyledriver modules from sys.modules so they are imported afresh.
+	Much of their state lives in module globals that are set up on import (the
+	config files, the sensor status, the debounce engine) and would otherwise
+	stay bound to the first simulation. The clock is kept since it is swapped
+	rather than set up on import, and so is this module
+	'''
+	keep = ('clock', __name__)
+	for name, module in list(sys.modules.items()):
+		path = getattr(module, '__file__', None)
+		if path and os.path.dirname(os.path.realpath(path)) == _PKG_DIR and name not in keep:
+			del sys.modules[name]
+
+def installFakes(gpio):
+	'''
+	Put the fake backends in place of the real ones, starting from a clean
+	slate. This must be called before the state machine (or anything it
+	imports) is imported
+	'''
+	_resetFakes()
+	rpi = types.ModuleType('RPi')
+	rpi.GPIO = gpio
+	pygame = types.ModuleType('pygame')
+	pygame.mixer = _fakeMixer
+	sys.modules.update({
+		'RPi': rpi,
+		'RPi.GPIO': gpio,
+		'evdev': _fakeEvdev,
+		'pygame': pygame,
+		'pygame.mixer': _fakeMixer,
+		'stream': _fakeStream,
+		'gmail': _fakeGmail,
+		'webInterface': _fakeWebInterface,
+	})
+
+class Simulation:
+	'''
+	Context manager that runs a StateMachine against fake hardware in a scratch
+	directory (so the real config and state files are never touched). Time only
+	moves when advance is called. Config entries may be overridden with config.
+	If gpiochip is True sensors are read through a fake gpio chip rather than
+	the fake RPi.GPIO
+	'''
+	def __init__(self, config=None, gpiochip=False, settle=0.005):
+		self.gpio = FakeGPIO()
+		self.clock = clock.VirtualClock(settle=settle)
+		self.transitions = []
+		self.latencies = []
+		self.events = 0
+		self.usbResets = []
+		self._settle = settle
+		self._config = dict(config or {})
+		self._gpiochip = gpiochip
+		self._lastInjection = None
+
+	def __enter__(self):
+		self._oldCwd = os.getcwd()
+		self._dir = tempfile.mkdtemp(prefix='pyledriver-sim-')
+
+		os.mkdir(os.path.join(self._dir, 'config'))
+		for f in os.listdir(os.path.join(_PKG_DIR, 'config')):
+			if f.endswith('.default'):
+				shutil.copy(os.path.join(_PKG_DIR, 'config', f),
+					os.path.join(self._dir, 'config', f[:-len('.default')]))
+
+		# the fake mixer decodes nothing, but sound files are still looked up
+		os.symlink(os.path.join(_PKG_DIR, 'soundfx'), os.path.join(self._dir, 'soundfx'))
+
+		self._config.setdefault('controlSocket', os.path.join(self._dir, 'control.sock'))
+
+		if self._gpiochip:
+			self._config['gpiochip'] = os.path.join(self._dir, 'gpiochip')
+			open(self._config['gpiochip'], 'w').close()
+
+		if self._config:
+			import yaml
+			confPath = os.path.join(self._dir, 'config', 'pyledriver.yaml')
+			with open(confPath, 'r') as f:
+				conf = yaml.safe_load(f)
+			conf.update(self._config)
+			with open(confPath, 'w') as f:
+				yaml.safe_dump(conf, f, default_flow_style=False)
+
+		os.chdir(self._dir)
+		if _PKG_DIR not in sys.path:
+			sys.path.insert(0, _PKG_DIR)
+
+		self._start()
+		return self
+
+	def __exit__(self, exception_type, exception_value, traceback):
+		self._stop(exception_type, exception_value, traceback)
+		clock.setClock(clock.RealClock())
+		os.chdir(self._oldCwd)
+		shutil.rmtree(self._dir, ignore_errors=True)
+
+	def _start(self):
+		_forgetModules()
+		installFakes(self.gpio)
+		clock.setClock(self.clock)
+
+		import stateMachine, listeners, gpiochip
+		from config import configFile
+
+		stateMachine._resetUSBDevice = self.usbResets.append
+		gpiochip.GpioChipBackend.lineClass = staticmethod(
+			lambda chipFd, offset, consumer: _FakeChipLine(self.gpio, offset))
+		listeners.KeypadListener._devPath = os.path.join(self._dir, 'input', 'keypad')
+		os.makedirs(os.path.dirname(listeners.KeypadListener._devPath), exist_ok=True)
+		open(listeners.KeypadListener._devPath, 'w').close()
+
+		self.passwd = configFile['keyPasswd']
+
+		self.stateMachine = sm = stateMachine.StateMachine()
+		sm.addTransitionListener(self._recordTransition)
+		sm.__enter__()
+		self._settleAll()
+
+	def _stop(self, exception_type=None, exception_value=None, traceback=None):
+		import sensors
+		self.stateMachine.__exit__(exception_type, exception_value, traceback)
+		sensors._debounce.stop()
+		# the lines are released when the process exits
+		self.gpio.cleanup()
+
+	def restart(self):
+		'''
+		Stop the state machine and start a new one from the same state and
+		snapshot files, as after a crash. The fake hardware keeps its levels, so
+		inputs changed with gpio.setLevel in between are only seen on startup
+		'''
+		self._stop()
+		self._start()
+
+	def _recordTransition(self, lastState, nextState, signal):
+		self.transitions.append((self.clock.monotonic(), lastState.name,
+			nextState.name, signal.name))
+		# only transitions caused directly by an injected event have a latency
+		# (eg not countdown timeouts)
+		if self._lastInjection is not None and signal.name != 'TIMOUT':
+			self.latencies.append((nextState.name, time.perf_counter() - self._lastInjection))
+			self._lastInjection = None
+
+	def _inject(self):
+		self.events += 1
+		self._lastInjection = time.perf_counter()
+
+	def _settleAll(self, timeout=1):
+		'''
+		Wait (in real time) for pending GPIO callbacks to run and for the
+		debounce engine to pick up their edges. Callbacks that block simply
+		time out
+		'''
+		import sensors
+		engine = sensors._debounce
+
+		# the engine is settled once it is waiting on the clock for its next
+		# deadline (otherwise advance could skip past it)
+		def filtering():
+			if engine._wake.is_set():
+				return True
+			pending = engine._deadlines and engine._deadlines[0][0]
+			return pending and not any(t <= pending + 1e-9 for t in self.clock._deadlines)
+
+		deadline = time.monotonic() + timeout
+		while (self.gpio.pending() or filtering()) and time.monotonic() < deadline:
+			time.sleep(self._settle)
+		time.sleep(self._settle)
+
+	@property
+	def state(self):
+		return self.stateMachine.currentState.name
+
+	def advance(self, seconds):
+		self.clock.advance(seconds)
+		self._settleAll()
+
+	def advanceTo(self, t):
+		self.clock.advanceTo(t)
+		self._settleAll()
+
+	def setPin(self, pin, value):
+		self._inject()
+		self.gpio.setLevel(pin, value)
+		self._settleAll()
+
+	def motion(self, pin, hold=1):
+		self.setPin(pin, 1)
+		self.advance(hold)
+		self.setPin(pin, 0)
+
+	def level(self, rms, peak):
+		self._inject()
+		self.stateMachine.loudness.feed(rms, peak)
+
+	@property
+	def keypad(self):
+		return _fakeEvdev.devices[-1]
+
+	def unplugKeypad(self):
+		import listeners
+		os.remove(listeners.KeypadListener._devPath)
+		self.keypad.unplug()
+		time.sleep(self._settle)
+
+	def plugKeypad(self):
+		import listeners
+		open(listeners.KeypadListener._devPath, 'w').close()
+		time.sleep(self._settle)
+
+	def key(self, codes):
+		for code in codes if isinstance(codes, list) else [codes]:
+			self._inject()
+			self.keypad.inject(code)
+			time.sleep(self._settle)
+		time.sleep(self._settle)
+
+	def secret(self, secret):
+		'''
+		Send a secret through the control socket and return the reply
+		'''
+		import socket, json
+		self._inject()
+		with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+			sock.connect(self._config['controlSocket'])
+			sock.sendall((secret + '\n').encode())
+			reply = sock.makefile().readline()
+		time.sleep(self._settle)
+		return json.loads(reply)
+
+	def signal(self, name, zone=None):
+		from stateMachine import _SIGNALS
+		self._inject()
+		self.stateMachine.selectState(_SIGNALS[name], zone)
+
+	def assertState(self, name, zone=None):
+		self.checkExceptions()
+		sm = self.stateMachine
+		state = (sm.currentState if zone is None else sm.zones[zone].currentState).name
+		if state != name:
+			raise SimulationError('Expected state {} at t={}, got {}'.format(
+				name, self.clock.monotonic(), state))
+
+	def checkExceptions(self):
+		'''
+		Reraise the first exception thrown in any exception-aware child thread
+		'''
+		from exceptionThreading import _excQueue
+		try:
+			raise _excQueue.get_nowait()
+		except queue.Empty:
+			pass
+
+	def replay(self, trace, speed=None):
+		'''
+		Replay a list of trace entries (see module docstring). If speed is
+		given, real time between events is the trace time divided by speed,
+		otherwise events are replayed as fast as possible
+		'''
+		start = time.perf_counter()
+		for entry in sorted(trace, key=lambda e: e['t']):
+			if speed:
+				delay = start + entry['t'] / speed - time.perf_counter()
+				if delay > 0:
+					time.sleep(delay)
+			self.advanceTo(entry['t'])
+
+			if 'pin' in entry:
+				self.setPin(entry['pin'], entry['value'])
+			elif 'motion' in entry:
+				self.motion(entry['motion'], entry.get('hold', 1))
+			elif 'level' in entry:
+				self.level(*entry['level'])
+			elif 'key' in entry:
+				self.key(entry['key'])
+			elif 'secret' in entry:
+				self.secret(entry['secret'])
+			elif 'signal' in entry:
+				self.signal(entry['signal'], entry.get('zone'))
+			elif 'expect' in entry:
+				self.assertState(entry['expect'], entry.get('zone'))
+			else:
+				raise SimulationError('Invalid trace entry: {}'.format(entry))
+
+		self.checkExceptions()
+
+		return self.report(time.perf_counter() - start)
+
+	def report(self, elapsed):
+		lat = [l for s, l in self.latencies]
+		report = {
+			'events': self.events,
+			'transitions': len(self.transitions),
+			'realSeconds': elapsed,
+			'virtualSeconds': self.clock.monotonic(),
+			'eventsPerSecond': self.events / elapsed if elapsed else None,
+		}
+		if lat:
+			report['latency'] = {
+				'mean': statistics.mean(lat),
+				'median': statistics.median(lat),
+				'max': max(lat),
+			}
+		return report
+
+def main(argv):
+	import yaml
+
+	if len(argv) < 2:
+		print('usage: simulation.py TRACE [SPEED]')
+		return 2
+
+	with open(argv[1], 'r') as f:
+		trace = yaml.safe_load(f)
+
+	speed = float(argv[2]) if len(argv) > 2 else None
+
+	with Simulation() as sim:
+		report = sim.replay(trace, speed)
+		for t, lastState, nextState, signal in sim.transitions:
+			print('[{:9.3f}] {:>18} -> {:<18} ({})'.format(t, lastState, nextState, signal))
+		for name, latency in sim.latencies:
+			print('latency to {:<18} {:8.3f} ms'.format(name, latency * 1000))
+
+	print(yaml.safe_dump(report, default_flow_style=False))
+	return 0
+
+if __name__ == '__main__':
+	sys.exit(main(sys.argv))
@@ -0,0 +1,106 @@
+'''
+Periodic snapshot of the runtime state for fast crash recovery. Unlike the
+stateFile (which only remembers the name of the current state) the snapshot
+holds everything needed to pick up exactly where we left off:
+- remaining time on any running countdown
+- active FileDump initiators (eg in-progress recordings)
+- sensor warm-up status and last signals
+
+The snapshot is tagged with the kernel boot id. If the boot id matches on
+startup then we merely crashed/restarted (as opposed to rebooting) and the
+sensors have been powered the entire time, so their warm-up can be skipped.
+'''
+
+import os, time, yaml, logging
+from threading import Event, Lock
+from exceptionThreading import ExceptionThread
+
+logger = logging.getLogger(__name__)
+
+_BOOT_ID_PATH = '/proc/sys/kernel/random/boot_id'
+
+def _getBootId():
+	try:
+		with open(_BOOT_ID_PATH, 'r') as f:
+			return f.read().strip()
+	except OSError:
+		return None
+
+def loadSnapshot(path='config/snapshot.yaml'):
+	'''
+	Returns the last snapshot as a dict if it was written during the current
+	boot, else None (in which case a cold start is required)
+	'''
+	try:
+		with open(path, 'r') as f:
+			snap = yaml.safe_load(f)
+	except FileNotFoundError:
+		return None
+	except yaml.YAMLError as e:
+		logger.warning('Discarding unreadable snapshot: %s', e)
+		return None
+
+	bootId = _getBootId()
+
+	if not isinstance(snap, dict) or bootId is None or snap.get('bootId') != bootId:
+		logger.debug('Snapshot not from current boot, performing cold start')
+		return None
+
+	logger.info('Recovering from snapshot taken %.1fs ago', time.time() - snap['time'])
+	return snap
+
+class Snapshot(ExceptionThread):
+	'''
+	Polls a number of providers (functions that return a dict) every period
+	seconds and merges their output into one snapshot file. The file is only
+	rewritten when something changes, and writes are atomic (tmp file + rename)
+	so that a crash mid-write never leaves a corrupted snapshot behind
+	'''
+	def __init__(self, path='config/snapshot.yaml', period=0.5):
+		self._path = path
+		self._period = period
+		self._providers = []
+		self._stopper = Event()
+		self._bootId = _getBootId()
+		self._last = None
+		self._lock = Lock()
+
+		def poll():
+			while not self._stopper.wait(self._period):
+				self.write()
+
+		super().__init__(target=poll, daemon=True)
+
+	def addProvider(self, provider):
+		self._providers.append(provider)
+
+	def write(self):
+		with self._lock:
+			snap = {}
+			for p in self._providers:
+				snap.update(p())
+
+			if snap == self._last:
+				return
+
+			self._last = snap
+			out = dict(snap, bootId=self._bootId, time=time.time())
+
+			tmpPath = self._path + '.tmp'
+			with open(tmpPath, 'w') as f:
+				yaml.safe_dump(out, f, default_flow_style=False)
+			os.replace(tmpPath, self._path)
+
+	def start(self):
+		ExceptionThread.start(self)
+		logger.debug('Started snapshot writer at path %s', self._path)
+
+	def stop(self):
+		if self.is_alive():
+			self._stopper.set()
+			# flush one last time so a clean shutdown leaves an accurate snapshot
+			self.write()
+			logger.debug('Stopped snapshot writer')
+
+	def __del__(self):
+		self.stop()
@@ -0,0 +1,169 @@
+'''
+Loading of sound files into mixer sounds. Decoding (especially of ogg files) is
+slow on the pi, so each file is only decoded once: the decoded samples, which
+are in the format the mixer was opened with, are written to a cache directory
+and later loads map that file instead. Cache entries are keyed by path, file
+modification time and size and mixer format, so changing any of these causes a
+fresh decode (and the stale entry to be removed).
+
+Sounds are loaded on first use or, after preload, in the background in
+parallel, whichever comes first. The time spent loading (split between decoding
+and mapping) is kept so the saving from the cache can be seen in stats
+'''
+
+import os, mmap, wave, struct, hashlib, logging, time
+from concurrent.futures import Future, ThreadPoolExecutor
+from threading import Lock
+from pygame import mixer
+from profiling import profiler
+
+logger = logging.getLogger(__name__)
+
+def _vorbisFormat(path):
+	'''
+	(frequency, channels) from the identification header at the start of an
+	Ogg Vorbis file, or None if it is not one
+	'''
+	with open(path, 'rb') as f:
+		head = f.read(128)
+	offset = head.find(b'\x01vorbis')
+	if not head.startswith(b'OggS') or offset < 0 or len(head) < offset + 16:
+		return None
+	_, channels, frequency = struct.unpack_from('<IBI', head, offset + 7)
+	return frequency, channels
+
+def sourceFormat(paths, formats=()):
+	'''
+	The highest frequency and channel count among the wav and ogg files in
+	paths and the given (frequency, channels) formats, ie the smallest mixer
+	format that loses nothing. Files whose header cannot be read count as
+	44.1 kHz stereo
+	'''
+	formats = list(formats)
+	for path in paths:
+		try:
+			with wave.open(path) as w:
+				formats.append((w.getframerate(), w.getnchannels()))
+			continue
+		except (OSError, EOFError, wave.Error):
+			pass
+		try:
+			formats.append(_vorbisFormat(path) or (44100, 2))
+		except OSError:
+			formats.append((44100, 2))
+	return max(f[0] for f in formats), max(f[1] for f in formats)
+
+def soundBytes(sound):
+	'''
+	Memory held by a decoded sound, which is always in the mixer's format
+	'''
+	frequency, size, channels = mixer.get_init()
+	return round(sound.get_length() * frequency) * channels * abs(size) // 8
+
+class SoundBank:
+	'''
+	Mixer sounds by path, each loaded once. Effects sharing a path share the
+	underlying sound (and thus its volume)
+	'''
+	def __init__(self, cachePath, workers=2):
+		self._cachePath = cachePath
+		self._workers = workers
+		self._futures = {}
+		self._lock = Lock()
+		self.decoded = 0
+		self.mapped = 0
+		self.bytes = 0
+		self.decodeSeconds = 0
+		self.mapSeconds = 0
+
+	def get(self, path):
+		'''
+		The sound for path, waiting for it to load if it is already loading
+		'''
+		with self._lock:
+			future = self._futures.get(path)
+			owner = future is None
+			if owner:
+				future = self._futures[path] = Future()
+		if owner:
+			try:
+				future.set_result(self._load(path))
+			except BaseException as e:
+				future.set_exception(e)
+		return future.result()
+
+	def preload(self, paths):
+		'''
+		Start loading paths in the background, in order
+		'''
+		executor = ThreadPoolExecutor(self._workers)
+		for path in paths:
+			executor.submit(self._preload, path)
+		executor.shutdown(wait=False)
+
+	def _preload(self, path):
+		try:
+			self.get(path)
+		except Exception as e:
+			logger.error('Could not load %s: %s', path, e)
+
+	def _entryPaths(self, path):
+		st = os.stat(path)
+		frequency, size, channels = mixer.get_init()
+		prefix = hashlib.sha1(os.path.abspath(path).encode()).hexdigest()
+		version = hashlib.sha1('{}\0{}\0{},{},{}'.format(st.st_mtime_ns, st.st_size,
+			frequency, size, channels).encode()).hexdigest()[:12]
+		return prefix, os.path.join(self._cachePath, '{}-{}.pcm'.format(prefix, version))
+
+	def _load(self, path):
+		prefix, entry = self._entryPaths(path)
+		start = time.perf_counter()
+		try:
+			with open(entry, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+				sound = mixer.Sound(buffer=m)
+		except (FileNotFoundError, ValueError):
+			# not cached (or an empty entry, which cannot be mapped)
+			pass
+		else:
+			elapsed = time.perf_counter() - start
+			with self._lock:
+				self.mapped += 1
+				self.mapSeconds += elapsed
+				self.bytes += soundBytes(sound)
+			profiler.record('audio.load.mapped', elapsed)
+			return sound
+
+		sound = mixer.Sound(path)
+		elapsed = time.perf_counter() - start
+		with self._lock:
+			self.decoded += 1
+			self.decodeSeconds += elapsed
+			self.bytes += soundBytes(sound)
+		profiler.record('audio.load.decoded', elapsed)
+		logger.debug('Decoded %s in %.0f ms', path, elapsed * 1000)
+
+		try:
+			self._store(prefix, entry, sound.get_raw())
+		except OSError as e:
+			logger.warning('Could not cache decoded %s: %s', path, e)
+		return sound
+
+	def _store(self, prefix, entry, data):
+		os.makedirs(self._cachePath, exist_ok=True)
+		for name in os.listdir(self._cachePath):
+			if name.startswith(prefix + '-'):
+				os.remove(os.path.join(self._cachePath, name))
+		with open(entry + '.tmp', 'wb') as f:
+			f.write(data)
+		os.replace(entry + '.tmp', entry)
+
+	def stats(self):
+		with self._lock:
+			return {
+				'loaded': sum(f.done() for f in self._futures.values()),
+				'decoded': self.decoded,
+				'mapped': self.mapped,
+				'bytes': self.bytes,
+				'decodeSeconds': self.decodeSeconds,
+				'mapSeconds': self.mapSeconds
+			}
@@ -1,130 +1,630 @@
 '''
 Implements all sound functionality
 '''
-import logging, os, hashlib, queue, time, psutil
-from config import stateFile
-from threading import Event, RLock
-from exceptionThreading import ExceptionThread, async
+import logging, os, io, re, string, struct, hashlib, heapq, itertools, queue, time, yaml, clock
+from config import configFile, stateFile
+from threading import Event, RLock, Lock, Condition, Semaphore
+from exceptionThreading import ExceptionThread
 from pygame import mixer
-from subprocess import call
+from subprocess import Popen, PIPE
 from collections import OrderedDict
+from profiling import profiler, getOrigin
+from soundBank import SoundBank, sourceFormat
 
 logger = logging.getLogger(__name__)
 
-class SoundEffect(mixer.Sound):
+# speech priorities, most urgent first
+PRIORITY_ALARM = 0
+PRIORITY_NORMAL = 1
+
+# sound priorities, most important first (see SoundScheduler)
+SOUND_PRIORITIES = ['alarm', 'speech', 'door', 'state', 'keypad']
+
+class SoundScheduler:
+	'''
+	Assigns sounds to mixer channels by priority. Each priority may have a set
+	of channels reserved for it (which should also be reserved in the mixer so
+	nothing else plays on them); all priorities share the remaining channels.
+	A sound takes the first idle channel among its reserved and the shared
+	channels. If all are busy it cuts off a sound of lower priority, or one of
+	its own priority on its reserved channels, whichever started longest ago
+	among the lowest priority. Otherwise the sound is dropped. Thus a sound is
+	never cut off or dropped in favour of a less important one.
+
+	Counts of sounds played, dropped and preempted (cut off) are kept per
+	priority
+	'''
+	def __init__(self, reserved, shared):
+		self._reserved = {p: [mixer.Channel(i) for i in ids] for p, ids in reserved.items()}
+		self._shared = [mixer.Channel(i) for i in shared]
+		self._lock = Lock()
+		# channel -> (priority, sequence number) of what was last played on it
+		self._playing = {}
+		self._seq = itertools.count()
+		self._counters = {p: {'played': 0, 'dropped': 0, 'preempted': 0} for p in SOUND_PRIORITIES}
+
+	def play(self, sound, priority, loops=0):
+		'''
+		Play sound, returning the channel or None if it was dropped
+		'''
+		rank = SOUND_PRIORITIES.index(priority)
+		reserved = self._reserved.get(priority, [])
+		with self._lock:
+			channels = reserved + self._shared
+			channel = next((c for c in channels if not c.get_busy()), None)
+			if channel is None:
+				victims = []
+				for c in channels:
+					p, seq = self._playing.get(c, (SOUND_PRIORITIES[-1], -1))
+					r = SOUND_PRIORITIES.index(p)
+					if r > rank or (r == rank and c in reserved):
+						victims.append((-r, seq, p, c))
+				if not victims:
+					self._counters[priority]['dropped'] += 1
+					logger.debug('Dropped %s sound, all channels are busy', priority)
+					return None
+				_, _, victim, channel = min(victims, key=lambda v: v[:2])
+				self._counters[victim]['preempted'] += 1
+				logger.debug('Cut off %s sound for a %s sound', victim, priority)
+			self._playing[channel] = (priority, next(self._seq))
+			self._counters[priority]['played'] += 1
+			# play before releasing the lock so no other caller takes the
+			# same idle channel before it is busy
+			channel.play(sound, loops=loops)
+		return channel
+
+	def stats(self):
+		with self._lock:
+			return {p: dict(c) for p, c in self._counters.items()}
+
+class SoundEffect:
 	'''
 	Represents one discrete sound effect that can be called and played at will.
 	The clas wraps a mixer.Sound object which maps to one sound file on the
 	disk. In addition, it implements volume and/or loops. The former sets the
 	volume permanently (independent of the user-set volume) and the latter
-	defines how many times to play once called. Both are optional.
+	defines how many times to play once called. Both are optional. A sound may
+	also be given a scheduler to play through at its priority (see
+	SoundScheduler), in which case the time from the origin of the event that
+	caused it (eg a key press) to the start of playback is recorded in the
+	profiler under 'audio.<origin>'.
+
+	If a sound bank is given the file is only loaded through it when first
+	needed (see SoundBank), otherwise it is loaded right away
 	'''
-	def __init__(self, path, volume=None, loops=0):
-		super().__init__(path)
+	def __init__(self, path, volume=None, loops=0, priority='state', scheduler=None, bank=None):
 		self.path = path
 		self.volume = volume
-		if volume:
-			self.set_volume(volume)
 		self.loops = loops
+		self.priority = priority
+		self.scheduler = scheduler
+		self._bank = bank
+		self._userVolume = None
+		self._sound = None
+		if not bank:
+			self.sound
+
+	@property
+	def sound(self):
+		if self._sound is None:
+			sound = self._bank.get(self.path) if self._bank else mixer.Sound(self.path)
+			volume = self.volume or self._userVolume
+			if volume is not None:
+				sound.set_volume(volume)
+			self._sound = sound
+		return self._sound
 		
 	def play(self, loops=None):
 		loops = loops if loops else self.loops
-		mixer.Sound.play(self, loops=loops)
+		if self.scheduler:
+			channel = self.scheduler.play(self.sound, self.priority, loops=loops)
+			origin = getOrigin()
+			if origin:
+				profiler.record('audio.' + origin[0], time.perf_counter() - origin[1])
+			return channel
+		return self.sound.play(loops=loops)
+
+	def stop(self):
+		if self._sound:
+			self._sound.stop()
+
+	def get_length(self):
+		return self.sound.get_length()
 	
-	def set_volume(self, volume, force=False):
-		# Note: force only intended to be used by fader
-		if not self.volume or force:
-			mixer.Sound.set_volume(self, volume)
+	def set_volume(self, volume):
+		if not self.volume:
+			self._userVolume = volume
+			if self._sound:
+				self._sound.set_volume(volume)
+
+class StreamedSound:
+	'''
+	A long or looping sound (ie an alarm) that is streamed from disk through
+	mixer.music instead of being decoded into memory, so only the stream's
+	buffer is ever held. Otherwise behaves like a SoundEffect. There is only
+	one music stream, so starting a streamed sound stops any other one. The
+	stream is resampled to the mixer's format, which is chosen for the decoded
+	sounds, so a source at a higher rate loses its top end (for the alarm,
+	above 11 kHz at the usual 22.05 kHz); set audio.frequency if that matters
+	'''
+	_current = None
+	_gain = 1.0
+
+	def __init__(self, path, volume=None, loops=0, priority='alarm'):
+		self.path = path
+		self.volume = volume
+		self.loops = loops
+		self.priority = priority
+		self._userVolume = 1.0
+
+	def play(self, loops=None):
+		loops = loops if loops else self.loops
+		mixer.music.load(self.path)
+		StreamedSound._current = self
+		self._applyVolume()
+		mixer.music.play(loops=loops)
+
+	def stop(self):
+		if StreamedSound._current is self:
+			mixer.music.stop()
+			StreamedSound._current = None
+
+	def set_volume(self, volume):
+		if not self.volume:
+			self._userVolume = volume
+			self._applyVolume()
+
+	def _applyVolume(self):
+		if StreamedSound._current is self:
+			mixer.music.set_volume((self.volume or self._userVolume) * StreamedSound._gain)
+
+	@classmethod
+	def duck(cls, gain):
+		'''
+		Scale the volume of whatever is streaming (the stream has no channel)
+		'''
+		cls._gain = gain
+		current = cls._current
+		if current:
+			current._applyVolume()
 
 class TTSSound(SoundEffect):
 	'''
-	Special case of a SoundEffect wherein the sound is a speech file dynamically
-	created	by espeak and stored in tmp.
+	Special case of a SoundEffect wherein the sound is speech dynamically
+	created	by espeak, either from the TTS cache or fresh from memory (path may
+	be a file-like object)
 	'''
 	def __init__(self, path):
 		super().__init__(path, volume=1.0, loops=0)
-		self.size = os.path.getsize(path)
 
-	def __del__(self):
-		if os.path.exists(self.path):
-			os.remove(self.path)
+def _fixWavHeader(data):
+	'''
+	espeak does not know the length of its output when writing to stdout, so
+	the RIFF and data chunk sizes are placeholders. Set them to the real sizes
+	'''
+	data = bytearray(data)
+	offset = data.find(b'data', 12)
+	if data[:4] != b'RIFF' or offset < 0:
+		raise ValueError('espeak did not output wav data')
+	struct.pack_into('<I', data, 4, len(data) - 8)
+	struct.pack_into('<I', data, offset + 4, len(data) - offset - 8)
+	return bytes(data)
 
-class TTSCache(OrderedDict):
+class Ducker(ExceptionThread):
 	'''
-	Manages a list of all TTSSounds stored in tmp, and remembers the order files
-	have been added. Amount of data shall not exceed memLimit; once memLimit is 
-	exceeded, files will be removed in FIFO manner
+	Lowers the volume of every mixer channel except the excluded ones (ie
+	speech) for a while, by setting channel volumes along an envelope: a fade
+	down to level, a hold, and a fade back up. Sound volumes (and thus the user
+	volume) are never touched. One thread runs all envelopes, stepping them on
+	the shared clock; it sleeps while nothing is ducked. Calling duck while
+	already ducked only extends the hold
 	'''
-	def __init__(self, memLimit):
-		super().__init__()
-		self._memLimit = memLimit
-		self._memUsed = 0
-	
-	def __setitem__(self, key, value):
-		if type(value) != TTSSound:
-			raise TypeError
-		OrderedDict.__setitem__(self, key, value)
-		self._memUsed += value.size
-		self._maintainMemLimit()
-		
-	def __delitem__(self, key):
-		self._memUsed -= self[key].size
-		OrderedDict.__delitem__(self, key)
-		
-	def clear(self):
-		logger.debug('Clearing TTS Cache')
-		OrderedDict.clear(self)
-		self._memUsed = 0
-	
-	def _maintainMemLimit(self):
-		while self._memUsed > self._memLimit:
-			OrderedDict.popitem(self, last=False)
+	def __init__(self, exclude, level=0.1, fade=0.2, steps=5):
+		super().__init__(target=self._envelopes, daemon=True)
+		self._exclude = set(exclude)
+		self._level = level
+		self._fade = fade
+		self._step = fade / steps
+		self._start = self._until = 0
+		self._ducked = False
+		self._lock = Lock()
+		self._wake = Event()
+		self._stopper = Event()
+
+	def duck(self, duration):
+		with self._lock:
+			now = clock.monotonic()
+			if now >= self._until:
+				self._start = now
+			self._until = max(self._until, now + duration)
+			self._wake.set()
+
+	def _gain(self, now, start, until):
+		t = min(now - start, until - now)
+		return 1 - (1 - self._level) * min(1, max(0, t) / self._fade)
+
+	def _apply(self, gain):
+		for i in range(mixer.get_num_channels()):
+			if i not in self._exclude:
+				mixer.Channel(i).set_volume(gain)
+		StreamedSound.duck(gain)
+		self._ducked = gain < 1
+
+	def _envelopes(self):
+		while not self._stopper.is_set():
+			with self._lock:
+				start, until = self._start, self._until
+				now = clock.monotonic()
+				idle = now >= until
+				if idle:
+					self._wake.clear()
+			if idle:
+				if self._ducked:
+					self._apply(1)
+				clock.wait(self._wake)
+				continue
+			# keep applying during the hold since playing a sound resets the
+			# volume of its channel
+			self._apply(self._gain(now, start, until))
+			clock.wait(self._stopper, min(self._step, until - now))
+
+	def stop(self):
+		self._stopper.set()
+		self._wake.set()
+		self.join()
+		self._apply(1)
+
+class _SpeechItem:
+	def __init__(self, text, priority, seq):
+		self.text = text
+		self.priority = priority
+		self.seq = seq
+		self.queued = time.perf_counter()
+		# rendered sounds, one per part, followed by None
+		self.parts = queue.Queue()
+
+	def __lt__(self, other):
+		return (self.priority, self.seq) < (other.priority, other.seq)
+
+class SpeechQueue:
+	'''
+	Bounded priority queue of text waiting to be synthesized. Items come out
+	most urgent first and in order of arrival within a priority. Text that is
+	already waiting is not queued again; it only takes the higher of the two
+	priorities. When full, whichever is least urgent (the newest item of the
+	lowest priority, possibly the one being added) is dropped
+	'''
+	def __init__(self, maxSize):
+		self._maxSize = maxSize
+		self._heap = []
+		self._waiting = {}
+		self._seq = itertools.count()
+		self._cond = Condition()
+		self._closed = False
+		self.dropped = 0
+		self.coalesced = 0
+
+	def put(self, text, priority=PRIORITY_NORMAL):
+		'''
+		Queue text, returning False if it was dropped
+		'''
+		with self._cond:
+			item = self._waiting.get(text)
+			if item:
+				self.coalesced += 1
+				if priority < item.priority:
+					item.priority = priority
+					heapq.heapify(self._heap)
+				return True
+
+			item = _SpeechItem(text, priority, next(self._seq))
+			if len(self._heap) >= self._maxSize:
+				worst = max(self._heap)
+				self.dropped += 1
+				if worst < item:
+					logger.warning('Speech queue full, dropping "%s"', text)
+					return False
+				self._heap.remove(worst)
+				heapq.heapify(self._heap)
+				del self._waiting[worst.text]
+				logger.warning('Speech queue full, dropping "%s"', worst.text)
+
+			heapq.heappush(self._heap, item)
+			self._waiting[text] = item
+			self._cond.notify()
+			return True
+
+	def get(self):
+		'''
+		Wait for the most urgent item, or return None once closed
+		'''
+		with self._cond:
+			while not self._heap and not self._closed:
+				self._cond.wait()
+			if self._closed:
+				return None
+			item = heapq.heappop(self._heap)
+			del self._waiting[item.text]
+			return item
+
+	def close(self):
+		with self._cond:
+			self._closed = True
+			self._cond.notify_all()
+
+	def __len__(self):
+		with self._cond:
+			return len(self._heap)
+
+class TTSCache:
+	'''
+	Persistent cache of synthesized speech, so phrases are synthesized once
+	and not again after every restart. Each entry is one file in the cache
+	directory, named by a hash of the text and voice parameters. The index
+	(index.yaml in the same directory) holds the voice parameters, size and
+	last use of each entry; the text itself is not kept.
+
+	The total size of all entries is kept under maxBytes by evicting the least
+	recently used entries. The index is only loaded when first needed, and is
+	written back whenever entries are added or evicted (and on stop), so a
+	crash loses no more than the last use times of recent hits
+	'''
+	def __init__(self, path, maxBytes):
+		self._path = path
+		self._indexPath = os.path.join(path, 'index.yaml')
+		self._maxBytes = maxBytes
+		self._index = None
+		self._bytesUsed = 0
+		self._dirty = False
+		self._lock = RLock()
+		self.hits = 0
+		self.misses = 0
+
+	@staticmethod
+	def key(text, voice):
+		params = ','.join('{}={}'.format(k, voice[k]) for k in sorted(voice))
+		return hashlib.sha1('{}\0{}'.format(params, text).encode()).hexdigest()
+
+	def _entryPath(self, key):
+		return os.path.join(self._path, key + '.wav')
+
+	def _load(self):
+		'''
+		Read the index (oldest entry first), dropping entries whose file is gone
+		and files that are not in the index
+		'''
+		os.makedirs(self._path, exist_ok=True)
+		try:
+			with open(self._indexPath, 'r') as f:
+				index = yaml.safe_load(f) or {}
+		except FileNotFoundError:
+			index = {}
+		except yaml.YAMLError as e:
+			logger.warning('Discarding unreadable TTS cache index: %s', e)
+			index = {}
+
+		self._index = OrderedDict()
+		for key, entry in sorted(index.items(), key=lambda i: i[1]['lastUse']):
+			if os.path.exists(self._entryPath(key)):
+				self._index[key] = entry
+
+		for name in os.listdir(self._path):
+			key, ext = os.path.splitext(name)
+			if ext == '.wav' and key not in self._index:
+				os.remove(os.path.join(self._path, name))
+
+		self._bytesUsed = sum(e['size'] for e in self._index.values())
+		self._dirty = len(self._index) != len(index)
+		logger.debug('Loaded TTS cache index with %s entries (%s bytes)', len(self._index), self._bytesUsed)
+
+	def _ensureLoaded(self):
+		if self._index is None:
+			self._load()
+
+	def contains(self, text, voice):
+		'''
+		Whether text is cached, without counting as a hit or miss
+		'''
+		with self._lock:
+			self._ensureLoaded()
+			return self.key(text, voice) in self._index
+
+	def lookup(self, text, voice):
+		'''
+		Path of the cached speech for text, or None if not cached
+		'''
+		key = self.key(text, voice)
+		with self._lock:
+			self._ensureLoaded()
+			entry = self._index.get(key)
+			if entry is None:
+				self.misses += 1
+				return None
+			self.hits += 1
+			entry['lastUse'] = time.time()
+			self._index.move_to_end(key)
+			self._dirty = True
+			return self._entryPath(key)
+
+	def store(self, text, voice, data):
+		'''
+		Add the speech (wav data) for text to the cache
+		'''
+		key = self.key(text, voice)
+		with self._lock:
+			self._ensureLoaded()
+			path = self._entryPath(key)
+			with open(path + '.tmp', 'wb') as f:
+				f.write(data)
+			os.replace(path + '.tmp', path)
+
+			old = self._index.pop(key, None)
+			if old:
+				self._bytesUsed -= old['size']
+			size = len(data)
+			self._index[key] = {'voice': dict(voice), 'size': size, 'lastUse': time.time()}
+			self._bytesUsed += size
+			self._evict()
+			self.flush(force=True)
+
+	def _evict(self):
+		while self._bytesUsed > self._maxBytes and len(self._index) > 1:
+			key, entry = self._index.popitem(last=False)
+			self._bytesUsed -= entry['size']
+			try:
+				os.remove(self._entryPath(key))
+			except FileNotFoundError:
+				pass
+			logger.debug('Evicted %s from TTS cache', key)
+
+	def flush(self, force=False):
+		with self._lock:
+			if self._index is None or not (self._dirty or force):
+				return
+			tmpPath = self._indexPath + '.tmp'
+			with open(tmpPath, 'w') as f:
+				yaml.safe_dump(dict(self._index), f, default_flow_style=False)
+			os.replace(tmpPath, self._indexPath)
+			self._dirty = False
+
+	def stats(self):
+		with self._lock:
+			lookups = self.hits + self.misses
+			return {
+				'entries': None if self._index is None else len(self._index),
+				'bytes': self._bytesUsed,
+				'maxBytes': self._maxBytes,
+				'hits': self.hits,
+				'misses': self.misses,
+				'hitRate': self.hits / lookups if lookups else None
+			}
 
 class SoundLib:
 	'''
 	Main wrapper for pygame.mixer, including methods for changing overall
 	volume, handling TTS, and hlding the soundfx table for importation
-	elsewhere. Note that the TTS listener is started as a separate thread,
-	and speech bits are sent to be prcoess with a queue (which is to be passed
-	to other threads)
+	elsewhere. Speech is handled in two stages: a pool of synthesis workers
+	takes text from the speech queue (see SpeechQueue) and renders it ahead of
+	time, and a playback thread plays the rendered items back to back, in the
+	order the workers took them, on a channel reserved for speech
 	'''
 	
 	_sentinel = None
+
+	# espeak parameters (amplitude, word gap and pitch; speed and voice may be
+	# set too)
+	_defaultVoice = {'amplitude': 180, 'gap': 8, 'pitch': 75}
+	_voiceArgs = {'amplitude': '-a', 'gap': '-g', 'pitch': '-p', 'speed': '-s', 'voice': '-v'}
+
+	# text longer than this is split at sentence boundaries and each part is
+	# synthesized while the previous one plays
+	_chunkLength = 200
+
+	# format of espeak's output (frequency, channels)
+	_speechFormat = (22050, 1)
+
+	# sound effects by name, with their priority (state if not given; see
+	# SoundScheduler). stream sounds are streamed from disk (see
+	# StreamedSound) and thus need no channel
+	_effects = OrderedDict([
+		('disarmed',			{'path': 'soundfx/smb_pause.wav'}),
+		('armedCountdown',		{'path': 'soundfx/smb_kick.wav'}),
+		('armed',				{'path': 'soundfx/smb_powerup.wav'}),
+		('lockedCountdown',		{'path': 'soundfx/smb_stomp.wav'}),
+		('locked',				{'path': 'soundfx/smb_1-up.wav'}),
+		('trippedCountdown',	{'path': 'soundfx/smb2_door_appears.wav'}),
+		('tripped',				{'path': 'soundfx/alarms/burgler_alarm.ogg', 'volume': 1.0, 'loops': -1, 'priority': 'alarm', 'stream': True}),
+		('door',				{'path': 'soundfx/smb_pipe.wav', 'priority': 'door'}),
+		('numKey',				{'path': 'soundfx/smb_bump.wav', 'priority': 'keypad'}),
+		('ctrlKey',				{'path': 'soundfx/smb_fireball.wav', 'priority': 'keypad'}),
+		('wrongPass',			{'path': 'soundfx/smb_fireworks.wav', 'priority': 'keypad'}),
+		('backspace',			{'path': 'soundfx/smb_breakblock.wav', 'priority': 'keypad'}),
+	])
 	
 	def __init__(self):
-		mixer.pre_init(frequency=44100, size=-16, channels=2, buffer=1024)
+		# in low latency mode UI sounds (keypad) get reserved channels and the
+		# mixer buffer is smaller, at the cost of more wakeups (and thus CPU)
+		audioConf = configFile.get('audio') or {}
+		lowLatency = audioConf.get('lowLatency', False)
+		uiChannels = audioConf.get('uiChannels', 2 if lowLatency else 0)
+
+		# every decoded sound is kept in the mixer's format, so the mixer runs
+		# at the lowest rate and channel count that the decoded sounds need
+		# rather than at 44.1 kHz stereo. Streamed sounds do not count: they
+		# hold no memory either way, and are resampled to the mixer's rate as
+		# they play (see StreamedSound)
+		sources = [e['path'] for e in self._effects.values() if not e.get('stream')]
+		frequency, channels = sourceFormat(sources, [self._speechFormat])
+		frequency = audioConf.get('frequency', frequency)
+		channels = 2 if audioConf.get('stereo', channels > 1) else 1
+		# buffer defaults are for 44.1 kHz; keep their duration
+		buffer = audioConf.get('buffer', (256 if lowLatency else 1024) * frequency // 44100)
+
+		mixer.pre_init(frequency=frequency, size=-16, channels=channels, buffer=buffer)
 		mixer.init()
+		numChannels = audioConf.get('channels', 8)
+		mixer.set_num_channels(numChannels)
+		# the channel after the UI channels is reserved for speech
+		mixer.set_reserved(uiChannels + 1)
+		logger.debug('Mixer running at %s Hz, %s channel(s), buffer of %s samples (%.1f ms)',
+			frequency, channels, buffer, buffer * 1000 / frequency)
+
+		# speech is played on its channel directly, in order, so only keypad
+		# sounds have channels in the scheduler
+		self.scheduler = SoundScheduler({'keypad': range(uiChannels)},
+			range(uiChannels + 1, numChannels))
+		self._speechChannel = mixer.Channel(uiChannels)
+		self._ducker = Ducker(exclude=[uiChannels])
+
+		# sound files are decoded in the background once started (or when
+		# first played), not here
+		bank = self._bank = SoundBank(audioConf.get('pcmCache', 'cache/pcm'),
+			audioConf.get('loadWorkers', 2))
 		
-		self.soundEffects = {
-			'disarmed':				SoundEffect(path='soundfx/smb_pause.wav'),
-			'armedCountdown':		SoundEffect(path='soundfx/smb_kick.wav'),
-			'armed':				SoundEffect(path='soundfx/smb_powerup.wav'),
-			'lockedCountdown':		SoundEffect(path='soundfx/smb_stomp.wav'),
-			'locked':				SoundEffect(path='soundfx/smb_1-up.wav'),
-			'trippedCountdown':		SoundEffect(path='soundfx/smb2_door_appears.wav'),
-			'tripped':				SoundEffect(path='soundfx/alarms/burgler_alarm.ogg', volume=1.0, loops=-1),
-			'door':					SoundEffect(path='soundfx/smb_pipe.wav'),
-			'numKey':				SoundEffect(path='soundfx/smb_bump.wav'),
-			'ctrlKey':				SoundEffect(path='soundfx/smb_fireball.wav'),
-			'wrongPass':			SoundEffect(path='soundfx/smb_fireworks.wav'),
-			'backspace':			SoundEffect(path='soundfx/smb_breakblock.wav'),
-		}
+		self.soundEffects = {}
+		for name, effect in self._effects.items():
+			effect = dict(effect)
+			if effect.pop('stream', False):
+				self.soundEffects[name] = StreamedSound(**effect)
+			else:
+				self.soundEffects[name] = SoundEffect(scheduler=self.scheduler, bank=bank, **effect)
 
-		self._ttsSounds = TTSCache(psutil.virtual_memory().total * 0.001)
-		self._lock = RLock()
+		ttsConf = configFile.get('tts') or {}
+		self.ttsCache = TTSCache(ttsConf.get('cachePath', 'cache/tts'),
+			ttsConf.get('cacheBytes', 32 * 1024 * 1024))
+		self._voice = dict(self._defaultVoice, **ttsConf.get('voice', {}))
 		
 		self.volume = stateFile['volume']
 		self._applyVolumesToSounds(self.volume)
 		
-		self._ttsQueue = queue.Queue()
+		self._ttsQueue = SpeechQueue(ttsConf.get('queueSize', 16))
+		self._ttsWorkers = ttsConf.get('workers', 2)
+		self._phrases = ttsConf.get('phrases') or {}
+		self._phraseFields = {}
+		self.prerenderProgress = {'total': 0, 'done': 0, 'cached': 0, 'failed': 0}
+		# items in the order the workers took them, waiting to be played. The
+		# workers take no more than their number of items ahead of playback, so
+		# the rest wait in the speech queue where urgent items can still go first
+		self._rendered = queue.Queue()
+		self._takeLock = Lock()
+		self._threads = []
+		self.spoken = 0
 		self._stopper = Event()
 
 	def start(self):
+		self._bank.preload(e.path for e in self.soundEffects.values() if isinstance(e, SoundEffect))
+		self._ducker.start()
 		self._startMonitor()
+		if self._phrases:
+			t = ExceptionThread(target=self._prerender, daemon=True)
+			self._threads.append(t)
+			t.start()
 		
 	def stop(self):
 		self._stopMonitor()
-		self._ttsSounds.clear()
+		if self._ducker.is_alive():
+			self._ducker.stop()
+		self.ttsCache.flush()
 		# this sometimes casues "Fatal Python error: (pygame parachute) Segmentation Fault"
 		mixer.quit()
 
@@ -133,107 +633,219 @@ class SoundLib:
 		if newVolume >= 0 and newVolume <= 100:
 			self._applyVolumesToSounds(newVolume)
 	
+	def playing(self):
+		'''
+		Whether any sound (including speech and streamed sounds) is playing
+		'''
+		return mixer.get_busy() or mixer.music.get_busy()
+
 	def mute(self):
 		self._applyVolumesToSounds(0)
 	
-	def speak(self, text):
-		self._ttsQueue.put_nowait(text)
+	def speak(self, text, priority=PRIORITY_NORMAL):
+		'''
+		Queue text to be spoken (use PRIORITY_ALARM for announcements that
+		should go ahead of anything else waiting). Returns False if the queue
+		was full and the text was dropped
+		'''
+		return self._ttsQueue.put(text, priority)
+
+	def announce(self, event, priority=PRIORITY_NORMAL, **fields):
+		'''
+		Speak the phrase configured for event (see tts.phrases in the config),
+		if any, with its fields filled in
+		'''
+		template = self._phrases.get(event)
+		if not template:
+			return
+		try:
+			self.speak(template.format(**fields), priority)
+		except (KeyError, IndexError) as e:
+			logger.warning('Could not announce %s: bad field %s in "%s"', event, e, template)
+
+	def phraseEvents(self):
+		return list(self._phrases)
+
+	def setPhraseFields(self, **fields):
+		'''
+		Values to fill in the phrase templates with (eg zone=['house', 'garage']
+		for 'intruder in the {zone}'). Must be called before start
+		'''
+		self._phraseFields = fields
+
+	def _expandPhrases(self):
+		phrases = []
+		for template in self._phrases.values():
+			names = sorted({f for _, f, _, _ in string.Formatter().parse(template) if f})
+			unknown = [n for n in names if n not in self._phraseFields]
+			if unknown:
+				logger.warning('Not prerendering "%s": no values for %s', template, ', '.join(unknown))
+				continue
+			for values in itertools.product(*(self._phraseFields[n] for n in names)):
+				phrases.append(template.format(**dict(zip(names, values))))
+		return phrases
+
+	def _prerender(self):
+		'''
+		Synthesize the configured phrases into the TTS cache so they are not
+		synthesized when first spoken. This runs at low priority: espeak is
+		niced and only runs while no speech is waiting
+		'''
+		chunks = [c for p in self._expandPhrases() for c in self._splitSpeech(p)]
+		progress = self.prerenderProgress
+		progress['total'] = len(chunks)
+		start = time.perf_counter()
+
+		for chunk in chunks:
+			while len(self._ttsQueue) or not self._rendered.empty():
+				if self._stopper.wait(0.1):
+					return
+			if self._stopper.is_set():
+				return
+
+			if self.ttsCache.contains(chunk, self._voice):
+				progress['cached'] += 1
+			else:
+				try:
+					self.ttsCache.store(chunk, self._voice, self._synthesize(chunk, nice=10))
+				except (OSError, ValueError) as e:
+					progress['failed'] += 1
+					logger.warning('Could not prerender "%s": %s', chunk, e)
+			progress['done'] += 1
+			logger.debug('Prerendered %s/%s phrases', progress['done'], progress['total'])
+
+		logger.info('Prerendered %s phrases in %.1f s (%s already cached, %s failed)',
+			progress['total'], time.perf_counter() - start, progress['cached'], progress['failed'])
+
+	def memoryStats(self):
+		'''
+		Memory held by decoded sounds, and what is streamed instead
+		'''
+		frequency, size, channels = mixer.get_init()
+		bank = self._bank.stats()
+		return {
+			'format': {'frequency': frequency, 'size': size, 'channels': channels},
+			'decodedBytes': bank['bytes'],
+			'streamed': [e.path for e in self.soundEffects.values() if isinstance(e, StreamedSound)],
+			'bank': bank
+		}
+
+	def speechStats(self):
+		q = self._ttsQueue
+		return {
+			'waiting': len(q),
+			'rendered': self._rendered.qsize(),
+			'spoken': self.spoken,
+			'coalesced': q.coalesced,
+			'dropped': q.dropped,
+			'prerender': dict(self.prerenderProgress)
+		}
 		
-	@async(daemon=False)
-	def _fader(self, lowerVolume, totalDuration, fadeDuration=0.2, stepSize=5):
-		with self._lock:
-			alarm = self.soundEffects['tripped']
-			alarmVolume = alarm.volume
-			alarmVolumeDelta = alarmVolume - lowerVolume
-			
-			masterVolume = self.volume
-			masterVolumeDelta = self.volume - lowerVolume
-			
-			sleepFadeTime = fadeDuration / stepSize
-			
-			for i in range(0, stepSize):
-				if alarmVolumeDelta > 0:
-					alarm.set_volume(alarmVolume - alarmVolumeDelta * i / stepSize, force=True)
-					
-				if masterVolumeDelta > 0:
-					self._applyVolumesToSounds(masterVolume - masterVolumeDelta * i / stepSize)
-				
-				time.sleep(sleepFadeTime)
-				
-			time.sleep(totalDuration - 2 * fadeDuration)
-			
-			for i in range(stepSize - 1, -1, -1):
-				if alarmVolumeDelta > 0:
-					alarm.set_volume(alarmVolume - alarmVolumeDelta * i / stepSize, force=True)
-					
-				if masterVolumeDelta > 0:
-					self._applyVolumesToSounds(masterVolume - masterVolumeDelta * i / stepSize)
-				
-				time.sleep(sleepFadeTime)
-	
 	# will not change sounds that have preset volume
 	def _applyVolumesToSounds(self, volume):
-		with self._lock:
-			self.volume = volume
-			stateFile['volume'] = volume
-			v = volume/100
-			s = self.soundEffects
-			for name, sound in s.items():
-				sound.set_volume(v)
-
-	def _ttsMonitor(self):
-		q = self._ttsQueue
-		while not self._stopper.isSet():
-			try:
-				text = self._ttsQueue.get(True)
-				if text is self._sentinel:
-					break
-				self._playSpeech(text)
-				q.task_done()
-			except queue.Empty:
-				pass
-		# There might still be records in the queue.
+		self.volume = volume
+		stateFile['volume'] = volume
+		v = volume/100
+		for sound in self.soundEffects.values():
+			sound.set_volume(v)
+
+	def _synthesize(self, text, nice=0):
+		'''
+		Run espeak and return its output (wav data) without touching the disk
+		'''
+		start = time.perf_counter()
+		args = ['{}{}'.format(self._voiceArgs[k], v) for k, v in sorted(self._voice.items())]
+		preexec = (lambda: os.nice(nice)) if nice else None
+		with Popen(['espeak'] + args + ['--stdout', text], stdout=PIPE, preexec_fn=preexec) as p:
+			data = p.stdout.read()
+		profiler.record('tts.synthesize', time.perf_counter() - start)
+		return _fixWavHeader(data)
+
+	def _speechSound(self, text):
+		path = self.ttsCache.lookup(text, self._voice)
+		if path:
+			return TTSSound(path)
+		data = self._synthesize(text)
+		self.ttsCache.store(text, self._voice, data)
+		return TTSSound(io.BytesIO(data))
+
+	def _splitSpeech(self, text):
+		if len(text) <= self._chunkLength:
+			return [text]
+		chunks = ['']
+		for sentence in re.split(r'(?<=[.!?;:])\s+', text):
+			if chunks[-1] and len(chunks[-1]) + len(sentence) >= self._chunkLength:
+				chunks.append(sentence)
+			else:
+				chunks[-1] = (chunks[-1] + ' ' + sentence).lstrip()
+		return chunks
+
+	def _synthesisWorker(self):
 		while 1:
-			try:
-				text = self._ttsQueue.get(False)
-				if text is self._sentinel:
+			# wait for playback to take an item before taking another
+			self._slots.acquire()
+			# take and hand over under one lock so playback keeps queue order
+			with self._takeLock:
+				item = self._ttsQueue.get()
+				if item is None:
 					break
-				self._playSpeech(text)
-				q.task_done()
-			except queue.Empty:
+				self._rendered.put(item)
+			try:
+				for chunk in self._splitSpeech(item.text):
+					item.parts.put(self._speechSound(chunk))
+			finally:
+				item.parts.put(None)
+
+	def _playback(self):
+		channel = self._speechChannel
+		while 1:
+			item = self._rendered.get()
+			if item is self._sentinel or self._stopper.is_set():
 				break
+			self._slots.release()
+
+			start = time.perf_counter()
+			sound = item.parts.get()
+			if sound is not None:
+				firstAudio = time.perf_counter() - start
+				profiler.record('tts.firstAudio', firstAudio)
+				profiler.record('tts.latency', time.perf_counter() - item.queued)
+				logger.debug('TTS engine playing "%s" (%.0f ms waiting for synthesis)', item.text, firstAudio * 1000)
 
-	def _playSpeech(self, text):
-		basename = hashlib.md5(text.encode()).hexdigest()
-
-		if basename in self._ttsSounds:
-			self._ttsSounds.move_to_end(basename)
-		else:
-			path = '/tmp/' + basename
-			call(['espeak', '-a180', '-g8', '-p75', '-w', path, text])
-			self._ttsSounds[basename] = TTSSound(path)
-
-		self._fader(
-			lowerVolume=0.1,
-			totalDuration=self._ttsSounds[basename].get_length()
-		)
-		self._ttsSounds[basename].play()
-		logger.debug('TTS engine received "%s"', text)
+			while sound is not None:
+				length = sound.get_length()
+				self._ducker.duck(length)
+				channel.play(sound.sound)
+				# the next part (or item) starts when this one ends
+				if clock.wait(self._stopper, length):
+					break
+				sound = item.parts.get()
+			else:
+				self.spoken += 1
 		
 	def _startMonitor(self):
-		self._thread = t = ExceptionThread(target=self._ttsMonitor, daemon=True)
-		t.start()
-		logger.debug('Starting TTS Queue Monitor')
+		self._stopper.clear()
+		self._slots = Semaphore(self._ttsWorkers)
+		self._threads = [ExceptionThread(target=self._synthesisWorker, daemon=True)
+			for i in range(self._ttsWorkers)]
+		self._threads.append(ExceptionThread(target=self._playback, daemon=True))
+		for t in self._threads:
+			t.start()
+		logger.debug('Starting TTS pipeline with %s synthesis workers', self._ttsWorkers)
 					
 	def _stopMonitor(self):
+		if not self._threads:
+			return
 		self._stopper.set()
-		self._ttsQueue.put_nowait(self._sentinel)
-		try:
-			self._thread.join()
-			self._thread = None
-		except AttributeError:
-			pass
-		logger.debug('Stopping TTS Queue Monitor')
+		self._ttsQueue.close()
+		# let any worker waiting for a slot see the queue is closed
+		self._slots.release(self._ttsWorkers)
+		self._rendered.put(self._sentinel)
+		for t in self._threads:
+			t.join()
+		self._threads = []
+		self._speechChannel.stop()
+		logger.debug('Stopping TTS pipeline')
 
 	def __del__(self):
 		self.stop()
@@ -8,22 +8,35 @@ machine in response to external events. The state machine itself does not "wait"
 but rather its selectState method could be called within any child thread (hence
 the lock) which also means the entry/exit functions of each state are run within
 the signal-originating child thread.
+
+The house may be partitioned into zones, each of which has its own copy of the
+state network (and its own lock) and can be armed separately. The state of the
+house as a whole is derived from the zones (see StateMachine below).
 '''
-import RPi.GPIO as GPIO
-import time, logging, enum, os
-from threading import Lock, Event
+import time, logging, enum, os, math, queue, clock
+from threading import Lock, RLock, Event
 from functools import partial
-from collections import namedtuple
+from collections import namedtuple, OrderedDict
 
 from exceptionThreading import ExceptionThread
 from config import configFile, stateFile
-from sensors import startDoorSensor, startMotionSensor
+from sensors import startDoorSensor, startMotionSensor, getSensorStatus, \
+	restoreSensorStatus, isSensorReady, getFilterStats, readSensor, scheduleSensorTask
+from debounce import FilterProfile
 from gmail import intruderAlert
-from listeners import KeypadListener, PipeListener
+from listeners import KeypadListener
+from control import ControlServer
+from reactor import InputReactor
 from blinkenLights import Blinkenlights
-from soundLib import SoundLib
+from soundLib import SoundLib, PRIORITY_ALARM, PRIORITY_NORMAL
 from webInterface import startWebInterface
 from stream import Camera, FileDump
+from snapshot import Snapshot, loadSnapshot
+from correlation import CorrelationFilter
+from history import SensorHistory, heatmapBuckets
+from health import SensorHealth
+from audioLevel import LoudnessDetector, HISTORY_ID
+from profiling import profiler, markOrigin, getOrigin
 
 logger = logging.getLogger(__name__)
 
@@ -44,29 +57,92 @@ class _CountdownTimer(ExceptionThread):
 	'''
 	Launches thread which self terminates after some time (given in seconds).
 	Termination triggers some action (a function). Optionally, a sound can be
-	assigned to each 'tick'
+	assigned to each 'tick'. The time need not be whole; any fractional part is
+	slept off before the first tick (eg when resuming from a snapshot)
 	'''
 	def __init__(self, countdownSeconds, action, sound=None):
 		self._stopper = Event()
+		self._deadline = clock.monotonic() + countdownSeconds
 
 		def countdown():
-			for i in range(countdownSeconds, 0, -1):
+			ticks = math.ceil(countdownSeconds)
+			for i in range(ticks, 0, -1):
 				if self._stopper.isSet():
 					return None
-				if sound and i < countdownSeconds:
+				if sound and i < ticks:
 					sound.play()
-				time.sleep(1)
+				clock.sleep(1 if i < ticks else countdownSeconds - ticks + 1)
+			markOrigin('timer')
 			action()
 
 		super().__init__(target=countdown, daemon=True)
 		self.start()
 
+	def remaining(self):
+		return max(0, self._deadline - clock.monotonic())
+
 	def stop(self):
 		self._stopper.set()
 
 	def __del__(self):
 		self.stop()
 		
+class _RecordingHold:
+	'''
+	Keeps the recording going while there is motion in front of a video sensor.
+	Recording is held when motion starts and released holdoff seconds after it
+	stops, unless motion starts again in the meantime. Releases are scheduled
+	rather than waited for so no thread is tied up while motion lasts. Hold and
+	release are called from the sensor thread, so they only note the change;
+	starting and stopping the recording (which may block on the pipeline and
+	the gluster mount) is left to a worker of our own, in order
+	'''
+	def __init__(self, fileDump, holdoff):
+		self._fileDump = fileDump
+		self._holdoff = holdoff
+		self._lock = Lock()
+		self._held = set()
+		self._generation = {}
+		self._changes = queue.Queue()
+
+		def apply():
+			while 1:
+				change = self._changes.get()
+				if change is None:
+					break
+				change()
+
+		self._worker = ExceptionThread(target=apply, daemon=True)
+
+	def start(self):
+		self._worker.start()
+
+	def stop(self):
+		self._changes.put(None)
+
+	def hold(self, pin):
+		with self._lock:
+			# invalidate any pending release
+			self._generation[pin] = self._generation.get(pin, 0) + 1
+			if pin in self._held:
+				return
+			self._held.add(pin)
+		self._changes.put(partial(self._fileDump.addInitiator, pin))
+
+	def release(self, pin):
+		with self._lock:
+			if pin not in self._held:
+				return
+			generation = self._generation[pin]
+		scheduleSensorTask(self._holdoff, partial(self._expire, pin, generation))
+
+	def _expire(self, pin, generation):
+		with self._lock:
+			if pin not in self._held or self._generation[pin] != generation:
+				return
+			self._held.remove(pin)
+		self._changes.put(partial(self._fileDump.removeInitiator, pin))
+
 def _resetUSBDevice(device):
 	'''
 	Resets a USB device using the de/reauthorization method. This is really
@@ -79,6 +155,19 @@ def _resetUSBDevice(device):
 		f.write('1')
 	logger.debug('Reset USB device: %s', devpath)
 
+def _callbackName(c):
+	f = c.func if isinstance(c, partial) else c
+	return getattr(f, '__name__', repr(f))
+
+def _runCallbacks(callbacks, stage):
+	'''
+	Run each callback, recording how long each takes
+	'''
+	for c in callbacks:
+		start = time.perf_counter()
+		c()
+		profiler.record('callback.{}.{}'.format(stage, _callbackName(c)), time.perf_counter() - start)
+
 class _State:
 	'''
 	Represents one discrete status of the system. Each state has a set of entry
@@ -91,8 +180,9 @@ class _State:
 	name...try not to be an idiot. This mostly matters in equality tests, which
 	only compares the name
 	'''
-	def __init__(self, name, entryCallbacks=[], exitCallbacks=[], sound=None):
+	def __init__(self, name, entryCallbacks=[], exitCallbacks=[], sound=None, zone=None):
 		self.name = name
+		self.zone = zone
 		self.entryCallbacks = entryCallbacks
 		self.exitCallbacks = exitCallbacks
 		self._transTbl = {}
@@ -100,18 +190,18 @@ class _State:
 		self._sound = sound
 		
 	def entry(self):
-		logger.info('entering ' + self.name)
+		logger.info('entering ' + str(self))
 		if self._sound:
+			start = time.perf_counter()
 			self._sound.play()
-		for c in self.entryCallbacks:
-			c()
+			profiler.record('callback.entry.sound', time.perf_counter() - start)
+		_runCallbacks(self.entryCallbacks, 'entry')
 		
 	def exit(self):
-		logger.info('exiting ' + self.name)
+		logger.info('exiting ' + str(self))
 		if self._sound:
 			self._sound.stop()
-		for c in self.exitCallbacks:
-			c()
+		_runCallbacks(self.exitCallbacks, 'exit')
 
 	def next(self, signal):
 		if signal in _SIGNALS:
@@ -123,86 +213,289 @@ class _State:
 		self._transTbl[signal] = state
 	
 	def __str__(self):
-		return self.name
+		return self.name if self.zone is None else '{}@{}'.format(self.name, self.zone)
 	
 	def __eq__(self, other):
 		return self.name == other
 		
+# order of severity of states, used to derive the state of the house from the
+# state of each zone (the house is in the most severe state of any zone)
+_SEVERITY = ('disarmed', 'lockedCountdown', 'locked', 'armedCountdown', 'armed',
+	'trippedCountdown', 'tripped')
+
+# events that may have a phrase spoken (see tts.phrases in the config): a
+# sensor tripping a zone and a zone entering each state
+_PHRASE_EVENTS = ('trip',) + _SEVERITY
+_ALARM_STATES = ('trippedCountdown', 'tripped')
+
+def _linkStates(st):
+	'''
+	Builds the state network by linking states (a namedtuple) with signals
+	'''
+	st.disarmed.addTransition(			_SIGNALS.ARM, 			st.armedCountdown)
+	st.disarmed.addTransition(			_SIGNALS.INSTANT_ARM, 	st.armed)
+	st.disarmed.addTransition(			_SIGNALS.LOCK, 			st.lockedCountdown)
+	st.disarmed.addTransition(			_SIGNALS.INSTANT_LOCK, 	st.locked)
+	
+	st.armedCountdown.addTransition(	_SIGNALS.DISARM, 		st.disarmed)
+	st.armedCountdown.addTransition(	_SIGNALS.TIMOUT, 		st.armed)
+	st.armedCountdown.addTransition(	_SIGNALS.INSTANT_ARM, 	st.armed)
+	st.armedCountdown.addTransition(	_SIGNALS.LOCK, 			st.lockedCountdown)
+	st.armedCountdown.addTransition(	_SIGNALS.INSTANT_LOCK, 	st.locked)
+	
+	st.armed.addTransition(				_SIGNALS.DISARM, 		st.disarmed)
+	st.armed.addTransition(				_SIGNALS.TRIP, 			st.trippedCountdown)
+	st.armed.addTransition(				_SIGNALS.LOCK, 			st.lockedCountdown)
+	st.armed.addTransition(				_SIGNALS.INSTANT_LOCK,	st.locked)
+	
+	st.lockedCountdown.addTransition(	_SIGNALS.DISARM, 		st.disarmed)
+	st.lockedCountdown.addTransition(	_SIGNALS.TIMOUT, 		st.locked)
+	st.lockedCountdown.addTransition(	_SIGNALS.INSTANT_LOCK, 	st.locked)
+	st.lockedCountdown.addTransition(	_SIGNALS.ARM, 			st.armedCountdown)
+	st.lockedCountdown.addTransition(	_SIGNALS.INSTANT_ARM, 	st.armed)
+	
+	st.locked.addTransition(			_SIGNALS.DISARM, 		st.disarmed)
+	st.locked.addTransition(			_SIGNALS.TRIP, 			st.trippedCountdown)
+	st.locked.addTransition(			_SIGNALS.ARM, 			st.armedCountdown)
+	st.locked.addTransition(			_SIGNALS.INSTANT_ARM, 	st.armed)
+	
+	st.trippedCountdown.addTransition(	_SIGNALS.DISARM, 		st.disarmed)
+	st.trippedCountdown.addTransition(	_SIGNALS.TIMOUT, 		st.tripped)
+	st.trippedCountdown.addTransition(	_SIGNALS.ARM, 			st.armed)
+	st.trippedCountdown.addTransition(	_SIGNALS.INSTANT_ARM, 	st.armed)
+	st.trippedCountdown.addTransition(	_SIGNALS.LOCK, 			st.locked)
+	st.trippedCountdown.addTransition(	_SIGNALS.INSTANT_LOCK,	st.locked)
+	
+	st.tripped.addTransition(			_SIGNALS.DISARM, 		st.disarmed)
+	st.tripped.addTransition(			_SIGNALS.ARM, 			st.armed)
+	st.tripped.addTransition(			_SIGNALS.INSTANT_ARM, 	st.armed)
+	st.tripped.addTransition(			_SIGNALS.LOCK, 			st.locked)
+	st.tripped.addTransition(			_SIGNALS.INSTANT_LOCK,	st.locked)
+
+class _Zone:
+	'''
+	One independently armable partition of the house. Each zone has its own copy
+	of the state network, its own lock and its own countdown timer, so sensors in
+	different zones never contend with each other. The zone only knows about
+	countdowns; everything the user sees or hears (sounds, LED, alerts) is tied to
+	the house-level state in StateMachine, which is notified of every transition
+	via onTransition. Note this is called after the zone lock is released so that
+	the zone lock is never held while waiting on the house lock
+	
+	Sensor hits must also be confirmed by the zone's correlation filter before
+	they result in a TRIP (see correlation.py)
+	'''
+	def __init__(self, name, initialState, onTransition, soundEffects,
+		resumeCountdown=None, tripRules=None):
+		self.name = name
+		self.correlation = CorrelationFilter(tripRules)
+		self._lock = Lock()
+		self._timer = None
+		self._resumeCountdown = resumeCountdown
+		self._onTransition = onTransition
+		
+		for sig in _SIGNALS:
+			setattr(self, sig.name, partial(self.selectState, sig))
+		
+		def countdownState(name):
+			return _State(
+				name = name,
+				entryCallbacks = [partial(self._startTimer, 30, soundEffects[name])],
+				exitCallbacks = [self._stopTimer],
+				zone = self.name
+			)
+			
+		stateObjs = [
+			_State(
+				name = 'disarmed',
+				entryCallbacks = [self.correlation.clear],
+				zone = self.name
+			),
+			countdownState('armedCountdown'),
+			_State(name = 'armed', zone = self.name),
+			countdownState('lockedCountdown'),
+			_State(name = 'locked', zone = self.name),
+			countdownState('trippedCountdown'),
+			_State(name = 'tripped', zone = self.name)
+		]
+		
+		self.states = namedtuple('States', [obj.name for obj in stateObjs])(*stateObjs)
+		_linkStates(self.states)
+		
+		self.currentState = getattr(self.states, initialState)
+		
+	def selectState(self, signal):
+		t0 = time.perf_counter()
+		with self._lock:
+			t1 = time.perf_counter()
+			lastState = self.currentState
+			nextState = lastState.next(signal)
+			t2 = time.perf_counter()
+			if nextState != lastState:
+				lastState.exit()
+				t3 = time.perf_counter()
+				self.currentState = nextState
+				nextState.entry()
+				t4 = time.perf_counter()
+				
+		if nextState != lastState:
+			self._onTransition(self, lastState, nextState, signal)
+			
+		end = time.perf_counter()
+		
+		profiler.record('zone.lockWait', t1 - t0)
+		profiler.record('zone.next', t2 - t1)
+		if nextState != lastState:
+			profiler.record('zone.exit', t3 - t2)
+			profiler.record('zone.entry', t4 - t3)
+			
+		origin = getOrigin()
+		if origin:
+			kind, t = origin
+			profiler.record('origin.{}.toLock'.format(kind), t1 - t)
+			if nextState != lastState:
+				profiler.record('origin.{}.toTransition'.format(kind), end - t)
+			
+	def countdownRemaining(self):
+		timer = self._timer
+		return round(timer.remaining(), 1) if timer and timer.is_alive() else None
+		
+	def _startTimer(self, t, sound):
+		# resume a countdown that was interrupted by a crash (only once)
+		if self._resumeCountdown is not None:
+			t, self._resumeCountdown = self._resumeCountdown, None
+			logger.info('Resuming countdown in zone %s with %.1fs remaining', self.name, t)
+		self._timer = _CountdownTimer(t, self.TIMOUT, sound)
+		
+	def _stopTimer(self):
+		if self._timer and self._timer.is_alive():
+			self._timer.stop()
+			self._timer = None
+		
 class StateMachine:
 	'''
 	Manager for states. This is intended to be used as a context manager (eg
 	"with" statement) for brevity...and because there should only be one.
-	
+
 	Init is responsible for setting up all objects (including child threads) as
 	well as contructing the state network. Each thread functions as some kind of
 	listener (or supports one) that wait for an event to happen.
-	
+
 	Note we distinguish between "managed" and "non-managed" objects; the former
 	need to be started/stopped to ensure things get cleaned. Managed objects are
-	added to the managed list with _addManaged, which also returns a ref to the 
+	added to the managed list with _addManaged, which also returns a ref to the
 	object for other uses.
-	
+
 	Upon opening the context, all threads are started. Note that not all threads
 	are managed; some are started and forgotten, as these require no cleanup.
 	Managed threads are started with _startManaged and stopped with _stopManaged
 	upon closing the context. This system has the added benefit of not trying to
 	stop an object that has not been initialized, as it cannot appear in the
 	managed list otherwise
-	
+
 	During steady-state operation, the receiver for signals that make things
 	happen is selectState, intended to be called from any of the state machine's
-	child threads. This calls the current state's "next" method and sets the
-	result as the new current state. Note the lock because it could be called by
-	any number of listeners simultaneously
+	child threads. Signals go to one zone (eg sensors) or to all zones (eg the
+	keypad). Each zone calls its current state's "next" method under its own
+	lock and sets the result as its new current state. The house-level state
+	(currentState) is then derived from the zones; it is the most severe state
+	of any zone and is what drives sounds, the LED and alerts. Zones are defined
+	in the config as a mapping of zone names to sensor names; if absent the
+	whole house is one zone
+
+	Sensors are declared in the config (see _loadSensors), falling back to the
+	ones originally installed in the house
+
+	The runtime state (countdowns, recordings, sensors) is periodically saved to
+	a snapshot. If a snapshot from the current boot exists on init we resume
+	from it rather than performing a cold start
 	'''
+	# sensors used if none are configured (same format as the config)
+	_defaultSensors = OrderedDict([
+		('Nate\'s room', {'pin': 5, 'type': 'motion'}),
+		('front door', {'pin': 19, 'type': 'motion'}),
+		('Laura\'s room', {'pin': 26, 'type': 'motion'}),
+		('deck window', {'pin': 6, 'type': 'motion', 'video': True}),
+		('kitchen bar', {'pin': 13, 'type': 'motion', 'video': True}),
+		('door', {'pin': 22, 'type': 'door'})
+	])
+
 	def __init__(self):
-		self._lock = Lock()
+		# reentrant since zone transitions are reported back to us while we may
+		# be holding the lock (eg when signalling all zones)
+		self._lock = RLock()
 		self._managed = []
-		
+		self._transitionListeners = []
+		self._deferAggregate = False
+		self._snapshot = loadSnapshot()
+		self._loadSensors()
+		self.history = SensorHistory(_SEVERITY, configFile.get('historySize', 65536))
+
 		self.soundLib = self._addManaged(SoundLib())
 		self.fileDump = self._addManaged(FileDump())
-		
-		self._addManaged(Camera())
-		
+
+		# the audio sensor listens through the camera's microphone
+		self.loudness = None
+		cameraConf = {'gate': configFile.get('audioGate')}
+		if self._audioSensor:
+			conf = self._audioSensor[1]
+			# the microphone also hears our own speaker
+			self.loudness = LoudnessDetector.fromConfig(conf, playing=self.soundLib.playing)
+			cameraConf.update(levelHandler=self.loudness.feed, levelInterval=conf.get('interval', 0.05))
+		self.camera = self._addManaged(Camera(**cameraConf))
+
 		# add signals to self to avoid calling partial every time
 		for sig in _SIGNALS:
 			setattr(self, sig.name, partial(self.selectState, sig))
 
-		secretTable = {secret: getattr(self, signal) for signal, secret in configFile['secretTable'].items()}
-		
-		def secretCallback(secret, logger):
-			if secret in secretTable:
-				secretTable[secret]()
-				logger.debug('Secret pipe listener received: \"%s\"', secret)
-			elif logger:
-				logger.debug('Secret pipe listener received invalid secret')
-	
-		self._addManaged(PipeListener(callback=secretCallback, name='secret'))
+		self._initZones()
+		self.soundLib.setPhraseFields(zone=list(self.zones),
+			location=list(self._motionSensors) + list(self._doorSensors))
+		for event in self.soundLib.phraseEvents():
+			if event not in _PHRASE_EVENTS:
+				logger.warning('Phrase for unknown event "%s" will never be spoken (known: %s)',
+					event, ', '.join(_PHRASE_EVENTS))
+
+		secretTable = {secret: _SIGNALS[signal] for signal, secret in configFile['secretTable'].items()}
+
+		# secrets may optionally be followed by a zone name (eg "secret zone").
+		# "state" merely asks for the current state
+		def controlCommand(msg):
+			secret, _, zone = msg.partition(' ')
+			if secret == 'state':
+				return dict(ok=True, **self.status())
+			if secret not in secretTable:
+				logger.debug('Control server received invalid secret')
+				return {'ok': False, 'error': 'invalid secret'}
+			if zone and zone not in self.zones:
+				return {'ok': False, 'error': 'unknown zone: ' + zone}
+			logger.debug('Control server received: \"%s\"', msg)
+			self.selectState(secretTable[secret], zone or None)
+			return dict(ok=True, **self.status())
+
+		# all user input is read on one thread
+		self.reactor = self._addManaged(InputReactor())
+
+		self._addManaged(ControlServer(configFile.get('controlSocket', '/tmp/pyledriver.sock'),
+			controlCommand, self.reactor))
+
+		self._addManaged(KeypadListener(stateMachine=self, passwd=configFile['keyPasswd'],
+			reactor=self.reactor))
 
-		self._addManaged(KeypadListener(stateMachine=self, passwd=configFile['keyPasswd']))
-		
-		def startTimer(t, sound):
-			self._timer = _CountdownTimer(t, self.TIMOUT, sound)
-			
-		def stopTimer():
-			if self._timer.is_alive():
-				self._timer.stop()
-				self._timer = None
-				
 		sfx = self.soundLib.soundEffects
-				
+
 		LED = self._addManaged(Blinkenlights(17))
-		
+
 		def squareBlink(t):
 			LED.setBlink(True)
 			LED.setTriangle(False)
 			LED.setCyclePeriod(t)
-			
+
 		def triangleBlink(t):
 			LED.setBlink(True)
 			LED.setTriangle(True)
 			LED.setCyclePeriod(t)
-			
+
 		stateObjs = [
 			_State(
 				name = 'disarmed',
@@ -211,8 +504,7 @@ class StateMachine:
 			),
 			_State(
 				name = 'armedCountdown',
-				entryCallbacks = [partial(squareBlink, 1), partial(startTimer, 30, sfx['armedCountdown'])],
-				exitCallbacks = [stopTimer],
+				entryCallbacks = [partial(squareBlink, 1)],
 				sound = sfx['armedCountdown']
 			),
 			_State(
@@ -222,8 +514,7 @@ class StateMachine:
 			),
 			_State(
 				name = 'lockedCountdown',
-				entryCallbacks = [partial(squareBlink, 1), partial(startTimer, 30, sfx['lockedCountdown'])],
-				exitCallbacks = [stopTimer],
+				entryCallbacks = [partial(squareBlink, 1)],
 				sound = sfx['lockedCountdown']
 			),
 			_State(
@@ -233,8 +524,7 @@ class StateMachine:
 			),
 			_State(
 				name = 'trippedCountdown',
-				entryCallbacks = [partial(squareBlink, 1), partial(startTimer, 30, sfx['trippedCountdown'])],
-				exitCallbacks = [stopTimer],
+				entryCallbacks = [partial(squareBlink, 1)],
 				sound = sfx['trippedCountdown']
 			),
 			_State(
@@ -243,121 +533,353 @@ class StateMachine:
 				sound = sfx['tripped']
 			)
 		]
-		
-		self.states = st = namedtuple('States', [obj.name for obj in stateObjs])(*stateObjs)
 
-		st.disarmed.addTransition(			_SIGNALS.ARM, 			st.armedCountdown)
-		st.disarmed.addTransition(			_SIGNALS.INSTANT_ARM, 	st.armed)
-		st.disarmed.addTransition(			_SIGNALS.LOCK, 			st.lockedCountdown)
-		st.disarmed.addTransition(			_SIGNALS.INSTANT_LOCK, 	st.locked)
-		
-		st.armedCountdown.addTransition(	_SIGNALS.DISARM, 		st.disarmed)
-		st.armedCountdown.addTransition(	_SIGNALS.TIMOUT, 		st.armed)
-		st.armedCountdown.addTransition(	_SIGNALS.INSTANT_ARM, 	st.armed)
-		st.armedCountdown.addTransition(	_SIGNALS.LOCK, 			st.lockedCountdown)
-		st.armedCountdown.addTransition(	_SIGNALS.INSTANT_LOCK, 	st.locked)
-		
-		st.armed.addTransition(				_SIGNALS.DISARM, 		st.disarmed)
-		st.armed.addTransition(				_SIGNALS.TRIP, 			st.trippedCountdown)
-		st.armed.addTransition(				_SIGNALS.LOCK, 			st.lockedCountdown)
-		st.armed.addTransition(				_SIGNALS.INSTANT_LOCK,	st.locked)
-		
-		st.lockedCountdown.addTransition(	_SIGNALS.DISARM, 		st.disarmed)
-		st.lockedCountdown.addTransition(	_SIGNALS.TIMOUT, 		st.locked)
-		st.lockedCountdown.addTransition(	_SIGNALS.INSTANT_LOCK, 	st.locked)
-		st.lockedCountdown.addTransition(	_SIGNALS.ARM, 			st.armedCountdown)
-		st.lockedCountdown.addTransition(	_SIGNALS.INSTANT_ARM, 	st.armed)
-		
-		st.locked.addTransition(			_SIGNALS.DISARM, 		st.disarmed)
-		st.locked.addTransition(			_SIGNALS.TRIP, 			st.trippedCountdown)
-		st.locked.addTransition(			_SIGNALS.ARM, 			st.armedCountdown)
-		st.locked.addTransition(			_SIGNALS.INSTANT_ARM, 	st.armed)
-		
-		st.trippedCountdown.addTransition(	_SIGNALS.DISARM, 		st.disarmed)
-		st.trippedCountdown.addTransition(	_SIGNALS.TIMOUT, 		st.tripped)
-		st.trippedCountdown.addTransition(	_SIGNALS.ARM, 			st.armed)
-		st.trippedCountdown.addTransition(	_SIGNALS.INSTANT_ARM, 	st.armed)
-		st.trippedCountdown.addTransition(	_SIGNALS.LOCK, 			st.locked)
-		st.trippedCountdown.addTransition(	_SIGNALS.INSTANT_LOCK,	st.locked)
-		
-		st.tripped.addTransition(			_SIGNALS.DISARM, 		st.disarmed)
-		st.tripped.addTransition(			_SIGNALS.ARM, 			st.armed)
-		st.tripped.addTransition(			_SIGNALS.INSTANT_ARM, 	st.armed)
-		st.tripped.addTransition(			_SIGNALS.LOCK, 			st.locked)
-		st.tripped.addTransition(			_SIGNALS.INSTANT_LOCK,	st.locked)
-		
-		self.currentState = getattr(self.states, stateFile['state'])
-		
+		# house-level states are not linked; they are derived from the zones
+		self.states = namedtuple('States', [obj.name for obj in stateObjs])(*stateObjs)
+
+		self.currentState = self._aggregateState()
+
+		def snapshotProvider():
+			return {
+				'state': self.currentState.name,
+				'zones': {name: z.currentState.name for name, z in self.zones.items()},
+				'countdown': {name: z.countdownRemaining() for name, z in self.zones.items()},
+				'recording': self.fileDump.initiators,
+				'sensors': getSensorStatus()
+			}
+
+		self._addManaged(Snapshot()).addProvider(snapshotProvider)
+
+		sensorTypes = {name: (pin, 'motion') for name, pin in self._motionSensors.items()}
+		sensorTypes.update({name: (pin, 'door') for name, pin in self._doorSensors.items()})
+		self.health = self._addManaged(SensorHealth(sensorTypes, configFile.get('sensorHealth')))
+
+	def _loadSensors(self):
+		'''
+		Reads the sensors from the config, a mapping of names to a pin and
+		type (motion or door). Motion sensors in front of the camera should
+		also have video set to record while there is motion. There may also be
+		one audio sensor (the camera microphone, see audioLevel.py), which has
+		no pin but takes detection thresholds instead
+		'''
+		sensorConf = configFile.get('sensors') or self._defaultSensors
+
+		self._motionSensors = OrderedDict()
+		self._doorSensors = OrderedDict()
+		self._audioSensor = None
+		videoSensors = []
+		pins = set()
+
+		for name, conf in sensorConf.items():
+			pin, sensorType = conf.get('pin'), conf.get('type')
+			if sensorType == 'audio':
+				if self._audioSensor:
+					logger.error('Only one audio sensor is supported. Check configuration')
+					raise SystemExit
+				self._audioSensor = (name, conf)
+				continue
+			if not isinstance(pin, int) or pin in pins:
+				logger.error('Sensor \"%s\" needs a unique pin. Check configuration', name)
+				raise SystemExit
+			pins.add(pin)
+
+			if sensorType == 'motion':
+				self._motionSensors[name] = pin
+				if conf.get('video'):
+					videoSensors.append(name)
+			elif sensorType == 'door':
+				self._doorSensors[name] = pin
+			else:
+				logger.error('Sensor \"%s\" has unknown type \"%s\". Check configuration', name, sensorType)
+				raise SystemExit
+
+		self._videoSensors = tuple(videoSensors)
+
+	def _initZones(self):
+		allSensors = list(self._motionSensors) + list(self._doorSensors)
+		if self._audioSensor:
+			allSensors.append(self._audioSensor[0])
+		zoneConf = configFile.get('zones') or {'house': allSensors}
+
+		self._sensorZones = {}
+		for zone, sensors in zoneConf.items():
+			for sensor in sensors:
+				if sensor not in allSensors:
+					logger.error('Unknown sensor \"%s\" in zone %s. Check configuration', sensor, zone)
+					raise SystemExit
+				if sensor in self._sensorZones:
+					logger.error('Sensor \"%s\" is in more than one zone. Check configuration', sensor)
+					raise SystemExit
+				self._sensorZones[sensor] = zone
+
+		for sensor in allSensors:
+			if sensor not in self._sensorZones:
+				logger.error('Sensor \"%s\" is not in any zone. Check configuration', sensor)
+				raise SystemExit
+
+		savedStates = stateFile.get('zones') or {}
+		snap = self._snapshot
+
+		self.zones = OrderedDict()
+		for name in zoneConf:
+			initialState = savedStates.get(name, stateFile['state'])
+
+			# resume a countdown from a snapshot if the zone is still counting down
+			resumeCountdown = None
+			if snap and snap.get('zones', {}).get(name) == initialState:
+				remaining = snap.get('countdown', {}).get(name)
+				if remaining is not None:
+					resumeCountdown = max(0, remaining - (time.time() - snap['time']))
+
+			self.zones[name] = _Zone(name, initialState, self._zoneTransition,
+				self.soundLib.soundEffects, resumeCountdown, configFile.get('tripRules'))
+
 	def __enter__(self):
-		_resetUSBDevice('1-1')
-		
+		# after a crash (ie resuming from a snapshot taken during this boot) the
+		# camera is still there; resetting it would only make us wait for it
+		if not self._snapshot:
+			_resetUSBDevice('1-1')
+
 		# start all managed threads (we retain ref to these to stop them later)
-		self._startManaged()
-		
+		# but the camera, which may wait a long time for its device to come
+		# back, so it is only started once the sensors are up
+		self._startManaged(exclude=[self.camera])
+
 		activeSensorStates = (self.states.armed, self.states.trippedCountdown, self.states.tripped)
-		
-		def sensorAction(location, logger):
-			cst = self.currentState
+
+		def trip(zone, location):
+			zone.selectState(_SIGNALS.TRIP)
+			self.soundLib.announce('trip', PRIORITY_ALARM, zone=zone.name, location=location)
+
+		def sensorAction(zone, location, logger, pin):
+			cst = zone.currentState
 			level = logging.INFO if cst in activeSensorStates else logging.DEBUG
 			logger.log(level, 'detected motion: ' + location)
-			if cst == self.states.armed:
-				self.selectState(_SIGNALS.TRIP)
-
-		def videoAction(location, logger, pin):
-			sensorAction(location, logger)
-			cst = self.currentState
-			if cst in activeSensorStates:
-				self.fileDump.addInitiator(pin)
-				while GPIO.input(pin) and cst in activeSensorStates:
-					time.sleep(0.1)
-				self.fileDump.removeInitiator(pin)
-				
+			if cst == self.states.armed and zone.correlation.hit(location):
+				trip(zone, location)
+			self.history.record(pin, 'motion', cst.name, zone.currentState != cst)
+
+		def soundAction(zone, location):
+			cst = zone.currentState
+			level = logging.INFO if cst in activeSensorStates else logging.DEBUG
+			logger.log(level, 'detected loud sound: ' + location)
+			if cst == self.states.armed and zone.correlation.hit(location):
+				trip(zone, location)
+			self.history.record(HISTORY_ID, 'sound', cst.name, zone.currentState != cst)
+
+		def sensorRelease(zone, location, logger, pin):
+			self.history.record(pin, 'motionEnd', zone.currentState.name)
+
+		recording = self._recording = _RecordingHold(self.fileDump, configFile.get('recordingHoldoff', 2))
+		recording.start()
+
+		def videoAction(zone, location, logger, pin):
+			sensorAction(zone, location, logger, pin)
+			if zone.currentState in activeSensorStates:
+				recording.hold(pin)
+
+		def videoRelease(zone, location, logger, pin):
+			sensorRelease(zone, location, logger, pin)
+			recording.release(pin)
+
 		activeDoorStates = activeSensorStates + (self.states.locked,)
 
-		def doorAction(closed, logger):
+		def doorAction(zone, location, pin, closed, logger):
 			self.soundLib.soundEffects['door'].play()
-			cst = self.currentState
+			cst = zone.currentState
 			level = logging.INFO if cst in activeDoorStates else logging.DEBUG
-			entry = 'door closed' if closed else 'door opened'
+			entry = ('door closed: ' if closed else 'door opened: ') + location
 			logger.log(level, entry)
-			if not closed and cst == self.states.armed or cst == self.states.locked:
-				self.selectState(_SIGNALS.TRIP)
+			if (not closed and cst == self.states.armed or cst == self.states.locked) \
+				and zone.correlation.hit(location):
+				trip(zone, location)
+			self.history.record(pin, 'doorClosed' if closed else 'doorOpened', cst.name,
+				zone.currentState != cst)
 
-		# start non-managed threads (we forget about these because they can exit with no cleanup)
-		startMotionSensor(5, 'Nate\'s room', sensorAction)
-		startMotionSensor(19, 'front door', sensorAction)
-		startMotionSensor(26, 'Laura\'s room', sensorAction)
-		
-		startMotionSensor(6, 'deck window', partial(videoAction, pin=6))
-		startMotionSensor(13, 'kitchen bar', partial(videoAction, pin=13))
-		
-		startDoorSensor(22, doorAction)
+		if self._snapshot:
+			restoreSensorStatus(self._snapshot.get('sensors', {}))
+
+		# per-sensor filter profiles, falling back to 'default' and then to the
+		# built-in defaults
+		filterConf = configFile.get('sensorFilters') or {}
 		
+		def profile(name):
+			return FilterProfile.fromConfig(filterConf.get(name, filterConf.get('default')))
+
+		# start non-managed threads (we forget about these because they can exit with no cleanup)
+		for location, pin in self._motionSensors.items():
+			zone = self.zones[self._sensorZones[location]]
+			if location in self._videoSensors:
+				startMotionSensor(pin, location, partial(videoAction, zone, pin=pin), profile(location),
+					release=partial(videoRelease, zone, pin=pin))
+			else:
+				startMotionSensor(pin, location, partial(sensorAction, zone, pin=pin), profile(location),
+					release=partial(sensorRelease, zone, pin=pin))
+
+		doorReplays = []
+		for location, pin in self._doorSensors.items():
+			zone = self.zones[self._sensorZones[location]]
+			replay = startDoorSensor(pin, location, partial(doorAction, zone, location, pin), profile(location))
+			if replay:
+				doorReplays.append(replay)
+
+		if self._audioSensor:
+			location = self._audioSensor[0]
+			self.loudness.action = partial(soundAction, self.zones[self._sensorZones[location]], location)
+
 		startWebInterface(self)
-		
+
+		for zone in self.zones.values():
+			zone.currentState.entry()
 		self.currentState.entry()
 
+		# doors that changed while we were down are acted on only now, so their
+		# transitions start from states that have been entered (and entered once)
+		for replay in doorReplays:
+			replay()
+
+		# pick up recordings that were in progress when we went down, provided
+		# there is still motion in front of the sensor
+		if self._snapshot:
+			pinZones = {pin: self.zones[self._sensorZones[l]] for l, pin in self._motionSensors.items()}
+			for pin in self._snapshot.get('recording', []):
+				cst = pinZones[pin].currentState
+				if cst in activeSensorStates and isSensorReady(pin) and readSensor(pin):
+					logger.info('Resuming recording initiated by pin %s', pin)
+					recording.hold(pin)
+
+		self.camera.start()
+
 	def __exit__(self, exception_type, exception_value, traceback):
+		self._recording.stop()
 		self._stopManaged()
 
-	def selectState(self, signal):
+	def selectState(self, signal, zone=None):
+		'''
+		Send signal to one zone (given by name) or to all zones if zone is None.
+		In the latter case the house-level state is only updated once all zones
+		have transitioned, so intermediate states are never seen (or heard)
+		'''
+		if zone is not None:
+			self.zones[zone].selectState(signal)
+			return
+
+		start = time.perf_counter()
 		with self._lock:
-			nextState = self.currentState.next(signal)
+			profiler.record('house.lockWait', time.perf_counter() - start)
+			self._deferAggregate = True
+			try:
+				for z in self.zones.values():
+					z.selectState(signal)
+			finally:
+				self._deferAggregate = False
+			self._updateAggregate(signal)
+
+	def _zoneTransition(self, zone, lastState, nextState, signal):
+		start = time.perf_counter()
+		with self._lock:
+			profiler.record('house.lockWait', time.perf_counter() - start)
+			stateFile['zones'] = {name: z.currentState.name for name, z in self.zones.items()}
+			if not self._deferAggregate:
+				self._updateAggregate(signal)
+		priority = PRIORITY_ALARM if nextState.name in _ALARM_STATES else PRIORITY_NORMAL
+		self.soundLib.announce(nextState.name, priority, zone=zone.name)
+
+	def _aggregateState(self):
+		name = max((z.currentState.name for z in self.zones.values()), key=_SEVERITY.index)
+		return getattr(self.states, name)
+
+	def _updateAggregate(self, signal):
+		with self._lock:
+			nextState = self._aggregateState()
 			if nextState != self.currentState:
+				lastState = self.currentState
+				t0 = time.perf_counter()
 				self.currentState.exit()
+				t1 = time.perf_counter()
 				self.currentState = nextState
 				self.currentState.entry()
-			
+				t2 = time.perf_counter()
+				profiler.record('house.exit', t1 - t0)
+				profiler.record('house.entry', t2 - t1)
+				for listener in self._transitionListeners:
+					listener(lastState, nextState, signal)
+
 			stateFile['state'] = self.currentState.name
-			
+
+	def status(self):
+		return {
+			'state': self.currentState.name,
+			'zones': {name: z.currentState.name for name, z in self.zones.items()}
+		}
+
+	def sensorStats(self):
+		return {'status': getSensorStatus(), 'filters': getFilterStats(),
+			'audio': self.loudness.stats() if self.loudness else None}
+
+	def sensorHealth(self):
+		return self.health.metrics
+
+	def audioStats(self):
+		gate = getattr(self.camera, 'gate', None)
+		return dict(self.soundLib.memoryStats(), channels=self.soundLib.scheduler.stats(),
+			encoder=gate.stats() if gate else None)
+
+	def ttsStats(self):
+		return dict(self.soundLib.speechStats(), cache=self.soundLib.ttsCache.stats())
+
+	def correlationStats(self):
+		return {name: z.correlation.stats() for name, z in self.zones.items()}
+
+	def _sensorPins(self):
+		pins = OrderedDict(list(self._motionSensors.items()) + list(self._doorSensors.items()))
+		if self._audioSensor:
+			pins[self._audioSensor[0]] = HISTORY_ID
+		return pins
+
+	def sensorHistory(self, start=None, end=None, sensors=None, limit=None):
+		'''
+		Sensor events between start and end (epoch seconds), optionally only
+		for the named sensors
+		'''
+		pins = self._sensorPins()
+		names = {pin: name for name, pin in pins.items()}
+		events = self.history.query(start, end, sensors and {pins[s] for s in sensors if s in pins}, limit)
+		for e in events:
+			e['sensor'] = names.get(e['pin'])
+		return events
+
+	def sensorAggregates(self, start=None, end=None):
+		names = {pin: name for name, pin in self._sensorPins().items()}
+		return {names.get(pin, pin): agg for pin, agg in self.history.aggregates(start, end).items()}
+
+	def sensorHeatmap(self, start, end, bucket=3600):
+		pins = self._sensorPins()
+		heatmap = self.history.heatmap(start, end, bucket)
+		nBuckets = heatmapBuckets(start, end, bucket)
+		return {
+			'start': start,
+			'bucket': bucket,
+			'sensors': {name: heatmap.get(pin, [0] * nBuckets) for name, pin in pins.items()}
+		}
+
+	def addTransitionListener(self, listener):
+		'''
+		Registers a function to be called as listener(lastState, nextState,
+		signal) after every transition of the house-level state. Note this is
+		called with the lock held
+		'''
+		self._transitionListeners.append(listener)
+
 	def _addManaged(self, obj):
 		self._managed.append(obj)
 		return obj
 
-	def _startManaged(self):
+	def _startManaged(self, exclude=()):
 		for m in self._managed:
-			m.start()
-	
+			if m not in exclude:
+				m.start()
+
 	def _stopManaged(self):
 		for m in self._managed:
 			m.stop()
@@ -17,8 +17,9 @@ from datetime import datetime
 from threading import Lock, Event
 
 from auxilary import waitForPath, mkdirSafe
-from exceptionThreading import async
+from exceptionThreading import threaded
 from sharedLogging import gluster
+from audioLevel import SilenceGate
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
@@ -61,11 +62,13 @@ def _linkElements(e1, e2, caps=None):
 class ThreadedPipeline:
 	'''
 	Launches a Gst Pipeline in a separate thread. Note that the 'threaded'
-	aspect is impimented via and async decorator around the mainLoop below
+	aspect is impimented via a threaded decorator around the mainLoop below
 	'''
 	def __init__(self, pName):
 		self._pipeline = Gst.Pipeline.new(pName)
 		self._stopper = Event()
+		# element messages (eg from level) are passed to these by structure name
+		self._elementHandlers = {}
 		
 	def start(self, play=True):
 		pName = self._pipeline.get_name()
@@ -278,12 +281,17 @@ class ThreadedPipeline:
 				)
 					
 			elif msgType == Gst.MessageType.ELEMENT:
-				_gstPrintMsg(pName, 'Unknown message ELEMENT', sName=msgSrcName)
+				structure = msg.get_structure()
+				handler = structure and self._elementHandlers.get(structure.get_name())
+				if handler:
+					handler(structure)
+				else:
+					_gstPrintMsg(pName, 'Unknown message ELEMENT', sName=msgSrcName)
 
 			elif msgType == Gst.MessageType.UNKNOWN:
 				_gstPrintMsg(pName, 'Unknown message', sName=msgSrcName)
 		
-	@async(daemon=True)
+	@threaded(daemon=True)
 	def _mainLoop(self):
 		self._eventLoop(block=True, doProgress=False, targetState=Gst.State.PLAYING)
 
@@ -298,12 +306,21 @@ class Camera(ThreadedPipeline):
 	send their stream to two UDP ports (900X for video, 800X for audio, where 
 	X = 1 is used by the Janus WebRTC interface and X = 2 is used by the
 	FileDump class below.
+
+	If levelHandler is given it is called as levelHandler(rms, peak) with the
+	levels (in dBFS, of the loudest channel) of every levelInterval seconds of
+	audio, as measured by a level element in front of the encoder. If gate is
+	given (a dict of SilenceGate settings) the same levels are used to encode
+	silence at lower complexity. The level element passes audio through
+	untouched, so measuring costs next to nothing
 	'''
 	_vPath = '/dev/video0'
 	_aPath = 'hw:1,0'
 	
-	def __init__(self, video=True, audio=True):
+	def __init__(self, video=True, audio=True, levelHandler=None, levelInterval=0.05, gate=None):
 		super().__init__('camera')
+		self._levelHandler = levelHandler
+		self.gate = None
 		
 		if video:
 			vSource = Gst.ElementFactory.make("v4l2src", "videoSource")
@@ -347,9 +364,32 @@ class Camera(ThreadedPipeline):
 
 			_linkElements(aSource, aConvert)
 			_linkElements(aConvert, aScale)
-			_linkElements(aScale, aEncode, aCaps)
+
+			if levelHandler or gate is not None:
+				aLevel = Gst.ElementFactory.make("level", "audioLevel")
+				aLevel.set_property('interval', int(levelInterval * Gst.SECOND))
+				aLevel.set_property('post-messages', True)
+
+				self._pipeline.add(aLevel)
+
+				_linkElements(aScale, aLevel, aCaps)
+				_linkElements(aLevel, aEncode)
+
+				if gate is not None:
+					self.gate = SilenceGate.fromConfig(aEncode, levelInterval, gate)
+				self._elementHandlers['level'] = self._onLevel
+			else:
+				_linkElements(aScale, aEncode, aCaps)
+
 			_linkElements(aEncode, aRTPPay)
 			_linkElements(aRTPPay, aRTPSink)
+
+	def _onLevel(self, structure):
+		rms, peak = max(structure.get_value('rms')), max(structure.get_value('peak'))
+		if self.gate:
+			self.gate.feed(rms, peak)
+		if self._levelHandler:
+			self._levelHandler(rms, peak)
 			
 	def start(self):
 		# video is on usb, so wait until it comes back after we hard reset the bus
@@ -427,6 +467,11 @@ class FileDump(ThreadedPipeline):
 		ThreadedPipeline.start(self, play=False)
 		self._pipeline.post_message(Gst.Message.new_request_state(self._pipeline, Gst.State.NULL))
 		
+	@property
+	def initiators(self):
+		with self._lock:
+			return list(self._initiators)
+		
 	def addInitiator(self, identifier):
 		with self._lock:
 			if identifier in self._initiators:
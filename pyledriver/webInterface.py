@@ -1,11 +1,13 @@
-import logging
+import logging, time
 from subprocess import check_output, CalledProcessError, run, PIPE
-from flask import Flask, render_template, Response, Blueprint, redirect, url_for
+from flask import Flask, render_template, Response, Blueprint, redirect, url_for, jsonify, request
 from flask_wtf import FlaskForm
 from wtforms.fields import StringField, SubmitField
 from wtforms.validators import InputRequired
 
-from exceptionThreading import async
+from exceptionThreading import threaded
+from config import configFile
+from profiling import profiler
 
 logger = logging.getLogger(__name__)
 
@@ -31,7 +33,7 @@ def janusRunning():
 	else:
 		return True
 
-@async(daemon=True)
+@threaded(daemon=True)
 def startWebInterface(stateMachine):
 	siteRoot = Blueprint('siteRoot', __name__, static_folder='static', static_url_path='')
 
@@ -53,10 +55,66 @@ def startWebInterface(stateMachine):
 			'index.html',
 			ttsForm=ttsForm,
 			state=stateMachine.currentState,
+			zones=stateMachine.zones,
+			unhealthySensors=stateMachine.health.flagged(),
 			janusRunning=janusRunning(),
 			janusRestart=janusRestart
 		)
 		
+	@siteRoot.route('/stats/profile')
+	def profileStats():
+		return jsonify(profiler.summary())
+		
+	@siteRoot.route('/stats/profile/dump')
+	def profileDump():
+		path = configFile.get('profileDumpPath', '/tmp/pyledriver-profile.yaml')
+		profiler.dump(path)
+		logger.info('Dumped profile to %s', path)
+		return jsonify({'path': path})
+		
+	@siteRoot.route('/stats/sensors')
+	def sensorStats():
+		return jsonify(stateMachine.sensorStats())
+		
+	@siteRoot.route('/stats/health')
+	def healthStats():
+		return jsonify(stateMachine.sensorHealth())
+		
+	@siteRoot.route('/stats/audio')
+	def audioStats():
+		return jsonify(stateMachine.audioStats())
+		
+	@siteRoot.route('/stats/tts')
+	def ttsStats():
+		return jsonify(stateMachine.ttsStats())
+		
+	@siteRoot.route('/stats/correlation')
+	def correlationStats():
+		return jsonify(stateMachine.correlationStats())
+		
+	# history queries take start/end as epoch seconds; heatmaps default to
+	# the last day in hourly buckets
+	@siteRoot.route('/history')
+	def history():
+		sensors = request.args.getlist('sensor') or None
+		return jsonify(stateMachine.sensorHistory(request.args.get('start', type=float),
+			request.args.get('end', type=float), sensors, request.args.get('limit', type=int)))
+		
+	@siteRoot.route('/history/aggregates')
+	def historyAggregates():
+		return jsonify(stateMachine.sensorAggregates(request.args.get('start', type=float),
+			request.args.get('end', type=float)))
+		
+	@siteRoot.route('/history/heatmap')
+	def historyHeatmap():
+		end = request.args.get('end', time.time(), type=float)
+		start = request.args.get('start', end - 86400, type=float)
+		try:
+			heatmap = stateMachine.sensorHeatmap(start, end, request.args.get('bucket', 3600, type=float))
+		except ValueError as e:
+			return jsonify({'error': str(e)}), 400
+		return jsonify(heatmap)
+		
 	janusRunning()
 
 	app = Flask(__name__)
@@ -9,6 +9,5 @@ setup(name='pyledriver',
       license='GPLv3',
       packages=['pyledriver'],
 	  install_requires=['Flask', 'evdev', 'Flask-WTF', 'numpy',
-						'psutil', 'pyaudio', 'pygame', 'pyinotify',
-						'RPi.GPIO', 'requests', 'yaml'],
+						'pyaudio', 'pygame', 'RPi.GPIO', 'requests', 'yaml'],
       zip_safe=False)
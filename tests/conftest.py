@@ -0,0 +1,4 @@
+import os, sys
+
+# the modules import each other by name, as when run from the package directory
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'pyledriver'))
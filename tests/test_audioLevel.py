@@ -0,0 +1,34 @@
+import pytest, clock
+from audioLevel import LoudnessDetector
+
+INTERVAL = 0.05
+
+@pytest.fixture
+def virtual():
+	virtual = clock.VirtualClock()
+	clock.setClock(virtual)
+	yield virtual
+	clock.setClock(clock.RealClock())
+
+def _feed(detector, virtual, rms, peak, seconds):
+	flagged = 0
+	for i in range(round(seconds / INTERVAL)):
+		flagged += detector.feed(rms, peak)
+		virtual.advance(INTERVAL)
+	return flagged
+
+def test_bangIsFlagged(virtual):
+	detector = LoudnessDetector()
+	assert _feed(detector, virtual, -60, -50, 10) == 0
+	assert _feed(detector, virtual, -20, -1, 0.2) == 1
+	assert _feed(detector, virtual, -60, -50, 10) == 0
+
+def test_levelStepBecomesBackground(virtual):
+	detector = LoudnessDetector()
+	_feed(detector, virtual, -60, -50, 10)
+	# eg a fan switched on: one detection, not one every holdoff
+	assert _feed(detector, virtual, -30, -20, 300) == 1
+	assert detector.background == pytest.approx(-30, abs=1)
+
+	# and loud sounds are heard over the new level
+	assert _feed(detector, virtual, -2, -1, 0.2) == 1
@@ -0,0 +1,27 @@
+from simulation import Simulation
+
+def _spike(sim, pin):
+	sim.setPin(pin, 1)
+	sim.setPin(pin, 0)
+
+def test_spikesAreFlapping():
+	# only the reject rate can flag the sensor
+	with Simulation({'sensorHealth': {'flapRate': 1000}}) as sim:
+		sim.advance(60)
+		for i in range(8):
+			_spike(sim, 5)
+			sim.advance(1)
+		sim.advance(2)
+		metrics = sim.stateMachine.health.metrics['Nate\'s room']
+		assert (metrics['edges'], metrics['rejected']) == (16, 8)
+		assert metrics['rejectRate'] == 1
+		assert 'flapping' in metrics['flags']
+
+def test_motionIsNotFlapping():
+	with Simulation({'sensorHealth': {'flapRate': 1000}}) as sim:
+		sim.advance(60)
+		sim.motion(5)
+		sim.advance(10)
+		metrics = sim.stateMachine.health.metrics['Nate\'s room']
+		assert metrics['rejectRate'] == 0
+		assert metrics['flags'] == []
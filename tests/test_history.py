@@ -0,0 +1,21 @@
+import pytest
+from history import SensorHistory, MAX_BUCKETS
+
+def _history():
+	history = SensorHistory(['disarmed', 'armed'])
+	for t in (10, 20, 3700):
+		history.record(5, 'motion', 'armed', t=t)
+	return history
+
+def test_heatmap():
+	assert _history().heatmap(0, 7200, 3600) == {5: [2, 1, 0]}
+
+@pytest.mark.parametrize('bucket', [0, -1, float('nan')])
+def test_heatmapRejectsBadBucket(bucket):
+	with pytest.raises(ValueError):
+		_history().heatmap(0, 7200, bucket)
+
+def test_heatmapLimitsBuckets():
+	with pytest.raises(ValueError):
+		_history().heatmap(0, 7200, 0.0001)
+	assert len(_history().heatmap(0, MAX_BUCKETS - 1, 1)[5]) == MAX_BUCKETS
@@ -0,0 +1,168 @@
+'''
+State machine scenarios run against fake hardware (see simulation.py). Each
+test gets a simulation of its own
+'''
+
+import time, pytest
+from simulation import Simulation
+
+MOTION = 5
+VIDEO = 6
+DOOR = 22
+
+_ZONES = {
+	'bedrooms': ['Nate\'s room', 'Laura\'s room'],
+	'common': ['front door', 'deck window', 'kitchen bar', 'door']
+}
+
+# long enough for the motion sensors to warm up
+WARMUP = 60
+
+@pytest.fixture
+def sim():
+	with Simulation() as sim:
+		sim.advance(WARMUP)
+		yield sim
+
+def _passwd(sim):
+	return [{'1': 79, '2': 80, '3': 81, '4': 75, '5': 76, '6': 77}[c] for c in str(sim.passwd)] + [96]
+
+def test_armTripDisarm(sim):
+	sim.assertState('disarmed')
+	sim.secret('petrucci')
+	sim.assertState('armedCountdown')
+	sim.advance(31)
+	sim.assertState('armed')
+	sim.motion(MOTION)
+	sim.assertState('trippedCountdown')
+	sim.key(_passwd(sim))
+	sim.assertState('disarmed')
+
+def test_countdownTimesOut(sim):
+	sim.signal('INSTANT_ARM')
+	sim.assertState('armed')
+	sim.motion(MOTION)
+	sim.assertState('trippedCountdown')
+	sim.advance(40)
+	sim.assertState('tripped')
+
+def test_lockedDoorTrips(sim):
+	sim.signal('INSTANT_LOCK')
+	sim.assertState('locked')
+	sim.setPin(DOOR, 1)
+	sim.advance(1)
+	sim.assertState('trippedCountdown')
+
+def test_zonesArmSeparately():
+	with Simulation({'zones': _ZONES}) as sim:
+		sim.advance(WARMUP)
+		sim.signal('INSTANT_ARM', 'bedrooms')
+		sim.assertState('armed', 'bedrooms')
+		sim.assertState('disarmed', 'common')
+
+		# motion in a disarmed zone is ignored
+		sim.motion(19)
+		sim.assertState('disarmed', 'common')
+		sim.assertState('armed', 'bedrooms')
+
+		sim.motion(MOTION)
+		sim.assertState('trippedCountdown', 'bedrooms')
+		sim.assertState('disarmed', 'common')
+
+def test_restartKeepsState(sim):
+	sim.signal('INSTANT_ARM')
+	sim.assertState('armed')
+	sim.restart()
+	sim.assertState('armed')
+
+def test_restartResumesCountdown(sim):
+	sim.signal('INSTANT_ARM')
+	sim.motion(MOTION)
+	sim.assertState('trippedCountdown')
+	sim.restart()
+	sim.assertState('trippedCountdown')
+	sim.advance(40)
+	sim.assertState('tripped')
+
+def test_resumeSkipsColdStart(sim):
+	assert sim.usbResets == ['1-1']
+	sim.signal('INSTANT_ARM')
+	sim.restart()
+	# the camera was not reset and the sensors came up before it
+	assert sim.usbResets == ['1-1']
+	assert 'DoorSensor@door' in sim.stateMachine.camera.sensorsAtStart
+
+def test_keypadReplugged(sim):
+	sim.unplugKeypad()
+	sim.plugKeypad()
+	sim.signal('INSTANT_ARM')
+	sim.key(_passwd(sim))
+	sim.assertState('disarmed')
+
+def test_doorOpenedWhileDown(sim):
+	sim.setPin(DOOR, 1)
+	sim.advance(1)
+	sim.signal('INSTANT_ARM')
+	sim.assertState('armed')
+
+	# the door is opened while we are down, which is acted on at startup
+	sim.gpio.setLevel(DOOR, 0)
+	sim.restart()
+	sim.assertState('trippedCountdown')
+
+	# the countdown was started once, so disarming stops it for good and a
+	# later countdown runs its full length
+	sim.advance(20)
+	sim.signal('DISARM')
+	sim.signal('INSTANT_ARM')
+	sim.motion(MOTION)
+	sim.assertState('trippedCountdown')
+	sim.advance(15)
+	sim.assertState('trippedCountdown')
+
+def _levels(sim, rms, peak, seconds):
+	for i in range(round(seconds / 0.05)):
+		sim.level(rms, peak)
+		sim.advance(0.05)
+
+def test_ownSoundsDoNotTrip():
+	sensors = {'Nate\'s room': {'pin': MOTION, 'type': 'motion'}, 'door': {'pin': DOOR, 'type': 'door'},
+		'microphone': {'type': 'audio', 'warmup': 1}}
+	with Simulation({'sensors': sensors}) as sim:
+		_levels(sim, -60, -50, 5)
+
+		# the microphone hears the armed sound, which starts as the zone is armed
+		sim.signal('INSTANT_ARM')
+		sim.assertState('armed')
+		_levels(sim, -20, -5, 0.5)
+		sim.assertState('armed')
+
+		# but not for long after it ends
+		_levels(sim, -60, -50, 3)
+		_levels(sim, -20, -5, 0.2)
+		sim.assertState('trippedCountdown')
+
+def test_recordingDoesNotHoldUpSensors(sim):
+	import threading, sensors
+	fileDump = sim.stateMachine.fileDump
+	unblock = threading.Event()
+	addInitiator = fileDump.addInitiator
+	def slowAddInitiator(identifier):
+		unblock.wait(5)
+		addInitiator(identifier)
+	fileDump.addInitiator = slowAddInitiator
+
+	try:
+		sim.signal('INSTANT_ARM')
+		# motion in front of the camera starts a recording, which is slow to
+		# start; meanwhile the door still gets through
+		sim.setPin(VIDEO, 1)
+		sim.advance(1)
+		sim.assertState('trippedCountdown')
+		sim.setPin(DOOR, 1)
+		sim.advance(1)
+		assert sensors.getSensorStatus()['DoorSensor@door']['value'] == 1
+	finally:
+		unblock.set()
+	time.sleep(0.05)
+	assert fileDump.initiators == [VIDEO]
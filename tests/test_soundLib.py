@@ -0,0 +1,64 @@
+'''
+Speech pipeline of SoundLib, run in a simulation with speech synthesis stubbed
+out (every part is one second of silence from the fake mixer)
+'''
+
+import time, simulation
+from simulation import Simulation
+
+def _stubSynthesis(soundLib):
+	from soundLib import TTSSound
+	texts = {}
+	def speechSound(text):
+		sound = TTSSound(text)
+		texts[sound.sound] = text
+		return sound
+	soundLib._speechSound = speechSound
+	return texts
+
+def test_alarmGoesAheadOfWaitingSpeech():
+	with Simulation() as sim:
+		from soundLib import PRIORITY_ALARM
+		soundLib = sim.stateMachine.soundLib
+		texts = _stubSynthesis(soundLib)
+
+		for i in range(10):
+			soundLib.speak('normal {}'.format(i))
+		# give the workers time to take as much as they will
+		time.sleep(0.1)
+		soundLib.speak('alarm', PRIORITY_ALARM)
+		sim.advance(12)
+
+		spoken = [texts[s] for s in simulation._fakeMixer.played if s in texts]
+		# only what was playing and what the workers took ahead of it is said
+		# first, not everything that was waiting
+		assert spoken.index('alarm') <= 1 + soundLib._ttsWorkers
+		assert [t for t in spoken if t != 'alarm'] == ['normal {}'.format(i) for i in range(10)]
+
+def test_eventsAreAnnounced(caplog):
+	phrases = {
+		'trip': 'intruder detected in the {location}',
+		'armedCountdown': '{zone} arming',
+		'disarmed': 'alarm disarmed',
+		'countdown': 'never said'
+	}
+	with Simulation({'tts': {'phrases': phrases}}) as sim:
+		assert 'unknown event "countdown"' in caplog.text
+		texts = _stubSynthesis(sim.stateMachine.soundLib)
+		sim.advance(60)
+		sim.signal('ARM')
+		sim.advance(31)
+		sim.motion(5)
+		sim.assertState('trippedCountdown')
+		sim.advance(1)
+		sim.signal('DISARM')
+		sim.advance(1)
+		assert set(texts.values()) == {'house arming', 'intruder detected in the Nate\'s room',
+			'alarm disarmed'}
+
+def test_mixerFormatFitsDecodedSounds():
+	with Simulation() as sim:
+		# the decoded sound effects are 22.05 kHz mono; the streamed alarm
+		# (44.1 kHz) is resampled rather than raising the rate for all of them
+		fmt = sim.stateMachine.soundLib.memoryStats()['format']
+		assert (fmt['frequency'], fmt['channels']) == (22050, 1)